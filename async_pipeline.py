@@ -0,0 +1,350 @@
+'''
+Asyncio-native version of the pipeline. The synchronous scripts park a thread on every Azure poller and every
+OpenAI call, so a process handles as many documents at once as it has threads. Here every network wait is a
+coroutine on one event loop: the async OpenAI client and the async Azure Form Recognizer client each run over one
+shared keep-alive connection pool, Azure results are polled without blocking, and resilience.Backend.call_async
+keeps the usual rate limits and retries while bounding the requests in flight per backend (OPENAI_MAX_IN_FLIGHT,
+AZURE_MAX_IN_FLIGHT). CPU-bound and blocking steps (Docling conversion, the cache files, openpyxl) run on worker
+threads. A single process can keep hundreds of documents in flight; ASYNC_MAX_IN_FLIGHT bounds how many, and a
+document's PDF is only read once it has a slot.
+
+Table formatting, prompt building and the workbook writers are shared with backends.py. The "sections" and "text"
+parsers have async versions; "stream" only feeds the Streamlit apps' live table and stays synchronous.
+
+Usage:
+    async with AsyncPipeline("azure") as pipeline:
+        await pipeline.process_financial_statement(pdf_path, output_path)
+
+    python async_pipeline.py data/filings --output-dir data/out --backend azure --max-in-flight 200
+'''
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+from collections import namedtuple
+
+from backends import (
+    ANALYSIS_SYSTEM_MESSAGE,
+    EXTRACTORS,
+    SECTIONS_MODEL,
+    SECTIONS_SYSTEM_MESSAGE,
+    WRITERS,
+    build_prompts,
+    component,
+    extract_docling,
+    lazy_import,
+    load_environment,
+)
+import deadlines
+from instrumentation import Trace, record_document, record_pages, stage
+from resilience import AZURE_MAX_IN_FLIGHT, OPENAI_MAX_IN_FLIGHT, BackendError, DeadlineExceeded
+
+MAX_IN_FLIGHT = int(os.getenv("ASYNC_MAX_IN_FLIGHT", 200))
+KEEPALIVE_SECONDS = float(os.getenv("ASYNC_KEEPALIVE_SECONDS", 30))
+REQUEST_TIMEOUT = float(os.getenv("ASYNC_REQUEST_TIMEOUT", 600))
+
+DocumentResult = namedtuple("DocumentResult", ["pdf_path", "output_path", "parsed_data", "error", "pages",
+                                               "seconds", "trace"])
+
+
+class AsyncClients:
+    '''
+    The async OpenAI and Azure clients of one event loop, built on first use. Each client sends all of its
+    requests over one connection pool with keep-alive, sized to the backend's bound on requests in flight.
+    Clients passed in (e.g. the stand-ins of fakes.py) are used as they are.
+    '''
+
+    def __init__(self, openai_client=None, document_client=None):
+        self._openai = openai_client
+        self._document = document_client
+        self._closers = []
+
+    def openai(self):
+        if self._openai is None:
+            load_environment()
+            httpx = lazy_import("httpx")
+            http_client = httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=OPENAI_MAX_IN_FLIGHT,
+                                    max_keepalive_connections=OPENAI_MAX_IN_FLIGHT,
+                                    keepalive_expiry=KEEPALIVE_SECONDS),
+                timeout=httpx.Timeout(REQUEST_TIMEOUT, connect=10.0),
+            )
+            self._openai = lazy_import("openai").AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"),
+                                                             http_client=http_client)
+            self._closers.append(self._openai.close)
+        return self._openai
+
+    def document(self):
+        if self._document is None:
+            load_environment()
+            aiohttp = lazy_import("aiohttp")
+            session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=AZURE_MAX_IN_FLIGHT,
+                                                                           keepalive_timeout=KEEPALIVE_SECONDS))
+            transport = lazy_import("azure.core.pipeline.transport").AioHttpTransport(session=session,
+                                                                                      session_owner=False)
+            credentials = lazy_import("azure.core.credentials")
+            self._document = lazy_import("azure.ai.formrecognizer.aio").DocumentAnalysisClient(
+                endpoint=os.getenv("AZURE_DOCUMENT_ANALYZER_ENDPOINT"),
+                credential=credentials.AzureKeyCredential(os.getenv("AZURE_DOCUMENT_ANALYZER_KEY")),
+                transport=transport,
+            )
+            self._closers += [session.close, self._document.close]
+        return self._document
+
+    async def close(self):
+        while self._closers:
+            await self._closers.pop()()
+
+
+'''
+Azure prebuilt-layout on a PDF (a file path or the PDF bytes) through the async client; returns the statement
+tables as TableGrids.
+'''
+async def extract_azure_async(clients, pdf):
+    from layout_cache import cached_azure_tables_async
+    from table_relevance import select_tables
+
+    try:
+        return select_tables(await cached_azure_tables_async(clients.document(), pdf))
+    except BackendError:
+        raise
+    except Exception as e:
+        print(f"Error extracting tables: {e}")
+        return []
+
+
+async def extract_docling_async(clients, pdf, pool=None):
+    '''Docling converts on the CPU, so the conversion runs on a worker thread.'''
+    return await asyncio.to_thread(extract_docling, pdf, pool)
+
+
+'''
+Typed extraction through the model cascade (see backends.parse_sections) with every section and chunk call a
+coroutine.
+'''
+async def parse_sections_async(clients, tables, extractor, model=SECTIONS_MODEL, prompt_path='data/prompt.txt',
+                               cascade=None):
+    try:
+        tables_by_statement, fallback_tables = extractor.statement_tables(tables)
+        extract = await lazy_import("cascade").cascade_extract_async(
+            clients.openai(),
+            tables_by_statement,
+            prompt_path=prompt_path,
+            model=model,
+            system_message=SECTIONS_SYSTEM_MESSAGE,
+            fallback_tables=fallback_tables,
+            cascade=cascade
+        )
+        return lazy_import("sections").deadline_partial(extract)
+    except BackendError:
+        raise
+    except Exception as e:
+        print(f"Error parsing tables with OpenAI: {e}")
+        return None
+
+
+'''
+Plain chat completion over every table through the model cascade (see backends.parse_text); the calls of a chunked
+prompt run concurrently.
+'''
+async def parse_text_async(clients, tables, extractor, model="gpt-4", prompt_path='data/prompt.txt', cascade=None):
+    from llm_cache import cached_create_async
+    from metric_rows import PartialText, merge_metric_rows, parse_metric_rows, unreported_metrics
+    from prompt import load_prompt
+
+    cascade_module = lazy_import("cascade")
+    prompt_tables = extractor.prompt_tables(tables)
+
+    async def answer(tier_model):
+        prompts = build_prompts(prompt_path, prompt_tables, tier_model)
+        answers = await deadlines.gather_by_deadline(cached_create_async(
+            clients.openai(),
+            model=tier_model,
+            messages=[
+                {"role": "system", "content": ANALYSIS_SYSTEM_MESSAGE},
+                {"role": "user", "content": prompt}
+            ]
+        ) for prompt in prompts)
+        if deadlines.MISSED in answers:
+            deadlines.miss("text")
+            answers = [text for text in answers if text is not deadlines.MISSED]
+        if len(answers) == 1:
+            return answers[0]
+        rows = merge_metric_rows(parse_metric_rows(text or "") for text in answers)
+        return "\n".join(" | ".join(row) for row in rows)
+
+    prompt_text = load_prompt(prompt_path)
+    try:
+        text = await cascade_module.cascade_answer_async(answer, cascade_module.cascade_models(model, cascade),
+                                                         cascade_module.text_completeness(prompt_text))
+    except DeadlineExceeded:
+        text = None
+    except BackendError:
+        raise
+    except Exception as e:
+        print(f"Error parsing tables with OpenAI: {e}")
+        return ""
+    if "text" in deadlines.missed() or (text is None and deadlines.expired()):
+        return PartialText(text or "", unreported_metrics(text or "", prompt_text))
+    return text
+
+
+ASYNC_EXTRACTORS = {
+    "azure": extract_azure_async,
+    "docling": extract_docling_async,
+}
+
+ASYNC_PARSERS = {
+    "sections": parse_sections_async,
+    "text": parse_text_async,
+}
+
+
+class AsyncPipeline:
+    '''
+    The pipeline stages as coroutines, over one set of clients. Use it as an async context manager so the
+    connection pools are closed with it. With a deadline (seconds), each document gets that latency budget
+    (deadlines.py) and a document that runs out of it is written from a partial result.
+    '''
+
+    def __init__(self, backend="azure", parser="sections", writer="metrics", clients=None,
+                 max_in_flight=MAX_IN_FLIGHT, deadline=None, **parser_options):
+        self.extractor = component(EXTRACTORS, backend)
+        self.extract = component(ASYNC_EXTRACTORS, backend)
+        self.parse = component(ASYNC_PARSERS, parser)
+        self.write = component(WRITERS, writer)
+        self.clients = clients or AsyncClients()
+        self.max_in_flight = max_in_flight
+        self.deadline = deadline
+        self.parser_options = parser_options
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.clients.close()
+
+    async def extract_tables_from_pdf(self, pdf):
+        return await self.extract(self.clients, pdf)
+
+    async def parse_tables_with_openai(self, tables):
+        return await self.parse(self.clients, tables, self.extractor, **self.parser_options)
+
+    async def save_to_excel(self, parsed_data, output):
+        # openpyxl builds and writes the workbook synchronously; it runs on a worker thread
+        return await asyncio.to_thread(self.write, parsed_data, output)
+
+    '''
+    Runs the three stages on one PDF (path or bytes) and writes the workbook to output. Returns the parsed data;
+    an empty stage result raises RuntimeError instead of producing an empty workbook.
+    '''
+    async def process_financial_statement(self, pdf, output):
+        with deadlines.budget(self.deadline):
+            with stage("extract"):
+                tables = await self.extract_tables_from_pdf(pdf)
+            if not tables:
+                raise RuntimeError("No tables found in the PDF")
+
+            with stage("parse"):
+                parsed_data = await self.parse_tables_with_openai(tables)
+            if not parsed_data:
+                raise RuntimeError("Failed to parse data with OpenAI")
+
+            with stage("save"):
+                if await self.save_to_excel(parsed_data, output) is False:
+                    raise RuntimeError("Failed to create Excel file")
+        return parsed_data
+
+    '''
+    Processes many PDFs concurrently, at most max_in_flight at a time, each with its own Trace. output_path maps a
+    PDF path to its workbook path; on_finish(DocumentResult), if given, is called as each document ends. Returns
+    the DocumentResults in the order of pdf_paths.
+    '''
+    async def process_many(self, pdf_paths, output_path, on_finish=None):
+        from page_selection import count_pages
+
+        documents = asyncio.BoundedSemaphore(self.max_in_flight)
+
+        async def run(pdf_path):
+            async with documents:
+                trace = Trace(pdf_path)
+                parsed_data, error, pages = None, None, 0
+                with trace.activate():
+                    try:
+                        pages = await asyncio.to_thread(count_pages, pdf_path)
+                        record_pages(pages)
+                        parsed_data = await self.process_financial_statement(pdf_path, output_path(pdf_path))
+                    except Exception as e:
+                        error = e
+                record_document("failed" if error else "partial" if getattr(parsed_data, "missing", None) else "done")
+                result = DocumentResult(pdf_path, output_path(pdf_path), parsed_data, error, pages,
+                                        round(time.time() - trace.started, 3), trace)
+                if on_finish is not None:
+                    on_finish(result)
+                return result
+
+        return list(await asyncio.gather(*(run(pdf_path) for pdf_path in pdf_paths)))
+
+
+def main(argv=None):
+    from batch import Journal, collect_inputs, output_stem
+
+    parser = argparse.ArgumentParser(description="Extract financial metrics from many PDFs on one event loop.")
+    parser.add_argument("source", help="directory of PDFs, or a manifest file with one PDF path per line")
+    parser.add_argument("--output-dir", default="data/batch_output")
+    parser.add_argument("--backend", choices=sorted(ASYNC_EXTRACTORS), default="azure")
+    parser.add_argument("--parser", choices=sorted(ASYNC_PARSERS), default="sections")
+    parser.add_argument("--journal", help="progress journal (default: <output-dir>/journal.jsonl)")
+    parser.add_argument("--max-in-flight", type=int, default=MAX_IN_FLIGHT, help="documents processed at once")
+    parser.add_argument("--deadline", type=float, help="latency budget per document, in seconds")
+    args = parser.parse_args(argv)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    journal = Journal(args.journal or os.path.join(args.output_dir, "journal.jsonl"))
+    pdf_paths = collect_inputs(args.source)
+    completed = journal.completed()
+    remaining = [path for path in pdf_paths if path not in completed]
+    print(f"{len(pdf_paths)} files, {len(pdf_paths) - len(remaining)} already done, {len(remaining)} to process")
+
+    def output_path(pdf_path):
+        return os.path.join(args.output_dir, f"{output_stem(pdf_path)}.xlsx")
+
+    def finished(result):
+        trace_path = os.path.join(args.output_dir, "traces", f"{output_stem(result.pdf_path)}.json")
+        try:
+            result.trace.write(trace_path)
+        except OSError as e:
+            print(f"Error writing trace for {result.pdf_path}: {e}")
+        missing = getattr(result.parsed_data, "missing", None)
+        if result.error is None:
+            journal.record(file=result.pdf_path, status="done", pages=result.pages, seconds=result.seconds,
+                           output=result.output_path, trace=trace_path, **({"missing": missing} if missing else {}))
+            print(f"[done] {result.pdf_path} ({result.pages} pages, {result.seconds}s)"
+                  + (f", past the deadline without: {', '.join(missing)}" if missing else ""))
+        else:
+            journal.record(file=result.pdf_path, status="failed", error=str(result.error),
+                           error_kind=getattr(result.error, "kind", type(result.error).__name__),
+                           seconds=result.seconds)
+            print(f"[failed] {result.pdf_path}: {result.error}")
+
+    async def run():
+        async with AsyncPipeline(args.backend, parser=args.parser, max_in_flight=args.max_in_flight,
+                                 deadline=args.deadline) as pipeline:
+            return await pipeline.process_many(remaining, output_path, finished)
+
+    start = time.perf_counter()
+    results = asyncio.run(run())
+    minutes = max(time.perf_counter() - start, 1e-9) / 60
+    succeeded = [result for result in results if result.error is None]
+    pages = sum(result.pages for result in succeeded)
+    print(f"Processed {len(succeeded)} files ({len(results) - len(succeeded)} failed) in {minutes * 60:.1f}s: "
+          f"{len(succeeded) / minutes:.2f} files/min, {pages / minutes:.1f} pages/min")
+    for line in lazy_import("cascade").stats_lines():
+        print(line)
+    return 1 if len(succeeded) < len(results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
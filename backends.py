@@ -0,0 +1,387 @@
+'''
+Registry of the pipeline components shared by the scripts and apps: layout extractors ("azure", "docling"), LLM
+parsers ("sections", "text", "stream") and workbook writers ("metrics", "text", "rows"). A component's heavy
+dependencies (the Azure and OpenAI SDKs, Docling, openpyxl, numpy) and its API clients are loaded on first use,
+so an entry point only pays for the backend it actually runs; nothing is imported or connected at import time.
+
+Table texts are re-encoded compactly before they reach a prompt and prompts are held to a token budget; tables
+over the budget are sent in chunks whose answers are merged (see prompt_budget.py). When OPENAI_CASCADE_MODELS is
+set, the "sections" and "text" parsers ask those cheaper models first and escalate low-confidence answers (see
+cascade.py).
+
+Components are plain functions in EXTRACTORS, PARSERS and WRITERS. Other components can be added to those dicts,
+or named as "module:attribute" paths, which are imported on first use. Every lazy import is timed; import_times()
+reports them and IMPORT_TIME_BUDGET is the cold start budget the benchmark suite checks the entry points against.
+
+Usage:
+    pipeline = load_pipeline("azure")
+    tables = pipeline.extract_tables_from_pdf(pdf_path)
+    parsed_data = pipeline.parse_tables_with_openai(tables)
+    pipeline.save_to_excel(parsed_data, output_path)
+'''
+
+import contextvars
+import importlib
+import os
+import sys
+import threading
+import time
+from collections import namedtuple
+
+import deadlines
+from instrumentation import REGISTRY, stage
+from resilience import BackendError, DeadlineExceeded
+
+IMPORT_TIME_BUDGET = float(os.getenv("IMPORT_TIME_BUDGET", 1.0))
+
+SECTIONS_MODEL = "gpt-4o-2024-08-06"
+SECTIONS_SYSTEM_MESSAGE = "You are a helpful assistant for structured financial data extraction. You will be given unstructured text from a research paper and should convert it into the given structure."
+ANALYSIS_SYSTEM_MESSAGE = "You are a helpful assistant for financial analysis."
+
+IMPORT_SECONDS = REGISTRY.histogram("module_import_seconds", "Time spent importing lazily loaded modules.",
+                                    ["module"])
+
+Extractor = namedtuple("Extractor", ["extract", "statement_tables", "prompt_tables"])
+Pipeline = namedtuple("Pipeline", ["extract_tables_from_pdf", "parse_tables_with_openai", "save_to_excel"])
+
+_import_times = {}
+_clients = {}
+_lock = threading.Lock()
+# reentrant: a client's build() loads the environment through _client as well
+_clients_lock = threading.RLock()
+
+
+'''
+Imports a module on first use and records how long the import took.
+'''
+def lazy_import(name):
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+    start = time.perf_counter()
+    module = importlib.import_module(name)
+    seconds = time.perf_counter() - start
+    with _lock:
+        _import_times.setdefault(name, round(seconds, 4))
+    IMPORT_SECONDS.observe(seconds, module=name)
+    return module
+
+
+def import_times():
+    with _lock:
+        return dict(_import_times)
+
+
+def _client(name, build):
+    with _clients_lock:
+        if name not in _clients:
+            _clients[name] = build()
+        return _clients[name]
+
+
+def load_environment():
+    '''Reads .env once; settings already in the environment win.'''
+    def load():
+        lazy_import("dotenv").load_dotenv()
+        return True
+    return _client("environment", load)
+
+
+def openai_client():
+    def build():
+        load_environment()
+        return lazy_import("openai").OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+    return _client("openai", build)
+
+
+def document_client():
+    def build():
+        load_environment()
+        formrecognizer = lazy_import("azure.ai.formrecognizer")
+        credentials = lazy_import("azure.core.credentials")
+        return formrecognizer.DocumentAnalysisClient(
+            endpoint=os.getenv("AZURE_DOCUMENT_ANALYZER_ENDPOINT"),
+            credential=credentials.AzureKeyCredential(os.getenv("AZURE_DOCUMENT_ANALYZER_KEY"))
+        )
+    return _client("azure", build)
+
+
+'''
+Resolves a component: a name registered in components, or a "module:attribute" path imported on first use.
+'''
+def component(components, name):
+    if name in components:
+        return components[name]
+    module, _, attribute = name.partition(":")
+    if not attribute:
+        raise KeyError(f"Unknown component {name!r}; choose one of {', '.join(sorted(components))}")
+    return getattr(lazy_import(module), attribute)
+
+
+'''
+Azure prebuilt-layout on a PDF (a file path or the PDF bytes); returns the statement tables as TableGrids.
+'''
+def extract_azure(pdf):
+    from layout_cache import cached_azure_tables
+    from table_relevance import select_tables
+
+    try:
+        return select_tables(cached_azure_tables(document_client(), pdf))
+    except BackendError:
+        raise
+    except Exception as e:
+        print(f"Error extracting tables: {e}")
+        return []
+
+
+'''
+Docling on a PDF (a file path or the PDF bytes) through a pool of warm converters (the shared one unless pool is
+given); returns the document exported to markdown.
+'''
+def extract_docling(pdf, pool=None):
+    from docling_pool import default_pool
+    from layout_cache import cached_docling_markdown
+    from uploads import scratch_file
+
+    pool = pool or default_pool()
+    try:
+        if isinstance(pdf, (bytes, bytearray)):
+            with scratch_file(pdf, suffix=".pdf") as pdf_path:
+                return cached_docling_markdown(pool.convert_markdown, pdf_path)
+        return cached_docling_markdown(pool.convert_markdown, pdf)
+    except Exception as e:
+        print(f"Error extracting tables: {e}")
+        return []
+
+
+def azure_statement_tables(grids):
+    from prompt_budget import compact_table
+    from table_relevance import group_tables
+
+    groups = {statement: [compact_table(table) for table in tables]
+              for statement, tables in group_tables(grids).items()}
+    return groups, [compact_table(grid.to_text()) for grid in grids]
+
+
+def _markdown_tables(markdown):
+    from prompt_budget import compact_table
+    return [compact_table(block) for block in markdown.split("\n\n") if block.strip()]
+
+
+def docling_statement_tables(markdown):
+    from prompt_budget import compact_table
+    from table_relevance import group_markdown, prune_markdown
+
+    groups = {statement: [compact_table(table) for table in tables]
+              for statement, tables in group_markdown(markdown).items()}
+    return groups, _markdown_tables(prune_markdown(markdown))
+
+
+def azure_prompt_tables(grids):
+    from prompt_budget import compact_table
+    return [compact_table(grid.to_text()) for grid in grids]
+
+
+def docling_prompt_tables(markdown):
+    from table_relevance import prune_markdown
+    return _markdown_tables(prune_markdown(markdown))
+
+
+'''
+The prompts for tables sent to model: one prompt when the tables fit the token budget, otherwise one per chunk.
+'''
+def build_prompts(prompt_path, tables, model, system_message=ANALYSIS_SYSTEM_MESSAGE):
+    from prompt import load_prompt
+    from prompt_budget import chunk_tables, token_budget
+
+    with stage("prompt_build"):
+        prompt = load_prompt(prompt_path)
+        chunks = chunk_tables(tables, token_budget(model, system_message + prompt), model)
+        return [prompt + "".join("\n" + table + "\n" for table in chunk) for chunk in chunks]
+
+
+'''
+Typed extraction: each statement section is extracted by its own concurrent structured-output call and merged
+back; sections failing the accounting checks are extracted once more. Sections go through the model cascade
+(cascade.py): the cheaper models of cascade answer first and only low-confidence sections reach model. Returns None
+when the extraction fails, and a PartialTypedFinancialStatementExtract when the run's deadline cut sections short.
+'''
+def parse_sections(tables, extractor, model=SECTIONS_MODEL, prompt_path='data/prompt.txt', cascade=None):
+    try:
+        tables_by_statement, fallback_tables = extractor.statement_tables(tables)
+        extract = lazy_import("cascade").cascade_extract(
+            openai_client(),
+            tables_by_statement,
+            prompt_path=prompt_path,
+            model=model,
+            system_message=SECTIONS_SYSTEM_MESSAGE,
+            fallback_tables=fallback_tables,
+            cascade=cascade
+        )
+        return lazy_import("sections").deadline_partial(extract)
+    except BackendError:
+        raise
+    except Exception as e:
+        print(f"Error parsing tables with OpenAI: {e}")
+        return None
+
+
+'''
+One plain chat completion over every table; returns the answer as "metric | value" lines, or "" on failure. Tables
+over the token budget are sent as concurrent calls, one per chunk, and the rows of the answers merged. The document
+goes through the model cascade (cascade.py): model only answers when the cheaper models' answer is incomplete. When
+the run's deadline cuts the answer (or some of its chunks) short, the rows that did arrive are returned as a
+metric_rows.PartialText.
+'''
+def parse_text(tables, extractor, model="gpt-4", prompt_path='data/prompt.txt', cascade=None):
+    from llm_cache import cached_create
+    from metric_rows import PartialText, merge_metric_rows, parse_metric_rows, unreported_metrics
+    from prompt import load_prompt
+
+    cascade_module = lazy_import("cascade")
+    prompt_tables = extractor.prompt_tables(tables)
+
+    def answer(tier_model):
+        prompts = build_prompts(prompt_path, prompt_tables, tier_model)
+
+        def call(prompt):
+            return cached_create(
+                openai_client(),
+                model=tier_model,
+                messages=[
+                    {"role": "system", "content": ANALYSIS_SYSTEM_MESSAGE},
+                    {"role": "user", "content": prompt}
+                ]
+            )
+
+        if len(prompts) == 1:
+            return call(prompts[0])
+        with deadlines.thread_pool(len(prompts), "chunk") as pool:
+            futures = [pool.submit(contextvars.copy_context().run, call, prompt) for prompt in prompts]
+            answers = deadlines.results_by_deadline(futures)
+        if deadlines.MISSED in answers:
+            deadlines.miss("text")
+        rows = merge_metric_rows(parse_metric_rows(text or "") for text in answers if text is not deadlines.MISSED)
+        return "\n".join(" | ".join(row) for row in rows)
+
+    prompt_text = load_prompt(prompt_path)
+    try:
+        text = cascade_module.cascade_answer(answer, cascade_module.cascade_models(model, cascade),
+                                             cascade_module.text_completeness(prompt_text))
+    except DeadlineExceeded:
+        text = None
+    except BackendError:
+        raise
+    except Exception as e:
+        print(f"Error parsing tables with OpenAI: {e}")
+        return ""
+    if "text" in deadlines.missed() or (text is None and deadlines.expired()):
+        return PartialText(text or "", unreported_metrics(text or "", prompt_text))
+    return text
+
+
+'''
+Streamed chat completion over every table; returns the answer as [metric, value] rows. on_rows(rows) is called
+with the rows so far each time a line has streamed in, e.g. to render them live. Tables over the token budget are
+streamed chunk after chunk, each chunk's rows merged into the rows so far.
+'''
+def parse_stream(tables, extractor, on_rows=None, model="gpt-4-turbo", prompt_path='data/prompt.txt'):
+    from llm_cache import cached_stream
+    from metric_rows import MetricRowParser, merge_metric_rows
+
+    on_rows = on_rows or (lambda rows: None)
+    prompts = build_prompts(prompt_path, extractor.prompt_tables(tables), model)
+    done, rows = [], []
+    try:
+        for prompt in prompts:
+            parser = MetricRowParser()
+            chunk_rows = []
+            for delta in cached_stream(
+                openai_client(),
+                model=model,
+                messages=[
+                    {"role": "system", "content": ANALYSIS_SYSTEM_MESSAGE},
+                    {"role": "user", "content": prompt}
+                ]
+            ):
+                new_rows = parser.feed(delta)
+                if new_rows:
+                    chunk_rows.extend(new_rows)
+                    rows = merge_metric_rows(done + [chunk_rows])
+                    on_rows(rows)
+            chunk_rows.extend(parser.close())
+            done.append(chunk_rows)
+            rows = merge_metric_rows(done)
+            on_rows(rows)
+        return rows
+    except BackendError:
+        raise
+    except Exception as e:
+        print(f"Error parsing tables with OpenAI: {e}")
+        return rows
+
+
+'''
+Saves rows to a "Financial Metrics" workbook at output, a file path or a writable file object such as io.BytesIO.
+Returns False when the workbook could not be written.
+'''
+def write_rows(rows, output):
+    try:
+        workbook = lazy_import("openpyxl").Workbook()
+        sheet = workbook.active
+        sheet.title = "Financial Metrics"
+
+        for row in rows:
+            sheet.append(row)
+
+        workbook.save(output)
+        return True
+    except Exception as e:
+        print(f"Error saving data to Excel: {e}")
+        return False
+
+
+def write_metrics(parsed_data, output):
+    '''A typed extract, one numeric column per period.'''
+    return write_rows(lazy_import("normalize").worksheet_rows(parsed_data), output)
+
+
+def write_text(parsed_data, output):
+    '''"metric | value" lines, as returned by parse_text.'''
+    rows = [["Metric", "Value"]]
+    for line in parsed_data.split("\n"):
+        vals = line.split("|")
+        if len(vals) >= 2:
+            rows.append([x.strip() for x in vals[:2]])
+    return write_rows(rows, output)
+
+
+EXTRACTORS = {
+    "azure": Extractor(extract_azure, azure_statement_tables, azure_prompt_tables),
+    "docling": Extractor(extract_docling, docling_statement_tables, docling_prompt_tables),
+}
+
+PARSERS = {
+    "sections": parse_sections,
+    "text": parse_text,
+    "stream": parse_stream,
+}
+
+WRITERS = {
+    "metrics": write_metrics,
+    "text": write_text,
+    "rows": write_rows,
+}
+
+
+'''
+Binds an extractor, a parser and a writer into the three pipeline stages. Nothing is loaded until a stage runs.
+'''
+def load_pipeline(backend, parser="sections", writer="metrics", **parser_options):
+    extractor = component(EXTRACTORS, backend)
+    parse = component(PARSERS, parser)
+    return Pipeline(
+        extractor.extract,
+        lambda tables: parse(tables, extractor, **parser_options),
+        component(WRITERS, writer),
+    )
@@ -0,0 +1,145 @@
+'''
+Background processing for the Streamlit apps. Streamlit re-executes the whole script on every widget interaction,
+so the pipeline does not run in the script itself: it runs on a worker pool shared by every session, and the
+session keeps the document's run under the SHA-256 of the upload. A rerun (clicking the download button, touching
+the uploader) finds the run and renders its progress or its result, so each document is processed once per
+session. The API clients and Docling converters the pipeline uses are process-wide already (see backends.py).
+
+Usage:
+    key = upload_key(uploaded_file.getbuffer())
+    runs = session_runs(st.session_state)
+    if key not in runs:
+        runs[key] = runner.submit(key, process_upload, write_scratch_file(...), extractor, prompt_path)
+    run = runs[key]  # render run.label(), run.fraction(), run.rows until run.done()
+'''
+
+import hashlib
+import io
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from backends import parse_stream, write_rows
+from instrumentation import stage
+from jobs import FAILED, QUEUED, RUNNING, SUCCEEDED
+from uploads import remove_scratch_file
+
+DEFAULT_WORKERS = int(os.getenv("STREAMLIT_PIPELINE_WORKERS", 2))
+
+STAGES = ("extract", "parse", "save")
+STAGE_LABELS = {
+    QUEUED: "Waiting for a worker...",
+    "extract": "Extracting tables from the PDF...",
+    "parse": "Extracting metrics with OpenAI...",
+    "save": "Saving data to Excel...",
+    SUCCEEDED: "Processing complete!",
+    FAILED: "Processing failed.",
+}
+
+
+class BackgroundRun:
+    '''Progress and outcome of one document. Written by the worker thread, read by script reruns.'''
+
+    def __init__(self, key):
+        self.key = key
+        self.status = QUEUED
+        self.stage = None
+        self.completed = []
+        self.rows = []
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.seconds = None
+        self._done = threading.Event()
+
+    def progress(self, stage):
+        if self.stage is not None:
+            self.completed.append(self.stage)
+        self.status, self.stage = RUNNING, stage
+
+    def set_rows(self, rows):
+        self.rows = list(rows)
+
+    def finish(self, result=None, error=None):
+        if self.stage is not None and error is None:
+            self.completed.append(self.stage)
+        self.result, self.error = result, error
+        self.status = FAILED if error is not None else SUCCEEDED
+        self.seconds = round(time.time() - self.created, 3)
+        self._done.set()
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+    def fraction(self):
+        return len(self.completed) / len(STAGES)
+
+    def label(self):
+        return STAGE_LABELS.get(self.stage if self.status == RUNNING else self.status, "")
+
+
+class BackgroundRunner:
+
+    def __init__(self, workers=DEFAULT_WORKERS):
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix="streamlit-pipeline")
+
+    def submit(self, key, fn, *args, **kwargs):
+        '''Runs fn(run, *args, **kwargs) on a worker; its return value becomes run.result.'''
+        run = BackgroundRun(key)
+        self._executor.submit(self._run, run, fn, args, kwargs)
+        return run
+
+    def _run(self, run, fn, args, kwargs):
+        try:
+            result = fn(run, *args, **kwargs)
+        except Exception as e:
+            print(f"Error processing {run.key}: {e}")
+            run.finish(error=e)
+        else:
+            run.finish(result)
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+
+def upload_key(buffer):
+    return hashlib.sha256(buffer).hexdigest()
+
+
+def session_runs(session_state):
+    '''The runs of this session by upload key; survives reruns, not new sessions.'''
+    if "background_runs" not in session_state:
+        session_state["background_runs"] = {}
+    return session_state["background_runs"]
+
+
+'''
+The Streamlit pipeline: extracts the tables of the PDF at pdf_path, streams the metrics into run.rows and returns
+the workbook as bytes. The scratch file at pdf_path is removed when the run ends.
+'''
+def process_upload(run, pdf_path, extractor, prompt_path, **extract_options):
+    try:
+        run.progress("extract")
+        with stage("extract"):
+            tables = extractor.extract(pdf_path, **extract_options)
+        if not tables:
+            raise RuntimeError("No tables found in the PDF.")
+
+        run.progress("parse")
+        with stage("parse"):
+            rows = parse_stream(tables, extractor, run.set_rows, prompt_path=prompt_path)
+        if not rows:
+            raise RuntimeError("Failed to parse data with OpenAI.")
+
+        run.progress("save")
+        excel_file = io.BytesIO()
+        with stage("save"):
+            if not write_rows(rows, excel_file):
+                raise RuntimeError("Failed to create Excel file.")
+        return excel_file.getvalue()
+    finally:
+        remove_scratch_file(pdf_path)
@@ -0,0 +1,260 @@
+'''
+Batch runner for backfills. Takes a directory of PDFs (or a manifest file listing one PDF path per line) and runs
+the layout, LLM and Excel stages of a pipeline script as overlapping stages: while one filing is waiting on the
+LLM, the next ones are already in layout analysis. Each stage has its own concurrency limit and a bounded number
+of documents waiting for it (--queue-size, by default as many as its workers); a stage whose successor is full
+blocks, so a fast layout stage cannot pile up extracted tables in front of a slow LLM stage.
+
+Finished files are appended to a JSONL progress journal, so a crashed or interrupted run can be restarted with
+the same arguments and only the remaining files are processed. Every document gets a JSON trace with its stage
+timings, page and table counts, token usage and cost (see instrumentation.py) in <output-dir>/traces. Outputs are
+named after the PDF plus a hash of its path, so same-named PDFs from different directories do not collide. The run
+ends with a throughput summary and the hit rate and latency of each model cascade tier (see cascade.py). Each
+extract is checked against the accounting identities (see validation.py) once its workbook is written, and only
+the names of the failed checks are kept; they are written to validation.json in the output directory.
+
+Usage: python batch.py data/filings --output-dir data/out --backend azure --layout-workers 4 --llm-workers 8
+'''
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from backends import EXTRACTORS, load_pipeline
+from cascade import stats_lines
+from instrumentation import Trace, record_document, record_pages, stage
+from page_selection import count_pages
+
+'''
+Expands the input into a sorted list of PDF paths: every *.pdf in a directory, or the paths listed in a manifest.
+'''
+def collect_inputs(source):
+    if os.path.isdir(source):
+        names = [name for name in os.listdir(source) if name.lower().endswith(".pdf")]
+        return sorted(os.path.abspath(os.path.join(source, name)) for name in names)
+    base = os.path.dirname(os.path.abspath(source))
+    with open(source, "r") as f:
+        lines = [line.strip() for line in f]
+    return [os.path.abspath(os.path.join(base, line)) for line in lines if line and not line.startswith("#")]
+
+
+'''
+The name a document's workbook and trace are written under: the PDF's stem plus a short hash of its full path, so
+PDFs with the same name in different directories of a manifest do not overwrite each other's outputs.
+'''
+def output_stem(pdf_path):
+    stem = os.path.splitext(os.path.basename(pdf_path))[0]
+    return f"{stem}-{hashlib.sha256(os.path.abspath(pdf_path).encode()).hexdigest()[:8]}"
+
+
+class Journal:
+    '''Append-only JSONL record of finished files. One line per file and outcome.'''
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def completed(self):
+        done = set()
+        if not os.path.exists(self.path):
+            return done
+        with open(self.path, "r") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # a torn last line from a crash
+                if entry.get("status") == "done":
+                    done.add(entry["file"])
+        return done
+
+    def record(self, **entry):
+        entry["time"] = time.time()
+        with self._lock:
+            with open(self.path, "a") as f:
+                f.write(json.dumps(entry) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+
+class Stage:
+    '''
+    A pipeline stage: a thread pool and a semaphore admitting at most workers + queue_size documents, running or
+    waiting. submit() blocks the caller (the previous stage) while the stage is full.
+    '''
+
+    def __init__(self, name, workers, queue_size=None):
+        self.pool = ThreadPoolExecutor(workers, thread_name_prefix=name)
+        self._slots = threading.Semaphore(workers + (workers if queue_size is None else queue_size))
+
+    def submit(self, fn, *args):
+        self._slots.acquire()
+
+        def run():
+            try:
+                fn(*args)
+            finally:
+                self._slots.release()
+
+        self.pool.submit(run)
+
+    def shutdown(self):
+        self.pool.shutdown()
+
+
+class BatchRunner:
+
+    def __init__(self, pipeline, output_dir, journal, layout_workers=4, llm_workers=4, excel_workers=2,
+                 trace_dir=None, queue_size=None):
+        self.pipeline = pipeline
+        self.output_dir = output_dir
+        self.journal = journal
+        self.trace_dir = trace_dir or os.path.join(output_dir, "traces")
+        self.layout_stage = Stage("layout", layout_workers, queue_size)
+        self.llm_stage = Stage("llm", llm_workers, queue_size)
+        self.excel_stage = Stage("excel", excel_workers, queue_size)
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._all_done = threading.Event()
+        self.succeeded = 0
+        self.failed = 0
+        self.pages = 0
+        self.validation = {}  # pdf path -> names of the failed accounting checks
+
+    def output_path(self, pdf_path):
+        return os.path.join(self.output_dir, f"{output_stem(pdf_path)}.xlsx")
+
+    def trace_path(self, pdf_path):
+        return os.path.join(self.trace_dir, f"{output_stem(pdf_path)}.json")
+
+    def run(self, pdf_paths):
+        self._pending = len(pdf_paths)
+        if not pdf_paths:
+            return
+        for pdf_path in pdf_paths:
+            self.layout_stage.submit(self._layout, pdf_path, Trace(pdf_path))
+        self._all_done.wait()
+        for pipeline_stage in (self.layout_stage, self.llm_stage, self.excel_stage):
+            pipeline_stage.shutdown()
+
+    # each stage re-activates the document's trace, since it runs on a thread of another pool
+
+    def _layout(self, pdf_path, trace):
+        with trace.activate():
+            try:
+                pages = count_pages(pdf_path)
+                record_pages(pages)
+                with stage("extract"):
+                    tables = self.pipeline.extract_tables_from_pdf(pdf_path)
+                if not tables:
+                    raise RuntimeError("no tables extracted")
+            except Exception as e:
+                return self._finish(pdf_path, trace, "layout", e)
+        self.llm_stage.submit(self._llm, pdf_path, trace, pages, tables)
+
+    def _llm(self, pdf_path, trace, pages, tables):
+        with trace.activate():
+            try:
+                with stage("parse"):
+                    parsed_data = self.pipeline.parse_tables_with_openai(tables)
+                if not parsed_data:
+                    raise RuntimeError("no data parsed")
+            except Exception as e:
+                return self._finish(pdf_path, trace, "llm", e)
+        self.excel_stage.submit(self._excel, pdf_path, trace, pages, parsed_data)
+
+    def _excel(self, pdf_path, trace, pages, parsed_data):
+        with trace.activate():
+            try:
+                with stage("save"):
+                    self.pipeline.save_to_excel(parsed_data, self.output_path(pdf_path))
+            except Exception as e:
+                return self._finish(pdf_path, trace, "excel", e)
+        self._validate(pdf_path, parsed_data)
+        self._finish(pdf_path, trace, None, None, pages)
+
+    def _validate(self, pdf_path, parsed_data):
+        '''Keeps the failed checks of a written extract; the extract itself is dropped with this stage.'''
+        from validation import validate_batch  # numpy is only needed once the run has extracts
+
+        try:
+            checks = validate_batch({pdf_path: parsed_data}).get(pdf_path, [])
+        except Exception as e:
+            print(f"Error validating {pdf_path}: {e}")
+            return
+        with self._lock:
+            self.validation[pdf_path] = checks
+
+    def _finish(self, pdf_path, trace, failed_stage, error, pages=0):
+        seconds = round(time.time() - trace.started, 3)
+        record_document("failed" if error else "done")
+        try:
+            trace.write(self.trace_path(pdf_path))
+        except OSError as e:
+            print(f"Error writing trace for {pdf_path}: {e}")
+        if error is None:
+            self.journal.record(file=pdf_path, status="done", pages=pages, seconds=seconds,
+                                output=self.output_path(pdf_path), trace=self.trace_path(pdf_path))
+            print(f"[done] {pdf_path} ({pages} pages, {seconds}s)")
+        else:
+            self.journal.record(file=pdf_path, status="failed", stage=failed_stage, error=str(error),
+                                error_kind=getattr(error, "kind", type(error).__name__), seconds=seconds)
+            print(f"[failed:{failed_stage}] {pdf_path}: {error}")
+        with self._lock:
+            if error is None:
+                self.succeeded += 1
+                self.pages += pages
+            else:
+                self.failed += 1
+            self._pending -= 1
+            if self._pending == 0:
+                self._all_done.set()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Extract financial metrics from a directory of PDFs.")
+    parser.add_argument("source", help="directory of PDFs, or a manifest file with one PDF path per line")
+    parser.add_argument("--output-dir", default="data/batch_output")
+    parser.add_argument("--backend", choices=sorted(EXTRACTORS), default="azure")
+    parser.add_argument("--journal", help="progress journal (default: <output-dir>/journal.jsonl)")
+    parser.add_argument("--layout-workers", type=int, default=4)
+    parser.add_argument("--llm-workers", type=int, default=4)
+    parser.add_argument("--excel-workers", type=int, default=2)
+    parser.add_argument("--queue-size", type=int, help="documents waiting per stage (default: its worker count)")
+    args = parser.parse_args(argv)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    journal = Journal(args.journal or os.path.join(args.output_dir, "journal.jsonl"))
+
+    pdf_paths = collect_inputs(args.source)
+    completed = journal.completed()
+    remaining = [path for path in pdf_paths if path not in completed]
+    print(f"{len(pdf_paths)} files, {len(pdf_paths) - len(remaining)} already done, {len(remaining)} to process")
+
+    runner = BatchRunner(load_pipeline(args.backend), args.output_dir, journal,
+                         args.layout_workers, args.llm_workers, args.excel_workers, queue_size=args.queue_size)
+    start = time.perf_counter()
+    runner.run(remaining)
+    minutes = max(time.perf_counter() - start, 1e-9) / 60
+
+    print(f"Processed {runner.succeeded} files ({runner.failed} failed) in {minutes * 60:.1f}s: "
+          f"{runner.succeeded / minutes:.2f} files/min, {runner.pages / minutes:.1f} pages/min")
+    for line in stats_lines():
+        print(line)
+
+    if runner.validation:
+        failures = {path: checks for path, checks in runner.validation.items() if checks}
+        with open(os.path.join(args.output_dir, "validation.json"), "w") as f:
+            json.dump(failures, f, indent=2)
+        print(f"Validation: {len(runner.validation) - len(failures)} of {len(runner.validation)} files pass every "
+              f"check")
+    return 1 if runner.failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,466 @@
+'''
+Offline benchmark suite. Times the pipeline's building blocks (table builder, prompt assembly, label matching,
+output parsing and validation, Excel writing) on synthetic filings of growing size, then runs the batch CLI, the
+Flask app and the async pipeline end to end against the local Azure and OpenAI stand-ins from fakes.py, with
+configurable latency, jitter and error rate.
+No live service is called and every run uses fresh caches, so results are comparable between commits.
+
+Each entry point's cold start (importing the script in a fresh interpreter) is checked against an import-time
+budget (--import-budget, IMPORT_TIME_BUDGET). Results go to a JSON report. Passing --baseline compares against an
+earlier report. The run exits with status 1 when a benchmark got slower than the tolerance allows or an entry point
+is over budget, so regressions show up before release.
+
+Run with: python benchmark_suite.py --report benchmark_report.json [--baseline previous.json]
+'''
+
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+ENTRY_POINTS = ("azuredi-gpt4.py", "docling-gpt4.py", "batch.py", "async_pipeline.py", "openai_batch.py",
+                "financial-statement-app.py")
+
+COLD_START = '''
+import importlib.util, json, sys, time
+start = time.perf_counter()
+spec = importlib.util.spec_from_file_location("entry_point", sys.argv[1])
+module = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(module)
+print(json.dumps({"seconds": time.perf_counter() - start, "modules": len(sys.modules)}))
+'''
+
+SIZES = {
+    "small": {"pages": 10, "filler_tables": 5, "rows": 15},
+    "medium": {"pages": 60, "filler_tables": 30, "rows": 30},
+    "large": {"pages": 200, "filler_tables": 120, "rows": 40},
+}
+
+
+def missing_modules(*names):
+    missing = []
+    for name in names:
+        try:
+            found = importlib.util.find_spec(name) is not None
+        except ModuleNotFoundError:  # a parent package is missing
+            found = False
+        if not found:
+            missing.append(name)
+    return missing
+
+
+def best_of(fn, repeat):
+    best, result = float("inf"), None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+class Report:
+
+    def __init__(self, config):
+        self.config = config
+        self.results = []
+        self.skipped = []
+
+    def add(self, benchmark, size, seconds, **extra):
+        self.results.append(dict(benchmark=benchmark, size=size, seconds=round(seconds, 6), **extra))
+        print(f"{benchmark:<22} {size:<10} {seconds * 1e3:>12.3f} ms  {json.dumps(extra) if extra else ''}")
+
+    def skip(self, benchmark, reason):
+        self.skipped.append({"benchmark": benchmark, "reason": reason})
+        print(f"{benchmark:<22} skipped: {reason}")
+
+    def to_dict(self):
+        return {
+            "created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "config": self.config,
+            "results": self.results,
+            "skipped": self.skipped,
+        }
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=HERE, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_table_builder(report, repeat):
+    from benchmark_tables import make_table
+    from tables import build_table_grid
+
+    for rows in (50, 200, 800):
+        table = make_table(rows, 4)
+        seconds, _ = best_of(lambda: build_table_grid(table).rows(), repeat)
+        report.add("table_builder", f"{rows}_rows", seconds, cells=len(table.cells),
+                   ns_per_cell=round(seconds / len(table.cells) * 1e9, 1))
+
+
+def bench_prompt_assembly(report, filings, repeat):
+    import label_matching
+    from fakes import result_from_fixture
+    from prompt import load_prompt
+    from prompt_budget import compact_table
+    from sections import SECTIONS, section_prompt
+    from table_relevance import group_tables, select_tables
+    from tables import grids_from_result
+    from tokens import count_tokens
+
+    prompt_text = load_prompt(os.path.join(HERE, "data", "prompt.txt"))
+    for size, (_, fixture) in filings.items():
+        result = result_from_fixture(fixture)
+
+        def assemble():
+            grids = select_tables(grids_from_result(result))
+            groups = group_tables(grids)
+            return [section_prompt(prompt_text, section.name) + "\n\n".join(
+                table for statement in section.statements for table in groups.get(statement, []))
+                for section in SECTIONS]
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            seconds, prompts = best_of(assemble, repeat)
+        report.add("prompt_assembly", size, seconds, tables=len(fixture["tables"]),
+                   prompt_chars=sum(len(prompt) for prompt in prompts))
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            groups = group_tables(select_tables(grids_from_result(result)))
+        raw = [table for tables in groups.values() for table in tables]
+        seconds, compact = best_of(lambda: [compact_table(table) for table in raw], repeat)
+        report.add("compact_encoding", size, seconds, raw_tokens=count_tokens("\n\n".join(raw)),
+                   compact_tokens=count_tokens("\n\n".join(compact)))
+        groups = {statement: [compact_table(table) for table in tables] for statement, tables in groups.items()}
+
+        def match():
+            return [label_matching.match_section(name, [table for statement in statements
+                                                        for table in groups.get(statement, [])])
+                    for name, statements in label_matching.MATCH_STATEMENTS.items()]
+
+        seconds, matches = best_of(match, repeat)
+        report.add("label_match", size, seconds,
+                   matched=sum(len(m.values) for m in matches if m), residual=sum(len(m.residual) for m in matches if m))
+
+
+def bench_parsing(report, repeat):
+    from fakes import fake_from_schema, synthesize_reply
+    from metric_rows import parse_metric_rows
+    from normalize import normalize_batch
+    from prompt import TypedFinancialStatementExtract
+    from validation import validate
+
+    text = synthesize_reply({"messages": []})
+    seconds, rows = best_of(lambda: parse_metric_rows(text), repeat)
+    report.add("parse_metric_rows", "document", seconds, rows=len(rows))
+
+    extract = TypedFinancialStatementExtract.model_validate(
+        fake_from_schema(TypedFinancialStatementExtract.model_json_schema()))
+    for documents in (1, 10, 100):
+        extracts = [extract] * documents
+        seconds, _ = best_of(lambda: validate(normalize_batch(extracts)), repeat)
+        report.add("normalize_validate", f"{documents}_docs", seconds)
+
+
+def bench_excel(report, repeat):
+    import openpyxl
+    from fakes import fake_from_schema
+    from normalize import worksheet_rows
+    from prompt import TypedFinancialStatementExtract
+
+    extract = TypedFinancialStatementExtract.model_validate(
+        fake_from_schema(TypedFinancialStatementExtract.model_json_schema()))
+
+    def write():
+        workbook = openpyxl.Workbook()
+        sheet = workbook.active
+        for row in worksheet_rows(extract):
+            sheet.append(row)
+        output = io.BytesIO()
+        workbook.save(output)
+        return output.tell()
+
+    seconds, size = best_of(write, repeat)
+    report.add("excel_write", "document", seconds, bytes=size)
+
+
+'''
+Imports each entry point in a fresh interpreter (its __main__ block is not run) and reports the best time against
+the import-time budget. Backends load on first use, so this is what a CLI run or a cold worker pays up front.
+'''
+def bench_cold_start(report, repeat, budget, workdir):
+    env = dict(os.environ)
+    env.update({
+        "JOB_DIR": os.path.join(workdir, "cold-start-jobs"),
+        "UPLOAD_SCRATCH_DIR": os.path.join(workdir, "cold-start-scratch"),
+        "PYTHONPATH": HERE + os.pathsep + os.environ.get("PYTHONPATH", ""),
+    })
+    over_budget = []
+    for script in ENTRY_POINTS:
+        best, modules, error = float("inf"), 0, None
+        for _ in range(repeat):
+            completed = subprocess.run([sys.executable, "-c", COLD_START, os.path.join(HERE, script)],
+                                       cwd=HERE, env=env, capture_output=True, text=True)
+            if completed.returncode != 0:
+                error = completed.stderr.strip().splitlines()[-1:] or ["failed"]
+                break
+            timing = json.loads(completed.stdout.strip().splitlines()[-1])
+            best, modules = min(best, timing["seconds"]), timing["modules"]
+        if error:
+            report.skip(f"cold_start[{script}]", error[0])
+            continue
+        report.add("cold_start", script, best, modules=modules, budget=budget, over_budget=best > budget)
+        if best > budget:
+            over_budget.append({"entry_point": script, "seconds": round(best, 4), "budget": budget})
+    return over_budget
+
+
+'''
+Writes files synthetic filings of the given size into directory and records their layout fixtures.
+'''
+def write_filings(directory, fixtures, size, files):
+    from fakes import synthetic_filing
+
+    os.makedirs(directory, exist_ok=True)
+    for i in range(files):
+        pdf_bytes, result = synthetic_filing(seed=f"{size}-{i}", **SIZES[size])
+        fixtures.add_filing(pdf_bytes, result)
+        with open(os.path.join(directory, f"{size}-{i}.pdf"), "wb") as f:
+            f.write(pdf_bytes)
+
+
+def stand_in_env(workdir, azure, openai):
+    env = dict(os.environ)
+    env.update({
+        "AZURE_DOCUMENT_ANALYZER_ENDPOINT": azure.url,
+        "AZURE_DOCUMENT_ANALYZER_KEY": "stand-in",
+        "OPENAI_API_KEY": "stand-in",
+        "OPENAI_BASE_URL": openai.url + "/v1",
+        "LAYOUT_CACHE_DIR": os.path.join(workdir, "layout-cache"),
+        "LLM_CACHE_PATH": os.path.join(workdir, "llm-cache"),
+        "RATE_LIMIT_PATH": os.path.join(workdir, "rate_limits.sqlite"),
+        "JOB_DIR": os.path.join(workdir, "jobs"),
+        "UPLOAD_SCRATCH_DIR": os.path.join(workdir, "scratch"),
+        "PYTHONPATH": HERE + os.pathsep + os.environ.get("PYTHONPATH", ""),
+    })
+    return env
+
+
+def bench_end_to_end(report, args, workdir):
+    from fakes import Behavior, Fixtures, StandInServer
+
+    fixtures = Fixtures(args.fixtures or os.path.join(workdir, "fixtures"))
+    azure_behavior = Behavior(args.azure_latency, args.jitter, args.error_rate, seed=1)
+    openai_behavior = Behavior(args.openai_latency, args.jitter, args.error_rate, seed=2)
+    with StandInServer("azure", fixtures, azure_behavior) as azure, \
+            StandInServer("openai", fixtures, openai_behavior) as openai:
+        for size in args.sizes:
+            run_dir = os.path.join(workdir, f"e2e-{size}")
+            inputs = os.path.join(run_dir, "pdfs")
+            write_filings(inputs, fixtures, size, args.files)
+
+            missing = missing_modules("openai", "azure.ai.formrecognizer", "openpyxl", "numpy", "dotenv")
+            if missing:
+                report.skip(f"cli_batch[{size}]", f"missing modules: {', '.join(missing)}")
+            else:
+                env = stand_in_env(os.path.join(run_dir, "cli"), azure, openai)
+                start = time.perf_counter()
+                completed = subprocess.run(
+                    [sys.executable, os.path.join(HERE, "batch.py"), inputs, "--output-dir",
+                     os.path.join(run_dir, "cli", "out"), "--backend", "azure"],
+                    cwd=HERE, env=env, capture_output=True, text=True)
+                seconds = time.perf_counter() - start
+                report.add("cli_batch", size, seconds, files=args.files, exit_code=completed.returncode,
+                           files_per_minute=round(args.files / seconds * 60, 2))
+
+            missing = missing_modules("flask", "openai", "azure.ai.formrecognizer", "openpyxl", "dotenv")
+            if missing:
+                report.skip(f"flask_app[{size}]", f"missing modules: {', '.join(missing)}")
+            else:
+                env = stand_in_env(os.path.join(run_dir, "flask"), azure, openai)
+                completed = subprocess.run([sys.executable, os.path.abspath(__file__), "--flask-client", inputs],
+                                           cwd=HERE, env=env, capture_output=True, text=True)
+                try:
+                    timings = json.loads(completed.stdout.strip().splitlines()[-1])
+                except (IndexError, ValueError):
+                    report.skip(f"flask_app[{size}]", f"client failed: {completed.stderr.strip()[-500:]}")
+                    continue
+                report.add("flask_app", size, sum(timings["seconds"]), files=len(timings["seconds"]),
+                           statuses=timings["statuses"], slowest=round(max(timings["seconds"]), 6))
+
+        report.config["stand_in_requests"] = {"azure": dict(azure.counters), "openai": dict(openai.counters)}
+
+
+'''
+Drives args.async_documents filings through the async pipeline (text parser) at once, over the in-process async
+stand-ins. Records throughput and the peak memory the run allocated. The OpenAI quota (OPENAI_TOKENS_PER_MINUTE)
+still applies, so runs of hundreds of documents measure the rate limiter unless it is raised.
+'''
+def bench_async(report, args, workdir):
+    import asyncio
+    import tracemalloc
+
+    from async_pipeline import AsyncClients, AsyncPipeline
+    from fakes import Behavior, FakeAsyncDocumentClient, FakeAsyncOpenAI, Fixtures
+
+    fixtures = Fixtures(args.fixtures or os.path.join(workdir, "fixtures"))
+    inputs = os.path.join(workdir, "async", "pdfs")
+    write_filings(inputs, fixtures, "small", args.async_documents)
+    pdf_paths = sorted(os.path.join(inputs, name) for name in os.listdir(inputs))
+    clients = AsyncClients(FakeAsyncOpenAI(fixtures, Behavior(args.openai_latency, args.jitter, seed=2)),
+                           FakeAsyncDocumentClient(fixtures, Behavior(args.azure_latency, args.jitter, seed=1)))
+
+    async def run():
+        async with AsyncPipeline("azure", parser="text", writer="text", clients=clients) as pipeline:
+            return await pipeline.process_many(pdf_paths, lambda pdf_path: pdf_path[:-len(".pdf")] + ".xlsx")
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        results = asyncio.run(run())
+    seconds = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    report.add("async_pipeline", f"{len(pdf_paths)}_documents", seconds,
+               failed=sum(1 for result in results if result.error is not None),
+               files_per_minute=round(len(pdf_paths) / seconds * 60, 2), peak_mb=round(peak / 1e6, 1))
+
+
+'''
+Runs in a subprocess with the stand-in environment: loads the Flask app and posts every PDF of directory to
+/process_financial_statement through the test client. Prints the timings as one JSON line.
+'''
+def flask_client(directory):
+    spec = importlib.util.spec_from_file_location("financial_statement_app",
+                                                  os.path.join(HERE, "financial-statement-app.py"))
+    module = importlib.util.module_from_spec(spec)
+    with contextlib.redirect_stdout(io.StringIO()):
+        spec.loader.exec_module(module)
+        client = module.app.test_client()
+        seconds, statuses = [], []
+        for name in sorted(os.listdir(directory)):
+            with open(os.path.join(directory, name), "rb") as f:
+                body = f.read()
+            start = time.perf_counter()
+            response = client.post("/process_financial_statement", data=body, content_type="application/pdf")
+            seconds.append(round(time.perf_counter() - start, 6))
+            statuses.append(response.status_code)
+        module.job_runner.shutdown()
+    print(json.dumps({"seconds": seconds, "statuses": statuses}))
+
+
+'''
+Returns the benchmarks that got slower than baseline by more than tolerance (a fraction).
+'''
+def compare(report, baseline, tolerance):
+    previous = {(result["benchmark"], result["size"]): result["seconds"] for result in baseline.get("results", [])}
+    regressions = []
+    for result in report["results"]:
+        before = previous.get((result["benchmark"], result["size"]))
+        if before and result["seconds"] > before * (1 + tolerance):
+            regressions.append({"benchmark": result["benchmark"], "size": result["size"], "before": before,
+                                "after": result["seconds"], "ratio": round(result["seconds"] / before, 3)})
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmarks against local Azure and OpenAI stand-ins.")
+    parser.add_argument("--report", default="benchmark_report.json")
+    parser.add_argument("--baseline", help="earlier report to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown against the baseline")
+    parser.add_argument("--sizes", nargs="+", choices=sorted(SIZES), default=["small", "medium", "large"])
+    parser.add_argument("--files", type=int, default=3, help="filings per size in the end-to-end runs")
+    parser.add_argument("--async-documents", type=int, default=50, help="filings in flight in the async run")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--azure-latency", type=float, default=0.5)
+    parser.add_argument("--openai-latency", type=float, default=0.3)
+    parser.add_argument("--jitter", type=float, default=0.1)
+    parser.add_argument("--error-rate", type=float, default=0.02)
+    parser.add_argument("--fixtures", help="fixture directory to replay and record (default: a temporary one)")
+    parser.add_argument("--import-budget", type=float, help="cold start budget in seconds per entry point "
+                                                                 "(default: IMPORT_TIME_BUDGET, 1.0)")
+    parser.add_argument("--skip-e2e", action="store_true")
+    parser.add_argument("--flask-client", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.flask_client:
+        return flask_client(args.flask_client)
+
+    if args.import_budget is None:
+        args.import_budget = float(os.getenv("IMPORT_TIME_BUDGET", 1.0))
+    config = {key: value for key, value in vars(args).items() if key not in ("flask_client",)}
+    report = Report(config)
+    over_budget = []
+    with tempfile.TemporaryDirectory(prefix="benchmark-") as workdir:
+        # module-level settings are read at import, so point the caches somewhere fresh before importing anything
+        os.environ["LAYOUT_CACHE_DIR"] = os.path.join(workdir, "layout-cache")
+        os.environ["LLM_CACHE_PATH"] = os.path.join(workdir, "llm-cache")
+        os.environ["RATE_LIMIT_PATH"] = os.path.join(workdir, "rate_limits.sqlite")
+
+        over_budget = bench_cold_start(report, args.repeat, args.import_budget, workdir)
+
+        micro = [
+            ("table_builder", (), lambda: bench_table_builder(report, args.repeat)),
+            ("prompt_assembly", ("pydantic",), lambda: bench_prompt_assembly(report, filings, args.repeat)),
+            ("parsing", ("pydantic", "numpy"), lambda: bench_parsing(report, args.repeat)),
+            ("excel_write", ("pydantic", "numpy", "openpyxl"), lambda: bench_excel(report, args.repeat)),
+        ]
+        filings = {}
+        if not missing_modules("pydantic"):
+            from fakes import synthetic_filing
+            filings = {size: synthetic_filing(seed=size, **SIZES[size]) for size in args.sizes}
+        for name, requires, run in micro:
+            missing = missing_modules(*requires)
+            if missing:
+                report.skip(name, f"missing modules: {', '.join(missing)}")
+            else:
+                run()
+
+        if args.skip_e2e:
+            report.skip("end_to_end", "--skip-e2e")
+        elif missing_modules("pydantic"):
+            report.skip("end_to_end", "missing modules: pydantic")
+        else:
+            bench_end_to_end(report, args, workdir)
+
+        missing = missing_modules("pydantic", "openpyxl")
+        if args.skip_e2e:
+            report.skip("async_pipeline", "--skip-e2e")
+        elif missing:
+            report.skip("async_pipeline", f"missing modules: {', '.join(missing)}")
+        else:
+            bench_async(report, args, workdir)
+
+    result = report.to_dict()
+    result["over_budget"] = over_budget
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            result["regressions"] = compare(result, json.load(f), args.tolerance)
+    with open(args.report, "w") as f:
+        json.dump(result, f, indent=2)
+    print(f"Report written to {args.report}")
+
+    for regression in result.get("regressions", []):
+        print(f"REGRESSION {regression['benchmark']} [{regression['size']}]: "
+              f"{regression['before'] * 1e3:.3f} ms -> {regression['after'] * 1e3:.3f} ms")
+    for entry in over_budget:
+        print(f"OVER BUDGET {entry['entry_point']}: cold start {entry['seconds']:.3f} s > {entry['budget']:.3f} s")
+    return 1 if result.get("regressions") or over_budget else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,77 @@
+'''
+Micro-benchmark for the table grid builder. It synthesizes Azure-shaped tables of growing size and times the
+single-pass TableGrid builder against the old per-row rescan of table.cells. The builder's time per cell should
+stay flat as the tables grow, while the old loop's grows with the row count.
+
+Run with: python benchmark_tables.py
+'''
+
+import time
+from types import SimpleNamespace
+
+from tables import build_table_grid
+
+
+'''
+Builds a fake DocumentTable with a two-row header (a "Years ended" cell spanning the value columns
+over one label per year) followed by line items.
+'''
+def make_table(row_count, column_count):
+    cells = [
+        SimpleNamespace(row_index=0, column_index=0, row_span=2, column_span=1, kind="stubHead", content=""),
+        SimpleNamespace(row_index=0, column_index=1, row_span=1, column_span=column_count - 1,
+                        kind="columnHeader", content="Years ended"),
+    ]
+    for c in range(1, column_count):
+        cells.append(SimpleNamespace(row_index=1, column_index=c, row_span=1, column_span=1,
+                                     kind="columnHeader", content=str(2024 - c)))
+    for r in range(2, row_count):
+        cells.append(SimpleNamespace(row_index=r, column_index=0, row_span=1, column_span=1,
+                                     kind="rowHeader", content=f"Line item {r}"))
+        for c in range(1, column_count):
+            cells.append(SimpleNamespace(row_index=r, column_index=c, row_span=1, column_span=1,
+                                         kind="content", content=f"{r * c:,}"))
+    return SimpleNamespace(row_count=row_count, column_count=column_count, cells=cells)
+
+
+'''
+The loop every script used before the grid builder: one scan over all cells per row.
+'''
+def rescan_rows(table):
+    rows = []
+    for row_idx in range(table.row_count):
+        row = []
+        for cell in table.cells:
+            if cell.row_index == row_idx:
+                row.append(cell.content)
+        rows.append(row)
+    return rows
+
+
+def time_call(fn, table, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(table)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def build_rows(table):
+    return build_table_grid(table).rows()
+
+
+def main():
+    print(f"{'rows':>6} {'cells':>8} {'grid ms':>10} {'grid ns/cell':>13} {'rescan ms':>10} {'rescan ns/cell':>15}")
+    for row_count in (25, 50, 100, 200, 400, 800):
+        table = make_table(row_count, 4)
+        repeat = 20 if row_count <= 200 else 5
+        grid_time = time_call(build_rows, table, repeat)
+        rescan_time = time_call(rescan_rows, table, repeat)
+        cell_count = len(table.cells)
+        print(f"{row_count:>6} {cell_count:>8} {grid_time * 1e3:>10.3f} {grid_time / cell_count * 1e9:>13.1f} "
+              f"{rescan_time * 1e3:>10.3f} {rescan_time / cell_count * 1e9:>15.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,265 @@
+'''
+Model cascade for the parsing stage. Most clean statements are extracted just as well by a small, fast model, so
+answers are first asked of the cheaper models in CASCADE_MODELS and only the low-confidence ones are escalated to
+the next model, up to the parser's own model, whose answers are final.
+
+- The typed "sections" parser cascades section by section. A section's answer is scored for completeness (the
+  share of its KEY_FIELDS reported in some period) and consistency (the accounting checks of validation.py the
+  section takes part in). Sections that are incomplete or fail a check are extracted again by the next model; the
+  others keep the cheap answer. The merged extract then goes through the usual validation round with the
+  parser's model.
+- The "text" parser cascades whole documents, scored for completeness: the share of the key metrics among the
+  prompt's bullets that the answer reports with a value other than "N/A".
+
+An answer is accepted when its completeness reaches MIN_COMPLETENESS and it fails no check; a tier whose calls
+fail escalates everything it was given. Nothing is escalated once the run's deadline (deadlines.py) has passed.
+Every tier counts its answers as accepted or escalated (cascade_answers_total) and observes its latency per
+document (cascade_tier_seconds); cascade_stats() reports the per-tier hit rates and mean latency, and a document's
+trace counts its escalated answers.
+
+OPENAI_CASCADE_MODELS lists the models tried before the parser's model, comma-separated, e.g. gpt-4o-mini. It is
+empty by default, which leaves the cascade off and every answer to the parser's model; with MIN_COMPLETENESS at
+1.0, a document whose answer reports "N/A" for a key metric pays for a call to every tier. Parsers also take the
+list as cascade=(...).
+'''
+
+import os
+import threading
+import time
+
+import deadlines
+from instrumentation import REGISTRY, current_trace
+from resilience import BackendError
+from table_relevance import normalize_label
+
+CASCADE_MODELS = tuple(model.strip() for model in os.getenv("OPENAI_CASCADE_MODELS", "").split(",")
+                       if model.strip())
+MIN_COMPLETENESS = float(os.getenv("CASCADE_MIN_COMPLETENESS", 1.0))
+
+# line items every filing reports for the section; the generic slots ("Revenue Item 1") and statements many
+# filings leave out (adjusted EBITDA, working capital) are not scored for completeness
+KEY_FIELDS = {
+    "income_statement": ("Sales", "Net_Income"),
+    "cash_flow": ("Cash_Flow_From_Operating_Activities", "Cash_Flow_From_Investing_Activities",
+                  "Cash_Flow_From_Financing_Activities", "Cash_And_Cash_Equivalents_End_Of_Period"),
+    "balance_sheet": ("Total_Assets", "Total_Liabilities_And_Shareholders_Equities"),
+}
+KEY_LABELS = tuple(dict.fromkeys(normalize_label(field) for fields in KEY_FIELDS.values() for field in fields))
+
+CASCADE_ANSWERS = REGISTRY.counter("cascade_answers_total",
+                                   "Sections (documents for the text parser) answered per cascade tier, by outcome.",
+                                   ["model", "outcome"])
+CASCADE_SECONDS = REGISTRY.histogram("cascade_tier_seconds", "Time spent per document in each cascade tier.",
+                                     ["model"])
+
+_models = {}
+_models_lock = threading.Lock()
+
+
+'''
+The models a parser whose own model is model tries in turn: the cheaper models of cascade (CASCADE_MODELS when
+None), then model.
+'''
+def cascade_models(model, cascade=None):
+    cascade = CASCADE_MODELS if cascade is None else cascade
+    return [tier for tier in dict.fromkeys(cascade) if tier != model] + [model]
+
+
+def record_tier(model, seconds, accepted, escalated):
+    with _models_lock:
+        _models.setdefault(model, None)
+    CASCADE_SECONDS.observe(seconds, model=model)
+    CASCADE_ANSWERS.inc(accepted, model=model, outcome="accepted")
+    CASCADE_ANSWERS.inc(escalated, model=model, outcome="escalated")
+    trace = current_trace()
+    if trace is not None and escalated:
+        trace.add("escalated_answers", escalated)
+
+
+'''
+Per-tier statistics since the process started: {model: {"answers", "accepted", "escalated", "hit_rate",
+"mean_seconds"}}, where hit_rate is the share of the tier's answers it did not escalate.
+'''
+def cascade_stats():
+    with _models_lock:
+        models = list(_models)
+    stats = {}
+    for model in models:
+        accepted = CASCADE_ANSWERS.value(model=model, outcome="accepted")
+        escalated = CASCADE_ANSWERS.value(model=model, outcome="escalated")
+        count, seconds = CASCADE_SECONDS.totals(model=model)
+        stats[model] = {
+            "answers": accepted + escalated,
+            "accepted": accepted,
+            "escalated": escalated,
+            "hit_rate": round(accepted / (accepted + escalated), 4) if accepted + escalated else None,
+            "mean_seconds": round(seconds / count, 4) if count else None,
+        }
+    return stats
+
+
+def stats_lines():
+    '''One summary line per cascade tier, for the end of a run.'''
+    return [f"Cascade {model}: {tier['accepted']} of {tier['answers']} answers accepted "
+            f"({tier['hit_rate']:.0%}), {tier['mean_seconds']:.2f}s per document"
+            for model, tier in cascade_stats().items() if tier["answers"]]
+
+
+def section_completeness(section_name, result):
+    '''Share of the section's KEY_FIELDS the typed result reports in some period; 0 without a result.'''
+    if result is None:
+        return 0.0
+    fields = KEY_FIELDS.get(section_name)
+    if not fields:
+        return 1.0
+    values = getattr(result, section_name)
+    return sum(any(value is not None for value in getattr(values, field)) for field in fields) / len(fields)
+
+
+'''
+The names of the sections in pending whose answers are low-confidence: incomplete, or taking part in an accounting
+check the extract merged from results ({section name: result}) fails.
+'''
+def low_confidence(results, pending):
+    from sections import merge_typed_sections
+    from validation import failing_sections, validate_extract
+
+    failing = failing_sections(validate_extract(merge_typed_sections(list(results.values()))))
+    return {section.name for section in pending
+            if section.name in failing or section_completeness(section.name, results.get(section.name))
+            < MIN_COMPLETENESS}
+
+
+def _keep(results, sections, answers):
+    '''Records a tier's answers; a failed answer keeps the answer of the tier before.'''
+    for section, answer in zip(sections, answers):
+        if answer is not None or section.name not in results:
+            results[section.name] = answer
+
+
+def _escalate(results, pending, model, seconds, final):
+    escalated = set() if final else low_confidence(results, pending)
+    record_tier(model, seconds, len(pending) - len(escalated), len(escalated))
+    return [section for section in pending if section.name in escalated]
+
+
+'''
+Typed extraction through the cascade: every section is extracted by the first model, low-confidence sections by
+the next one, and so on. The merged extract gets validated_extract's re-extraction rounds with model. Returns a
+TypedFinancialStatementExtract.
+'''
+def cascade_extract(openai_client, tables_by_statement, prompt_path, model, system_message, fallback_tables=(),
+                    cascade=None, max_rounds=1):
+    from sections import SECTIONS, extract_section_results, merge_typed_sections
+    from validation import revise_failures
+
+    tiers = cascade_models(model, cascade)
+    results, pending = {}, list(SECTIONS)
+    for tier, tier_model in enumerate(tiers):
+        final = tier == len(tiers) - 1
+        start = time.perf_counter()
+        try:
+            answers = extract_section_results(openai_client, tables_by_statement, prompt_path, tier_model,
+                                              system_message, fallback_tables, typed=True, sections=pending)
+        except BackendError as e:
+            if final:
+                raise
+            print(f"Escalating every section: {tier_model} failed: {e}")
+            answers = [None] * len(pending)
+        _keep(results, pending, answers)
+        pending = _escalate(results, pending, tier_model, time.perf_counter() - start, final)
+        if not pending or deadlines.expired():
+            break
+    extract = merge_typed_sections([results[section.name] for section in SECTIONS])
+    return revise_failures(openai_client, extract, tables_by_statement, prompt_path, model, system_message,
+                           fallback_tables, max_rounds)
+
+
+async def cascade_extract_async(openai_client, tables_by_statement, prompt_path, model, system_message,
+                                fallback_tables=(), cascade=None, max_rounds=1):
+    from sections import SECTIONS, extract_section_results_async, merge_typed_sections
+    from validation import revise_failures_async
+
+    tiers = cascade_models(model, cascade)
+    results, pending = {}, list(SECTIONS)
+    for tier, tier_model in enumerate(tiers):
+        final = tier == len(tiers) - 1
+        start = time.perf_counter()
+        try:
+            answers = await extract_section_results_async(openai_client, tables_by_statement, prompt_path,
+                                                          tier_model, system_message, fallback_tables, typed=True,
+                                                          sections=pending)
+        except BackendError as e:
+            if final:
+                raise
+            print(f"Escalating every section: {tier_model} failed: {e}")
+            answers = [None] * len(pending)
+        _keep(results, pending, answers)
+        pending = _escalate(results, pending, tier_model, time.perf_counter() - start, final)
+        if not pending or deadlines.expired():
+            break
+    extract = merge_typed_sections([results[section.name] for section in SECTIONS])
+    return await revise_failures_async(openai_client, extract, tables_by_statement, prompt_path, model,
+                                       system_message, fallback_tables, max_rounds)
+
+
+'''
+Completeness score of "metric | value" answers to prompt_text: the share of the KEY_LABELS among the prompt's
+bullets that the answer reports with a value. An answer without rows scores 0; a prompt without any of the key
+bullets scores every non-empty answer 1.
+'''
+def text_completeness(prompt_text):
+    from metric_rows import is_missing, parse_metric_rows, prompt_metrics
+
+    bullets = {normalize_label(metric) for metric in prompt_metrics(prompt_text)}
+    keys = [label for label in KEY_LABELS if label in bullets]
+
+    def score(answer):
+        rows = parse_metric_rows(answer or "")
+        if not rows:
+            return 0.0
+        if not keys:
+            return 1.0
+        reported = {normalize_label(row[0]) for row in rows if not is_missing(row)}
+        return sum(label in reported for label in keys) / len(keys)
+
+    return score
+
+
+'''
+Document-level cascade: asks answer(model) of each model in turn and returns the first answer whose score reaches
+MIN_COMPLETENESS, or the last model's answer. Past the run's deadline the answer at hand is returned (None when
+that tier failed).
+'''
+def cascade_answer(answer, models, score):
+    for tier, model in enumerate(models):
+        final = tier == len(models) - 1
+        start = time.perf_counter()
+        try:
+            text = answer(model)
+        except BackendError as e:
+            if final:
+                raise
+            print(f"Escalating: {model} failed: {e}")
+            text = None
+        accepted = final or deadlines.expired() or (text is not None and score(text) >= MIN_COMPLETENESS)
+        record_tier(model, time.perf_counter() - start, int(accepted), int(not accepted))
+        if accepted:
+            return text
+
+
+async def cascade_answer_async(answer, models, score):
+    for tier, model in enumerate(models):
+        final = tier == len(models) - 1
+        start = time.perf_counter()
+        try:
+            text = await answer(model)
+        except BackendError as e:
+            if final:
+                raise
+            print(f"Escalating: {model} failed: {e}")
+            text = None
+        accepted = final or deadlines.expired() or (text is not None and score(text) >= MIN_COMPLETENESS)
+        record_tier(model, time.perf_counter() - start, int(accepted), int(not accepted))
+        if accepted:
+            return text
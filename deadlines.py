@@ -0,0 +1,183 @@
+'''
+Latency budgets for pipeline runs. A run that has to answer within a time limit (a request of the Flask app)
+activates a Deadline; the stages of the run then share what is left of it:
+
+    with budget(90):
+        with stage("extract"):      # may use STAGE_SHARES["extract"] of the remaining budget
+            ...
+        with stage("parse"):        # gets its own share of what extract left over
+            ...
+
+stage() narrows the current deadline for the stages in STAGE_SHARES, so a slow extraction cannot take the parse
+stage's time and a fast one leaves the later stages more. Backend calls (resilience.py) stop retrying and waiting
+for the rate limits once the deadline has passed and pass the remaining time to the SDKs as the request timeout;
+the parsers wait for their calls no longer than the deadline and return a partial result (prompt.
+PartialTypedFinancialStatementExtract, metric_rows.PartialText) naming what they left out.
+
+Deadlines follow the current context, like traces: work handed to a thread pool has to run in a copy of the
+context (contextvars.copy_context().run) to keep the run's deadline.
+'''
+
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# shares of the remaining budget, in the order the stages run
+STAGE_SHARES = {
+    "extract": float(os.getenv("DEADLINE_EXTRACT_SHARE", 0.45)),
+    "parse": float(os.getenv("DEADLINE_PARSE_SHARE", 0.5)),
+    "save": float(os.getenv("DEADLINE_SAVE_SHARE", 0.05)),
+}
+
+
+class Deadline:
+    '''
+    A point in time (time.monotonic) a run has to finish by. missed collects the names of the parts of the run
+    (e.g. statement sections) that were cut off by this deadline or one narrowed from it.
+    '''
+
+    def __init__(self, seconds, missed=None):
+        self.expires = time.monotonic() + max(0.0, seconds)
+        self.missed = missed if missed is not None else set()
+
+    def remaining(self):
+        return max(0.0, self.expires - time.monotonic())
+
+    def expired(self):
+        return time.monotonic() >= self.expires
+
+    def narrowed(self, seconds):
+        '''A deadline seconds from now, but no later than this one, recording its misses here.'''
+        return Deadline(min(seconds, self.remaining()), self.missed)
+
+    def miss(self, name):
+        with _missed_lock:
+            self.missed.add(name)
+
+    @contextmanager
+    def activate(self):
+        '''Makes this the current deadline for the enclosed code.'''
+        token = _current_deadline.set(self)
+        try:
+            yield self
+        finally:
+            _current_deadline.reset(token)
+
+
+# stands in for the result of a call the deadline cut short
+MISSED = object()
+
+_current_deadline = ContextVar("deadline", default=None)
+_missed_lock = threading.Lock()
+
+
+def current_deadline():
+    return _current_deadline.get()
+
+
+def remaining():
+    '''Seconds left before the current deadline, or None without one.'''
+    deadline = current_deadline()
+    return None if deadline is None else deadline.remaining()
+
+
+def expired():
+    deadline = current_deadline()
+    return deadline is not None and deadline.expired()
+
+
+'''
+Runs the enclosed code with a deadline seconds from now (or the current one, if that is earlier). None or 0 runs
+it without a new deadline.
+'''
+@contextmanager
+def budget(seconds):
+    if not seconds:
+        yield current_deadline()
+        return
+    current = current_deadline()
+    deadline = current.narrowed(seconds) if current is not None else Deadline(seconds)
+    with deadline.activate():
+        yield deadline
+
+
+'''
+Narrows the current deadline for the pipeline stage name to its share of the remaining budget: STAGE_SHARES[name]
+out of the shares of name and the stages after it. Other stages, and runs without a deadline, are left alone.
+'''
+@contextmanager
+def stage_deadline(name):
+    current = current_deadline()
+    if current is None or name not in STAGE_SHARES:
+        yield current
+        return
+    stages = list(STAGE_SHARES)
+    later = sum(STAGE_SHARES[stage] for stage in stages[stages.index(name):])
+    share = STAGE_SHARES[name] / later if later > 0 else 1.0
+    with current.narrowed(current.remaining() * share).activate() as deadline:
+        yield deadline
+
+
+def miss(name):
+    '''Records that name was cut off by the current deadline.'''
+    deadline = current_deadline()
+    if deadline is not None:
+        deadline.miss(name)
+
+
+def missed():
+    deadline = current_deadline()
+    if deadline is None:
+        return set()
+    with _missed_lock:
+        return set(deadline.missed)
+
+
+'''
+A ThreadPoolExecutor that waits for its calls on exit, unless the deadline has passed: calls still running then are
+left to time out on their own and queued ones are cancelled.
+'''
+@contextmanager
+def thread_pool(max_workers, thread_name_prefix=""):
+    pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=thread_name_prefix)
+    try:
+        yield pool
+    finally:
+        pool.shutdown(wait=not expired(), cancel_futures=True)
+
+
+def _result(outcome):
+    from resilience import DeadlineExceeded
+
+    try:
+        return outcome.result()
+    except DeadlineExceeded:
+        return MISSED
+
+
+'''
+Waits for the futures no longer than the current deadline and returns their results in order; a future that has
+not finished by then, or failed with DeadlineExceeded, gives MISSED. Other errors are raised.
+'''
+def results_by_deadline(futures):
+    wait(futures, timeout=remaining())
+    return [_result(future) if future.done() else MISSED for future in futures]
+
+
+'''
+Same as results_by_deadline for coroutines, which run as tasks; the ones still running at the deadline are
+cancelled.
+'''
+async def gather_by_deadline(coroutines):
+    tasks = [asyncio.ensure_future(coroutine) for coroutine in coroutines]
+    try:
+        if tasks:
+            await asyncio.wait(tasks, timeout=remaining())
+        return [_result(task) if task.done() else MISSED for task in tasks]
+    finally:
+        for task in tasks:
+            task.cancel()
@@ -0,0 +1,115 @@
+'''
+Long-lived pool of warm Docling converters. Building a DocumentConverter loads the layout and table-structure
+models, which takes seconds and hundreds of MB, so instead of constructing one per request the models are loaded
+once per worker process and reused. Workers are recycled after a number of documents to bound memory growth.
+
+DOCLING_POOL_WORKERS sets the number of worker processes (0 converts in-process with a single warm converter)
+and DOCLING_MAX_DOCUMENTS_PER_WORKER how many documents a worker handles before it is replaced. warm_up() hands
+each worker one task of its own, which counts towards that limit like a document.
+'''
+
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from page_selection import page_runs
+
+DEFAULT_WORKERS = int(os.getenv("DOCLING_POOL_WORKERS", 2))
+DEFAULT_MAX_DOCUMENTS_PER_WORKER = int(os.getenv("DOCLING_MAX_DOCUMENTS_PER_WORKER", 50)) or None
+# how long warm_up waits for every worker to have loaded its models
+WARM_UP_TIMEOUT = float(os.getenv("DOCLING_WARM_UP_TIMEOUT", 600))
+
+_converter = None
+
+
+'''
+Creates the converter of the current process and loads the PDF pipeline's models up front, so the first
+document does not pay for it.
+'''
+def _init_converter():
+    global _converter
+    from docling.document_converter import DocumentConverter
+
+    _converter = DocumentConverter()
+    try:
+        from docling.datamodel.base_models import InputFormat
+        _converter.initialize_pipeline(InputFormat.PDF)
+    except (ImportError, AttributeError):
+        pass  # older Docling releases build the pipeline on first convert
+    return _converter
+
+
+def _convert_to_markdown(pdf_path, pages=None):
+    converter = _converter or _init_converter()
+    if not pages:
+        return converter.convert(pdf_path).document.export_to_markdown()
+    # Docling converts one contiguous page_range at a time
+    return "\n\n".join(converter.convert(pdf_path, page_range=page_range).document.export_to_markdown()
+                       for page_range in page_runs(pages))
+
+
+'''
+The warm-up task: holds its worker until every worker has taken one, so no worker can take a second one and leave
+another cold. Returns the worker's pid.
+'''
+def _wait_for_siblings(barrier):
+    barrier.wait()
+    return os.getpid()
+
+
+class DoclingPool:
+
+    def __init__(self, workers=DEFAULT_WORKERS, max_documents_per_worker=DEFAULT_MAX_DOCUMENTS_PER_WORKER):
+        self.workers = workers
+        self.max_documents_per_worker = max_documents_per_worker
+        self._lock = threading.Lock()
+        self._executor = None
+        if workers > 0:
+            # recycling workers requires the spawn start method, which ProcessPoolExecutor then picks itself
+            self._executor = ProcessPoolExecutor(
+                max_workers=workers,
+                initializer=_init_converter,
+                max_tasks_per_child=max_documents_per_worker,
+            )
+
+    def convert_markdown(self, pdf_path, pages=None):
+        '''Converts a PDF (or only its 1-based pages, if given) and returns it exported to markdown.'''
+        if self._executor is None:
+            with self._lock:  # one in-process converter, used by one thread at a time
+                return _convert_to_markdown(pdf_path, pages)
+        return self._executor.submit(_convert_to_markdown, os.path.abspath(pdf_path), pages).result()
+
+    def warm_up(self, timeout=WARM_UP_TIMEOUT):
+        '''
+        Starts every worker now and waits until each one has loaded its models, instead of on the first document.
+        Each worker runs exactly one warm-up task, which counts towards max_documents_per_worker. Returns the
+        workers' pids.
+        '''
+        if self._executor is None:
+            with self._lock:
+                if _converter is None:
+                    _init_converter()
+            return [os.getpid()]
+        import multiprocessing
+
+        # a manager's barrier can be passed to the tasks; the executor starts a worker for every blocked task
+        with multiprocessing.Manager() as manager:
+            barrier = manager.Barrier(self.workers, timeout=timeout)
+            futures = [self._executor.submit(_wait_for_siblings, barrier) for _ in range(self.workers)]
+            return sorted(future.result() for future in futures)
+
+    def shutdown(self, wait=True):
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+
+
+_default_pool = None
+_default_pool_lock = threading.Lock()
+
+
+def default_pool():
+    global _default_pool
+    with _default_pool_lock:
+        if _default_pool is None:
+            _default_pool = DoclingPool()
+    return _default_pool
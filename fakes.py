@@ -0,0 +1,749 @@
+'''
+Local stand-ins for Azure Document Intelligence and OpenAI, used by the benchmark suite (benchmark_suite.py) to
+measure the pipelines without calling the live services.
+
+- synthetic_filing builds a fake annual report: a minimal PDF with the requested number of pages and the
+  prebuilt-layout analyzeResult Azure would return for it (statement tables plus filler note tables).
+- StandInServer serves the Azure REST analyze/poll protocol or the OpenAI chat-completions API (plain, streamed and
+  structured output) and Batch API (file upload and download, batch create and retrieve) over HTTP, so the
+  unmodified scripts and the Flask app can be pointed at it through AZURE_DOCUMENT_ANALYZER_ENDPOINT and
+  OPENAI_BASE_URL.
+- FakeDocumentClient and FakeOpenAI are the in-process equivalents for code that takes a client object, and
+  FakeAsyncDocumentClient and FakeAsyncOpenAI those of the async clients (async_pipeline.py). Both FakeOpenAI and
+  StandInServer keep Batch API files and batches in a BatchStore (see openai_batch.py).
+
+Replies come from a fixture directory: layout results are looked up by the SHA-256 of the PDF (so real recorded
+analyzeResult JSON can be dropped in), chat replies by a hash of the request. A chat request without a fixture is
+answered from its schema and the reply is recorded, so later runs replay it. Latency, jitter and an error rate
+(429s with Retry-After, and 500s) are configurable and seeded for reproducible runs.
+'''
+
+import asyncio
+import base64
+import email.parser
+import email.policy
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from urllib.parse import urlparse
+
+from prompt import FinancialStatementExtract, TypedFinancialStatementExtract
+
+PERIODS = ("2024", "2023")
+
+STATEMENT_TABLES = {
+    "income_statement": "CONSOLIDATED STATEMENTS OF OPERATIONS",
+    "cash_flow": "CONSOLIDATED STATEMENTS OF CASH FLOWS",
+    "balance_sheet": "CONSOLIDATED BALANCE SHEETS",
+}
+
+
+def _label(field):
+    return field.replace("_", " ").replace("Shortterm", "Short-term").capitalize()
+
+
+def _number(seed, scale=100000):
+    return int(hashlib.sha256(seed.encode()).hexdigest()[:8], 16) % scale + 100
+
+
+'''
+Builds one table in the REST (camelCase) shape of an analyzeResult table: a header row with the periods, then a
+row per label.
+'''
+def _layout_table(labels, page_number, seed, periods=PERIODS):
+    cells = [{"kind": "columnHeader", "rowIndex": 0, "columnIndex": 0, "rowSpan": 1, "columnSpan": 1,
+              "content": "(USD in millions)"}]
+    for c, period in enumerate(periods, start=1):
+        cells.append({"kind": "columnHeader", "rowIndex": 0, "columnIndex": c, "rowSpan": 1, "columnSpan": 1,
+                      "content": period})
+    for r, label in enumerate(labels, start=1):
+        cells.append({"kind": "rowHeader", "rowIndex": r, "columnIndex": 0, "rowSpan": 1, "columnSpan": 1,
+                      "content": label})
+        for c, period in enumerate(periods, start=1):
+            cells.append({"kind": "content", "rowIndex": r, "columnIndex": c, "rowSpan": 1, "columnSpan": 1,
+                          "content": f"{_number(f'{seed}:{label}:{period}'):,}"})
+    return {
+        "rowCount": len(labels) + 1,
+        "columnCount": len(periods) + 1,
+        "cells": cells,
+        "boundingRegions": [{"pageNumber": page_number, "polygon": []}],
+        "spans": [],
+    }
+
+
+'''
+Returns (pdf_bytes, analyze_result) for a synthetic filing with pages pages and filler_tables note tables of
+rows rows each next to the three primary statements.
+'''
+def synthetic_filing(pages=20, filler_tables=10, rows=20, seed="filing"):
+    statement_fields = {name: list(TypedFinancialStatementExtract.model_fields[name].annotation.model_fields)
+                        for name in STATEMENT_TABLES}
+    tables = []
+    for i, (section, fields) in enumerate(statement_fields.items()):
+        tables.append(_layout_table([_label(field) for field in fields], min(pages, i + 1), f"{seed}:{section}"))
+    for i in range(filler_tables):
+        labels = [f"Note {i + 1} item {r + 1}" for r in range(rows)]
+        tables.append(_layout_table(labels, min(pages, 4 + i % max(1, pages - 3)), f"{seed}:note{i}"))
+
+    result = {
+        "apiVersion": "2023-07-31",
+        "modelId": "prebuilt-layout",
+        "stringIndexType": "textElements",
+        "content": "\n".join(STATEMENT_TABLES.values()),
+        "pages": [{"pageNumber": n, "angle": 0, "width": 8.5, "height": 11, "unit": "inch",
+                   "spans": [{"offset": 0, "length": 0}], "words": [], "lines": []}
+                  for n in range(1, pages + 1)],
+        "tables": tables,
+    }
+    return synthetic_pdf(pages, seed), result
+
+
+'''
+A minimal valid PDF with the given number of empty pages. seed ends up in a comment so every filing hashes
+differently.
+'''
+def synthetic_pdf(pages, seed="filing"):
+    objects = ["<< /Type /Catalog /Pages 2 0 R >>",
+               "<< /Type /Pages /Kids [" + " ".join(f"{3 + i} 0 R" for i in range(pages)) + f"] /Count {pages} >>"]
+    objects += ["<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] >>"] * pages
+    out = f"%PDF-1.4\n% synthetic filing {seed}\n".encode()
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += f"{number} 0 obj\n{body}\nendobj\n".encode()
+    xref = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    out += "".join(f"{offset:010d} 00000 n \n" for offset in offsets).encode()
+    out += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode()
+    return out
+
+
+def _snake(name):
+    return re.sub(r"(?<!^)(?=[A-Z])", "_", name).lower()
+
+
+'''
+Converts a REST analyzeResult into the attribute shape the SDK returns (result.tables[i].cells[j].row_index).
+'''
+def result_from_fixture(value):
+    if isinstance(value, dict):
+        return SimpleNamespace(**{_snake(key): result_from_fixture(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return [result_from_fixture(item) for item in value]
+    return value
+
+
+class Fixtures:
+    '''Layout results (<sha256 of the PDF>.json) and chat replies (chat-<request hash>.json) in one directory.'''
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _read(self, name):
+        try:
+            with open(os.path.join(self.directory, name), "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def _write(self, name, value):
+        path = os.path.join(self.directory, name)
+        temp_path = f"{path}.{uuid.uuid4().hex}.tmp"  # concurrent requests may record the same reply
+        with open(temp_path, "w") as f:
+            json.dump(value, f)
+        os.replace(temp_path, path)
+
+    def add_filing(self, pdf_bytes, analyze_result):
+        self._write(hashlib.sha256(pdf_bytes).hexdigest() + ".json", analyze_result)
+
+    def layout(self, pdf_bytes):
+        return self._read(hashlib.sha256(pdf_bytes).hexdigest() + ".json")
+
+    def chat(self, request):
+        '''Returns the recorded reply content for a chat request, generating and recording it on first use.'''
+        material = json.dumps({key: request.get(key) for key in ("model", "messages", "response_format")},
+                              sort_keys=True)
+        name = "chat-" + hashlib.sha256(material.encode()).hexdigest() + ".json"
+        reply = self._read(name)
+        if reply is None:
+            reply = {"content": synthesize_reply(request)}
+            self._write(name, reply)
+        return reply["content"]
+
+
+'''
+Builds a plausible value for a JSON schema: lists of numbers for the typed models, "a | b" strings for the flat
+string schema.
+'''
+def fake_from_schema(schema, definitions=None, name="", periods=PERIODS):
+    definitions = definitions if definitions is not None else schema.get("$defs", {})
+    if "$ref" in schema:
+        return fake_from_schema(definitions[schema["$ref"].split("/")[-1]], definitions, name, periods)
+    if "anyOf" in schema:
+        options = [option for option in schema["anyOf"] if option.get("type") != "null"]
+        return fake_from_schema(options[0], definitions, name, periods) if options else None
+    if "enum" in schema:
+        return "millions" if "millions" in schema["enum"] else schema["enum"][0]
+    kind = schema.get("type")
+    if kind == "object":
+        return {key: fake_from_schema(value, definitions, key, periods)
+                for key, value in schema.get("properties", {}).items()}
+    if kind == "array":
+        if name == "periods":
+            return list(periods)
+        return [fake_from_schema(schema.get("items", {}), definitions, f"{name}:{period}", periods)
+                for period in periods]
+    if kind in ("number", "integer"):
+        return float(_number(name))
+    if name == "currency":
+        return "USD"
+    return " | ".join(f"${_number(f'{name}:{period}'):,}" for period in periods)
+
+
+def synthesize_reply(request):
+    response_format = request.get("response_format") or {}
+    if response_format.get("type") == "json_schema":
+        return json.dumps(fake_from_schema(response_format["json_schema"]["schema"]))
+    lines = []
+    for field in FinancialStatementExtract.model_fields:
+        values = " | ".join(f"${_number(f'{field}:{period}'):,}" for period in PERIODS)
+        lines.append(f"{_label(field)} | {values}")
+    return "\n".join(lines)
+
+
+def _usage(request, content):
+    prompt_tokens = sum(len(message.get("content") or "") for message in request.get("messages", [])) // 4
+    completion_tokens = len(content) // 4
+    return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens}
+
+
+def _completion(request, content):
+    '''A chat.completion response body in the REST shape.'''
+    message = {"role": "assistant", "content": content, "refusal": None}
+    return {"id": "chatcmpl-" + uuid.uuid4().hex, "object": "chat.completion", "created": int(time.time()),
+            "model": request.get("model", ""), "system_fingerprint": "stand-in", "usage": _usage(request, content),
+            "choices": [{"index": 0, "message": message, "finish_reason": "stop", "logprobs": None}]}
+
+
+class Behavior:
+    '''Latency (seconds), uniform jitter around it and the share of requests answered with an error.'''
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def delay(self):
+        with self._lock:
+            return max(0.0, self.latency + self._random.uniform(-self.jitter, self.jitter))
+
+    def error(self):
+        '''Returns None, or the (status, retry_after_seconds) of an error to answer with.'''
+        with self._lock:
+            if self._random.random() >= self.error_rate:
+                return None
+            return (429, 0.1) if self._random.random() < 0.7 else (500, None)
+
+
+class StandInError(Exception):
+    '''Raised by the in-process fakes; shaped like the SDK errors resilience.py classifies.'''
+
+    def __init__(self, status, retry_after=None):
+        super().__init__(f"stand-in error {status}")
+        self.status_code = status
+        headers = {"retry-after": str(retry_after)} if retry_after is not None else {}
+        self.response = SimpleNamespace(status_code=status, headers=headers)
+
+
+class FakePoller:
+
+    def __init__(self, result, ready_at):
+        self._result = result
+        self._ready_at = ready_at
+
+    def done(self):
+        return time.monotonic() >= self._ready_at
+
+    def result(self, timeout=None):
+        wait = max(0.0, self._ready_at - time.monotonic())
+        time.sleep(wait if timeout is None else min(wait, timeout))
+        return self._result if self.done() else None
+
+
+class FakeDocumentClient:
+    '''In-process stand-in for DocumentAnalysisClient.begin_analyze_document.'''
+
+    def __init__(self, fixtures, behavior=None):
+        self.fixtures = fixtures
+        self.behavior = behavior or Behavior()
+
+    def begin_analyze_document(self, model_id, document, **kwargs):
+        error = self.behavior.error()
+        if error:
+            raise StandInError(*error)
+        # like the SDK, takes the bytes or a file to read them from
+        fixture = self.fixtures.layout(bytes(document) if isinstance(document, (bytes, bytearray)) else document.read())
+        if fixture is None:
+            raise StandInError(400)
+        return FakePoller(result_from_fixture(fixture), time.monotonic() + self.behavior.delay())
+
+
+class _FakeCompletions:
+
+    def __init__(self, fixtures, behavior):
+        self.fixtures = fixtures
+        self.behavior = behavior
+
+    def _reply(self, request, timeout=None):
+        error = self.behavior.error()
+        if error:
+            raise StandInError(*error)
+        delay = self.behavior.delay()
+        if timeout is not None and delay > timeout:
+            time.sleep(timeout)
+            raise TimeoutError("stand-in request timed out")
+        time.sleep(delay)
+        return self.fixtures.chat(request)
+
+    @staticmethod
+    def _parse_request(model, messages, response_format):
+        schema = response_format.model_json_schema()
+        return {"model": model, "messages": messages,
+                "response_format": {"type": "json_schema", "json_schema": {"schema": schema}}}
+
+    @staticmethod
+    def _parsed(request, content, response_format):
+        message = SimpleNamespace(content=content, parsed=response_format.model_validate_json(content), refusal=None)
+        return SimpleNamespace(choices=[SimpleNamespace(message=message, finish_reason="stop")],
+                               usage=SimpleNamespace(**_usage(request, content)))
+
+    @staticmethod
+    def _created(request, content, stream):
+        usage = SimpleNamespace(**_usage(request, content))
+        if not stream:
+            message = SimpleNamespace(content=content, refusal=None)
+            return SimpleNamespace(choices=[SimpleNamespace(message=message, finish_reason="stop")], usage=usage)
+        chunks = [SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=line + "\n"))], usage=None)
+                  for line in content.split("\n")]
+        return iter(chunks + [SimpleNamespace(choices=[], usage=usage)])
+
+    def parse(self, model, messages, response_format, timeout=None, **kwargs):
+        request = self._parse_request(model, messages, response_format)
+        return self._parsed(request, self._reply(request, timeout), response_format)
+
+    def create(self, model, messages, stream=False, timeout=None, **kwargs):
+        request = {"model": model, "messages": messages}
+        return self._created(request, self._reply(request, timeout), stream)
+
+
+class BatchStore:
+    '''
+    Files and batches of the stand-in Batch API, in the REST shapes. A batch is answered as a whole once the
+    behavior's latency has passed: every request line gets a chat completion from the fixtures, except for the share
+    the behavior's error rate turns into error lines (in the batch's error file).
+    '''
+
+    def __init__(self, fixtures, behavior=None):
+        self.fixtures = fixtures
+        self.behavior = behavior or Behavior()
+        self._files = {}
+        self._contents = {}
+        self._batches = {}
+        self._ready_at = {}
+        self._lock = threading.Lock()
+
+    def add_file(self, content, filename, purpose):
+        file_id = "file-" + uuid.uuid4().hex
+        entry = {"id": file_id, "object": "file", "bytes": len(content), "created_at": int(time.time()),
+                 "filename": filename, "purpose": purpose, "status": "processed"}
+        with self._lock:
+            self._files[file_id] = entry
+            self._contents[file_id] = bytes(content)
+        return dict(entry)
+
+    def content(self, file_id):
+        with self._lock:
+            return self._contents.get(file_id)
+
+    def create_batch(self, input_file_id, endpoint, completion_window, metadata=None):
+        if self.content(input_file_id) is None:
+            return None
+        batch_id = "batch_" + uuid.uuid4().hex
+        entry = {"id": batch_id, "object": "batch", "endpoint": endpoint, "errors": None,
+                 "input_file_id": input_file_id, "completion_window": completion_window, "status": "validating",
+                 "output_file_id": None, "error_file_id": None, "created_at": int(time.time()),
+                 "in_progress_at": None, "completed_at": None, "metadata": metadata,
+                 "request_counts": {"total": 0, "completed": 0, "failed": 0}}
+        with self._lock:
+            self._batches[batch_id] = entry
+            self._ready_at[batch_id] = time.monotonic() + self.behavior.delay()
+        return dict(entry)
+
+    def batch(self, batch_id):
+        '''The batch, answered first if it is due.'''
+        with self._lock:
+            entry = self._batches.get(batch_id)
+            if entry is None:
+                return None
+            due = entry["status"] == "validating" and time.monotonic() >= self._ready_at[batch_id]
+            if due:
+                entry["status"] = "in_progress"
+                entry["in_progress_at"] = int(time.time())
+        if due:
+            self._answer(entry)
+        return json.loads(json.dumps(entry))
+
+    def _answer(self, entry):
+        outputs, errors = [], []
+        for line in self.content(entry["input_file_id"]).decode().splitlines():
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            reply = {"id": "batch_req_" + uuid.uuid4().hex, "custom_id": request["custom_id"], "error": None}
+            error = self.behavior.error()
+            if error:
+                reply["response"] = {"status_code": error[0], "request_id": uuid.uuid4().hex,
+                                     "body": {"error": {"code": str(error[0]), "message": "stand-in error"}}}
+                errors.append(reply)
+            else:
+                body = _completion(request["body"], self.fixtures.chat(request["body"]))
+                reply["response"] = {"status_code": 200, "request_id": uuid.uuid4().hex, "body": body}
+                outputs.append(reply)
+
+        def jsonl(lines):
+            return "".join(json.dumps(line) + "\n" for line in lines).encode()
+
+        output_file = outputs and self.add_file(jsonl(outputs), f"{entry['id']}_output.jsonl", "batch_output")
+        error_file = errors and self.add_file(jsonl(errors), f"{entry['id']}_error.jsonl", "batch_output")
+        with self._lock:
+            entry.update(status="completed", completed_at=int(time.time()),
+                         output_file_id=output_file["id"] if output_file else None,
+                         error_file_id=error_file["id"] if error_file else None,
+                         request_counts={"total": len(outputs) + len(errors), "completed": len(outputs),
+                                         "failed": len(errors)})
+
+
+def _namespace(value):
+    if isinstance(value, dict):
+        return SimpleNamespace(**{key: _namespace(item) for key, item in value.items()})
+    return value
+
+
+def _file_content(file):
+    '''(filename, bytes) of an upload in any form the SDK accepts: bytes, a file object or a (name, content) tuple.'''
+    if isinstance(file, tuple):
+        name, content = file[0], file[1]
+    else:
+        name, content = os.path.basename(getattr(file, "name", "upload.jsonl")), file
+    if hasattr(content, "read"):
+        content = content.read()
+    return name, content
+
+
+class _FakeFiles:
+
+    def __init__(self, store):
+        self.store = store
+
+    def create(self, file, purpose, **kwargs):
+        filename, content = _file_content(file)
+        return _namespace(self.store.add_file(content, filename, purpose))
+
+    def content(self, file_id, **kwargs):
+        content = self.store.content(file_id)
+        if content is None:
+            raise StandInError(404)
+        return SimpleNamespace(content=content, text=content.decode(), read=lambda: content)
+
+
+class _FakeBatches:
+
+    def __init__(self, store):
+        self.store = store
+
+    def create(self, input_file_id, endpoint, completion_window, metadata=None, **kwargs):
+        batch = self.store.create_batch(input_file_id, endpoint, completion_window, metadata)
+        if batch is None:
+            raise StandInError(400)
+        return _namespace(batch)
+
+    def retrieve(self, batch_id, **kwargs):
+        batch = self.store.batch(batch_id)
+        if batch is None:
+            raise StandInError(404)
+        return _namespace(batch)
+
+
+class FakeOpenAI:
+    '''In-process stand-in for the parts of the OpenAI client the pipelines use.'''
+
+    def __init__(self, fixtures, behavior=None, batch_behavior=None):
+        behavior = behavior or Behavior()
+        completions = _FakeCompletions(fixtures, behavior)
+        self.chat = SimpleNamespace(completions=completions)
+        self.beta = SimpleNamespace(chat=SimpleNamespace(completions=completions))
+        store = BatchStore(fixtures, batch_behavior)
+        self.files = _FakeFiles(store)
+        self.batches = _FakeBatches(store)
+
+
+class FakeAsyncPoller:
+
+    def __init__(self, result, ready_at):
+        self._result = result
+        self._ready_at = ready_at
+
+    async def result(self):
+        await asyncio.sleep(max(0.0, self._ready_at - time.monotonic()))
+        return self._result
+
+
+class FakeAsyncDocumentClient(FakeDocumentClient):
+    '''In-process stand-in for the async DocumentAnalysisClient (azure.ai.formrecognizer.aio).'''
+
+    async def begin_analyze_document(self, model_id, document, **kwargs):
+        poller = super().begin_analyze_document(model_id, document, **kwargs)
+        return FakeAsyncPoller(poller._result, poller._ready_at)
+
+    async def close(self):
+        pass
+
+
+class _FakeAsyncCompletions(_FakeCompletions):
+
+    async def _reply_async(self, request, timeout=None):
+        error = self.behavior.error()
+        if error:
+            raise StandInError(*error)
+        delay = self.behavior.delay()
+        if timeout is not None and delay > timeout:
+            await asyncio.sleep(timeout)
+            raise TimeoutError("stand-in request timed out")
+        await asyncio.sleep(delay)
+        return self.fixtures.chat(request)
+
+    async def parse(self, model, messages, response_format, timeout=None, **kwargs):
+        request = self._parse_request(model, messages, response_format)
+        return self._parsed(request, await self._reply_async(request, timeout), response_format)
+
+    async def create(self, model, messages, stream=False, timeout=None, **kwargs):
+        request = {"model": model, "messages": messages}
+        return self._created(request, await self._reply_async(request, timeout), stream)
+
+
+class FakeAsyncOpenAI:
+    '''In-process stand-in for the parts of the AsyncOpenAI client the async pipeline uses.'''
+
+    def __init__(self, fixtures, behavior=None):
+        completions = _FakeAsyncCompletions(fixtures, behavior or Behavior())
+        self.chat = SimpleNamespace(completions=completions)
+        self.beta = SimpleNamespace(chat=SimpleNamespace(completions=completions))
+
+    async def close(self):
+        pass
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_error(self, status, retry_after):
+        headers = {}
+        if retry_after is not None:
+            headers = {"Retry-After": str(max(0, round(retry_after))), "retry-after-ms": str(int(retry_after * 1000))}
+        self._send_json(status, {"error": {"code": str(status), "message": "stand-in error"}}, headers)
+
+    def _body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+    def do_POST(self):
+        server = self.server
+        body = self._body()
+        server.count("requests")
+        error = server.behavior.error()
+        if error:
+            server.count(f"errors_{error[0]}")
+            return self._send_error(*error)
+        path = urlparse(self.path).path
+        if server.kind == "azure" and path.endswith(":analyze"):
+            return self._analyze(body)
+        if server.kind == "openai" and path.endswith("/chat/completions"):
+            return self._chat(json.loads(body))
+        if server.kind == "openai" and path.endswith("/files"):
+            return self._upload(body)
+        if server.kind == "openai" and path.endswith("/batches"):
+            return self._create_batch(json.loads(body))
+        self._send_json(404, {"error": {"code": "NotFound", "message": path}})
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if self.server.kind == "azure" and "/analyzeResults/" in path:
+            return self._poll(path.rsplit("/", 1)[-1])
+        if self.server.kind == "openai" and "/batches/" in path:
+            return self._batch(path.rsplit("/", 1)[-1])
+        if self.server.kind == "openai" and path.endswith("/content"):
+            return self._file_content(path.rsplit("/", 2)[-2])
+        self._send_json(404, {"error": {"code": "NotFound", "message": path}})
+
+    def _analyze(self, body):
+        if self.headers.get("Content-Type", "").startswith("application/json"):
+            body = base64.b64decode(json.loads(body).get("base64Source", ""))
+        fixture = self.server.fixtures.layout(body)
+        if fixture is None:
+            return self._send_json(400, {"error": {"code": "InvalidRequest", "message": "no fixture for document"}})
+        operation = uuid.uuid4().hex
+        self.server.operations[operation] = (time.monotonic() + self.server.behavior.delay(), fixture)
+        model = urlparse(self.path).path.rsplit("/", 1)[-1].split(":")[0]
+        location = f"{self.server.url}/formrecognizer/documentModels/{model}/analyzeResults/{operation}" \
+                   f"?{urlparse(self.path).query}"
+        self.send_response(202)
+        self.send_header("Operation-Location", location)
+        self.send_header("Retry-After", "0")
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def _poll(self, operation):
+        entry = self.server.operations.get(operation)
+        if entry is None:
+            return self._send_json(404, {"error": {"code": "NotFound", "message": operation}})
+        ready_at, fixture = entry
+        now = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+        if time.monotonic() < ready_at:
+            # the SDK sleeps for Retry-After between polls; whole seconds only, so short waits poll at once
+            retry = "1" if ready_at - time.monotonic() > 1 else "0"
+            return self._send_json(200, {"status": "running", "createdDateTime": now, "lastUpdatedDateTime": now},
+                                   {"Retry-After": retry})
+        self.server.operations.pop(operation, None)
+        self._send_json(200, {"status": "succeeded", "createdDateTime": now, "lastUpdatedDateTime": now,
+                              "analyzeResult": fixture})
+
+    def _chat(self, request):
+        time.sleep(self.server.behavior.delay())
+        content = self.server.fixtures.chat(request)
+        if not request.get("stream"):
+            return self._send_json(200, _completion(request, content))
+        usage = _usage(request, content)
+        base = {"id": "chatcmpl-" + uuid.uuid4().hex, "created": int(time.time()), "model": request.get("model", ""),
+                "system_fingerprint": "stand-in"}
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        chunks = [{"index": 0, "delta": {"role": "assistant", "content": line + "\n"}, "finish_reason": None}
+                  for line in content.split("\n")]
+        for choice in chunks:
+            self._event(dict(base, object="chat.completion.chunk", choices=[choice]))
+        self._event(dict(base, object="chat.completion.chunk",
+                         choices=[{"index": 0, "delta": {}, "finish_reason": "stop"}]))
+        if (request.get("stream_options") or {}).get("include_usage"):
+            self._event(dict(base, object="chat.completion.chunk", choices=[], usage=usage))
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.close_connection = True
+
+    def _event(self, payload):
+        self.wfile.write(b"data: " + json.dumps(payload).encode() + b"\n\n")
+        self.wfile.flush()
+
+    def _upload(self, body):
+        content_type = self.headers.get("Content-Type", "")
+        message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+            f"Content-Type: {content_type}\r\n\r\n".encode() + body)
+        fields = {part.get_param("name", header="content-disposition"): part for part in message.iter_parts()}
+        if "file" not in fields:
+            return self._send_json(400, {"error": {"code": "invalid_request", "message": "no file"}})
+        purpose = fields["purpose"].get_payload(decode=True).decode() if "purpose" in fields else "batch"
+        upload = fields["file"]
+        self._send_json(200, self.server.batches.add_file(upload.get_payload(decode=True),
+                                                          upload.get_filename() or "upload.jsonl", purpose))
+
+    def _create_batch(self, request):
+        batch = self.server.batches.create_batch(request.get("input_file_id"), request.get("endpoint"),
+                                                 request.get("completion_window"), request.get("metadata"))
+        if batch is None:
+            return self._send_json(400, {"error": {"code": "invalid_request", "message": "unknown input file"}})
+        self._send_json(200, batch)
+
+    def _batch(self, batch_id):
+        batch = self.server.batches.batch(batch_id)
+        if batch is None:
+            return self._send_json(404, {"error": {"code": "NotFound", "message": batch_id}})
+        self._send_json(200, batch)
+
+    def _file_content(self, file_id):
+        content = self.server.batches.content(file_id)
+        if content is None:
+            return self._send_json(404, {"error": {"code": "NotFound", "message": file_id}})
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+class StandInServer(ThreadingHTTPServer):
+    '''
+    An HTTP stand-in for one service: kind "azure" (prebuilt-layout analyze and poll) or "openai" (chat
+    completions and the Batch API). Serves on localhost from a background thread; use as a context manager.
+    '''
+
+    daemon_threads = True
+
+    def __init__(self, kind, fixtures, behavior=None, port=0):
+        super().__init__(("127.0.0.1", port), _Handler)
+        self.kind = kind
+        self.fixtures = fixtures
+        self.behavior = behavior or Behavior()
+        self.operations = {}
+        self.batches = BatchStore(fixtures, self.behavior)
+        self.counters = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def count(self, name):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + 1
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, name=f"stand-in-{self.kind}", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
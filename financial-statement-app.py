@@ -2,148 +2,235 @@
 This Flask app hosts an endpoint that processes a financial statement PDF file and extracts structured data 
 using Azure Document Intelligence and OpenAI's GPT-4 model. I wrote a HTTP endpoint to scale my app in production.
 Components inside the pipeline can be swapped at will. 
+Long uploads can go through POST /jobs instead, which answers 202 with a job id to poll at GET /jobs/<id>.
+Slow LLM calls are hedged. REQUEST_DEADLINE_SECONDS (off by default) gives a request to /process_financial_statement
+a latency budget; it should sit well above the usual layout analysis time, since extraction only gets its share
+of it. A parse the deadline cuts short is written from the rows that arrived, with the metrics left out listed in
+the X-Partial-Result header. Concurrent uploads of the same PDF share one pipeline run, and its workbook
+is kept for a few minutes for the uploads that follow (single_flight.py).
 '''
 
-import openai
-from openai import OpenAI
 import os
-from azure.ai.formrecognizer import DocumentAnalysisClient
-from azure.core.credentials import AzureKeyCredential
-import openpyxl
-from dotenv import load_dotenv
-
-from flask import Flask, request, jsonify, send_file
-import tempfile
-
-load_dotenv()
-
-AZURE_DOCUMENT_ANALYZER_KEY = os.getenv("AZURE_DOCUMENT_ANALYZER_KEY")
-AZURE_DOCUMENT_ANALYZER_ENDPOINT = os.getenv("AZURE_DOCUMENT_ANALYZER_ENDPOINT")
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-
-document_client = DocumentAnalysisClient(
-    endpoint=AZURE_DOCUMENT_ANALYZER_ENDPOINT,
-    credential=AzureKeyCredential(AZURE_DOCUMENT_ANALYZER_KEY)
-)
-
-openai_client = OpenAI(api_key=OPENAI_API_KEY)
+from backends import import_times, load_pipeline
+from cascade import cascade_stats
+from deadlines import budget
+from resilience import BackendError, DeadlineExceeded, RateLimited, backend_stats
+from instrumentation import REGISTRY, record_document, record_pages, stage
+from page_selection import count_pages
+from single_flight import SingleFlight
+from jobs import JobRunner, QUEUED, SUCCEEDED
+from uploads import (MAX_UPLOAD_BYTES, UploadTooLarge, cleanup_stale_scratch, remove_scratch_file, save_upload,
+                     store_upload, upload_metrics)
+
+from flask import Flask, Response, request, jsonify, send_file, url_for
+import io
+
+# LAYOUT_BACKEND picks the layout backend; only its SDK and client are loaded, on the first request
+pipeline = load_pipeline(os.getenv("LAYOUT_BACKEND", "azure"), parser="text", writer="text")
+# 0 runs requests without a deadline
+REQUEST_DEADLINE_SECONDS = float(os.getenv("REQUEST_DEADLINE_SECONDS", 0))
+flights = SingleFlight()
 
 app = Flask(__name__)
 
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_BYTES + 64 * 1024  # room for the multipart envelope
+cleanup_stale_scratch()
+
 '''
-This function takes in a PDF file path, extracts tables from the PDF
-using Azure Document Analysis and returns the tables as a list of rows.
+This function takes in a PDF (a file path or the PDF bytes), extracts tables from it
+using the layout backend and returns the statement tables.
 '''
-def extract_tables_from_pdf(pdf_path):
+def extract_tables_from_pdf(pdf):
     try:
-        with open(pdf_path, "rb") as pdf_file:
-            poller = document_client.begin_analyze_document("prebuilt-layout", document=pdf_file)
-            result = poller.result()
-
-        tables = []
-        for table in result.tables:
-            rows = []
-            for row_idx in range(table.row_count):
-                row = []
-                for cell in table.cells:
-                    if cell.row_index == row_idx:
-                        row.append(cell.content)
-                rows.append(row)
-            tables.append(rows)
-        return tables
-    except Exception as e:
+        record_pages(count_pages(pdf))
+    except OSError as e:
         print(f"Error extracting tables: {e}")
         return []
+    return pipeline.extract_tables_from_pdf(pdf)
 
 '''
-This function takes in the extracted tables in markdown format
-and prompts OpenAI to extract the desired information and format it.
+This function takes in the extracted tables, renders them
+in markdown and prompts OpenAI to extract the desired
+information and format it.
 '''
-def parse_tables_with_openai(tables_markdown):
-    with open('data/prompt.txt', 'r') as f:
-        prompt = f.read()
-
-    # Append the extracted tables to the prompt
-    for table_markdown in tables_markdown:
-        prompt += "\n" + table_markdown + "\n"
-
-    try:
-        response = openai_client.chat.completions.create(
-            model="gpt-4",
-            messages=[
-                {"role": "system", "content": "You are a helpful assistant for financial analysis."},
-                {"role": "user", "content": prompt}
-            ]
-        )
-        return response.choices[0].message.content
-    except Exception as e:
-        print(f"Error parsing tables with OpenAI: {e}")
-        return ""
+def parse_tables_with_openai(tables):
+    return pipeline.parse_tables_with_openai(tables)
 
 '''
 This function takes the extracted information and 
 saves it to an Excel file.
 '''
 def save_to_excel(parsed_data, output_path):
-    try:
-        workbook = openpyxl.Workbook()
-        sheet = workbook.active
-        sheet.title = "Financial Metrics"
-
-        sheet.append(["Metric", "Value"])
+    pipeline.save_to_excel(parsed_data, output_path)
 
-        for line in parsed_data.split("\n"):
-            vals = line.split("|")
-            if len(vals) >= 2:
-                sheet.append([x.strip() for x in vals[:2]])
-        workbook.save(output_path)
-    except Exception as e:
-        print(f"Error saving data to Excel: {e}")
+class ExtractionFailed(RuntimeError):
+    '''A stage came back empty: no tables were found in the PDF, or OpenAI returned nothing for them.'''
 
 '''
-This function processes the financial statement PDF file
-and invokes the above functionality.
+This function processes the financial statement PDF (path or bytes)
+and invokes the above functionality. output is a file path or a
+writable file object such as io.BytesIO. Returns the parsed data.
+An empty stage result raises ExtractionFailed instead of producing
+an empty workbook (and, for no tables, before any LLM call).
 '''
-def process_financial_statement(pdf_path, output_path):
+def process_financial_statement(pdf, output, progress=None):
+    progress = progress or (lambda stage: None)
+
     print("Extracting tables from PDF using OpenAI Vision...")
-    tables_markdown = extract_tables_from_pdf(pdf_path)
+    progress("extract")
+    with stage("extract"):
+        tables = extract_tables_from_pdf(pdf)
+    if not tables:
+        record_document("failed")
+        raise ExtractionFailed("No tables found in the PDF")
 
     print("Parsing tables with OpenAI...")
-    parsed_data = parse_tables_with_openai(tables_markdown)
+    progress("parse")
+    with stage("parse"):
+        parsed_data = parse_tables_with_openai(tables)
     print(parsed_data)
+    if not parsed_data:
+        record_document("failed")
+        if getattr(parsed_data, "missing", None):
+            raise DeadlineExceeded("openai", "no rows arrived before the deadline")
+        raise ExtractionFailed("Failed to parse data with OpenAI")
 
     print("Saving data to Excel...")
-    save_to_excel(parsed_data, output_path)
-    print(f"Processing complete. Data saved to {output_path}")
+    progress("save")
+    with stage("save"):
+        save_to_excel(parsed_data, output)
+    record_document("partial" if getattr(parsed_data, "missing", None) else "done")
+    print("Processing complete.")
+    return parsed_data
 
 @app.route('/process_financial_statement', methods=['POST'])
 def process_financial_statement_endpoint():
 
-    if 'file' not in request.files: # user needs to submit a file header
+    # the PDF can be sent as a multipart "file" field or as the raw request body (Content-Type: application/pdf)
+    if request.mimetype == 'application/pdf':
+        stream = request.stream
+    elif 'file' not in request.files: # user needs to submit a file header
         return jsonify({'error': 'No file part in the request'}), 400
+    else:
+        file = request.files['file']
 
-    file = request.files['file']
+        # If the user does not select a file
+        if file.filename == '':
+            return jsonify({'error': 'No selected file'}), 400
+        stream = file.stream
 
-    # If the user does not select a file
-    if file.filename == '':
-        return jsonify({'error': 'No selected file'}), 400
+    try:
+        with stage("upload"):
+            # the PDF goes to a scratch file, not memory, and is keyed by the hash taken while streaming it
+            pdf_path, key = store_upload(stream)
+    except UploadTooLarge as e:
+        return jsonify({'error': str(e)}), 413
+
+    # build the workbook in memory; nothing is left on disk once the response is sent
+    def build_workbook():
+        workbook = io.BytesIO()
+        parsed_data = process_financial_statement(pdf_path, workbook)
+        return workbook.getvalue(), getattr(parsed_data, 'missing', None)
+
+    # uploads of the same document share one run, each waiting no longer than its own deadline; a failed run
+    # raises and is not kept, nor is a partial workbook
+    try:
+        with budget(REQUEST_DEADLINE_SECONDS):
+            workbook, missing = flights.do(key, build_workbook, keep=lambda result: not result[1])
+    finally:
+        remove_scratch_file(pdf_path)
+
+    response = send_file(
+        io.BytesIO(workbook),
+        as_attachment=True,
+        download_name='financial_metrics.xlsx',
+        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+    )
+    if missing:
+        response.headers['X-Partial-Result'] = ', '.join(missing)
+    return response
+
+@app.route('/upload_metrics', methods=['GET'])
+def upload_metrics_endpoint():
+    return jsonify(upload_metrics())
 
-    if file:
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as temp_pdf:
-            file.save(temp_pdf.name)
-            pdf_path = temp_pdf.name
+'''
+Prometheus scrape endpoint: stage latency histograms, page, table, token, cost, cache and error counters.
+'''
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
 
-        # Create a temporary file for the output Excel file
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".xlsx") as temp_xlsx:
-            output_path = temp_xlsx.name
+@app.route('/backend_metrics', methods=['GET'])
+def backend_metrics_endpoint():
+    return jsonify({**backend_stats(), 'import_seconds': import_times(), 'cascade': cascade_stats(),
+                    'single_flight': flights.stats()})
 
-        # Call the process_financial_statement function
-        process_financial_statement(pdf_path, output_path)
+'''
+A backend that stayed unavailable after the retries answers 503 (429 when out of quota, 504 when the request's
+deadline passed before the tables were extracted) instead of an empty workbook.
+'''
+@app.errorhandler(BackendError)
+def backend_error_handler(e):
+    status = 429 if isinstance(e, RateLimited) else 504 if isinstance(e, DeadlineExceeded) else 503
+    return jsonify({'error': str(e), 'kind': e.kind, 'backend': e.backend}), status
 
-        # Send the output Excel file back to the user
-        return send_file(output_path, as_attachment=True, attachment_filename='financial_metrics.xlsx')
+@app.errorhandler(ExtractionFailed)
+def extraction_failed_handler(e):
+    return jsonify({'error': str(e)}), 422
 
-    return jsonify({'error': 'File processing failed'}), 500
+'''
+Job-based version of the pipeline: an empty stage result fails the job instead of producing an empty workbook.
+'''
+def run_financial_statement_job(pdf_path, output_path, progress):
+    process_financial_statement(pdf_path, output_path, progress)
+
+job_runner = JobRunner(run_financial_statement_job)
+
+'''
+Starts the job runner (lease heartbeat, jobs abandoned by a stopped worker) in the process that serves requests,
+not at import: a reloader parent or a preloading server master never runs jobs.
+'''
+@app.before_request
+def start_job_runner():
+    job_runner.start()
+
+@app.route('/jobs', methods=['POST'])
+def create_job_endpoint():
+    if 'file' not in request.files:
+        return jsonify({'error': 'No file part in the request'}), 400
+
+    file = request.files['file']
+    if file.filename == '':
+        return jsonify({'error': 'No selected file'}), 400
+
+    try:
+        job_id = job_runner.submit(lambda pdf_path: save_upload(file.stream, pdf_path))
+    except UploadTooLarge as e:
+        return jsonify({'error': str(e)}), 413
+    status_url = url_for('job_status_endpoint', job_id=job_id)
+    return jsonify({'job_id': job_id, 'status': QUEUED, 'status_url': status_url}), 202, {'Location': status_url}
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status_endpoint(job_id):
+    job = job_runner.store.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown job'}), 404
+
+    body = {key: job[key] for key in ('id', 'status', 'stage', 'stages', 'error', 'created', 'updated')}
+    if job['status'] == SUCCEEDED:
+        body['result_url'] = url_for('job_result_endpoint', job_id=job_id)
+    return jsonify(body)
+
+@app.route('/jobs/<job_id>/result', methods=['GET'])
+def job_result_endpoint(job_id):
+    job = job_runner.store.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    if job['status'] != SUCCEEDED:
+        return jsonify({'error': f"Job is {job['status']}", 'status': job['status']}), 409
+
+    return send_file(job['output_path'], as_attachment=True, download_name='financial_metrics.xlsx')
 
 if __name__ == "__main__":
     app.run(debug=True)
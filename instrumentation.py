@@ -0,0 +1,318 @@
+'''
+Lightweight instrumentation for the pipelines: timers around each stage, counters for pages, tables, LLM tokens
+and cost, cache hits and error types. Everything is recorded in a process-wide registry that renders in the
+Prometheus text format (served by the Flask app at /metrics), and, when a document Trace is active, in that
+document's trace as well (written as JSON per document by batch runs).
+
+Usage:
+    with stage("extract"):
+        tables = extract_tables_from_pdf(pdf_path)
+    record_tables(len(tables))
+
+Traces follow the current context. Work handed to a thread pool has to run in a copy of the context
+(contextvars.copy_context().run) to stay attached to the document's trace.
+'''
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from deadlines import stage_deadline
+
+SECONDS_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+# USD per million prompt and completion tokens; prefixes match dated model names
+MODEL_PRICES = {
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4-turbo": (10.00, 30.00),
+    "gpt-4": (30.00, 60.00),
+}
+
+
+def _label_key(labelnames, labels):
+    return tuple(str(labels.get(name, "")) for name in labelnames)
+
+
+def _format_labels(labelnames, key, extra=()):
+    pairs = list(zip(labelnames, key)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+class Counter:
+
+    type = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(self.labelnames, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(_label_key(self.labelnames, labels), 0)
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        return [(self.name + _format_labels(self.labelnames, key), value) for key, value in sorted(values.items())]
+
+
+class Histogram:
+
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=SECONDS_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}  # label key -> [count per bucket..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = _label_key(self.labelnames, labels)
+        with self._lock:
+            state = self._values.setdefault(key, [0] * (len(self.buckets) + 2))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[i] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    def totals(self, **labels):
+        '''(count, sum) of the values observed with labels.'''
+        with self._lock:
+            state = self._values.get(_label_key(self.labelnames, labels))
+        return (state[-1], state[-2]) if state else (0, 0.0)
+
+    def samples(self):
+        with self._lock:
+            values = {key: list(state) for key, state in self._values.items()}
+        samples = []
+        for key, state in sorted(values.items()):
+            for bound, count in zip(self.buckets, state):
+                samples.append((self.name + "_bucket" + _format_labels(self.labelnames, key, [("le", f"{bound:g}")]),
+                                count))
+            samples.append((self.name + "_bucket" + _format_labels(self.labelnames, key, [("le", "+Inf")]),
+                            state[-1]))
+            samples.append((self.name + "_sum" + _format_labels(self.labelnames, key), state[-2]))
+            samples.append((self.name + "_count" + _format_labels(self.labelnames, key), state[-1]))
+        return samples
+
+
+class Observed:
+    '''A counter or gauge kept elsewhere (e.g. UploadMetrics), read by read() whenever the registry renders.'''
+
+    def __init__(self, name, documentation, read, type="gauge"):
+        self.name = name
+        self.documentation = documentation
+        self.read = read
+        self.type = type
+
+    def samples(self):
+        return [(self.name, self.read())]
+
+
+class Registry:
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=SECONDS_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def observed(self, name, documentation, read, type="gauge"):
+        return self._register(Observed(name, documentation, read, type))
+
+    def render(self):
+        '''The registry in the Prometheus text exposition format (version 0.0.4).'''
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(f"{sample} {value}" for sample, value in metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.histogram("pipeline_stage_seconds", "Time spent in each pipeline stage.", ["stage"])
+STAGE_ERRORS = REGISTRY.counter("pipeline_stage_errors_total", "Pipeline stages that raised, by error type.",
+                                ["stage", "kind"])
+PAGES = REGISTRY.counter("pipeline_pages_total", "Pages of the processed PDFs.")
+TABLES = REGISTRY.counter("pipeline_tables_total", "Tables extracted by layout analysis.")
+LLM_TOKENS = REGISTRY.counter("llm_tokens_total", "Tokens reported by OpenAI responses.", ["model", "type"])
+LLM_COST = REGISTRY.counter("llm_cost_usd_total", "Estimated OpenAI cost in USD.", ["model"])
+DOCUMENTS = REGISTRY.counter("pipeline_documents_total", "Processed documents by outcome.", ["status"])
+CACHE_REQUESTS = REGISTRY.counter("cache_requests_total", "Cache lookups by cache and result.", ["cache", "result"])
+
+
+class Trace:
+    '''Timings and counters of one document. Thread-safe; stages of one document may run on several threads.'''
+
+    def __init__(self, document):
+        self.document = document
+        self.started = time.time()
+        self.spans = []
+        self.counters = {}
+        self.errors = []
+        self._lock = threading.Lock()
+
+    def add_span(self, stage, started, seconds, error=None):
+        with self._lock:
+            self.spans.append({"stage": stage, "start": round(started - self.started, 4),
+                               "seconds": round(seconds, 4), "error": error})
+
+    def add(self, name, amount):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def add_error(self, stage, kind, message):
+        with self._lock:
+            self.errors.append({"stage": stage, "kind": kind, "message": message})
+
+    def stage_seconds(self):
+        totals = {}
+        with self._lock:
+            for span in self.spans:
+                totals[span["stage"]] = round(totals.get(span["stage"], 0.0) + span["seconds"], 4)
+        return totals
+
+    def to_dict(self):
+        with self._lock:
+            spans, counters, errors = list(self.spans), dict(self.counters), list(self.errors)
+        return {
+            "document": self.document,
+            "started": self.started,
+            "seconds": round(time.time() - self.started, 4),
+            "stages": self.stage_seconds(),
+            "spans": spans,
+            "counters": counters,
+            "errors": errors,
+        }
+
+    def write(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    @contextmanager
+    def activate(self):
+        '''Makes this the current trace for the enclosed code.'''
+        token = _current_trace.set(self)
+        try:
+            yield self
+        finally:
+            _current_trace.reset(token)
+
+
+_current_trace = ContextVar("trace", default=None)
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+def error_kind(error):
+    return getattr(error, "kind", None) or type(error).__name__
+
+
+'''
+Times the enclosed block as a pipeline stage and counts the type of any exception it raises. Within a run's
+latency budget the stage gets its share of what is left (deadlines.stage_deadline).
+'''
+@contextmanager
+def stage(name):
+    trace = current_trace()
+    wall_start = time.time()
+    start = time.perf_counter()
+    error = None
+    try:
+        with stage_deadline(name):
+            yield
+    except Exception as e:
+        error = error_kind(e)
+        STAGE_ERRORS.inc(stage=name, kind=error)
+        if trace is not None:
+            trace.add_error(name, error, str(e))
+        raise
+    finally:
+        seconds = time.perf_counter() - start
+        STAGE_SECONDS.observe(seconds, stage=name)
+        if trace is not None:
+            trace.add_span(name, wall_start, seconds, error)
+
+
+def record_document(status):
+    DOCUMENTS.inc(status=status)
+
+
+def record_pages(count):
+    PAGES.inc(count)
+    _trace_add("pages", count)
+
+
+def record_tables(count):
+    TABLES.inc(count)
+    _trace_add("tables", count)
+
+
+def record_cache(cache, hit):
+    CACHE_REQUESTS.inc(cache=cache, result="hit" if hit else "miss")
+    _trace_add(f"{cache}_cache_{'hits' if hit else 'misses'}", 1)
+
+
+def model_price(model):
+    for prefix in sorted(MODEL_PRICES, key=len, reverse=True):
+        if model.startswith(prefix):
+            return MODEL_PRICES[prefix]
+    return (0.0, 0.0)
+
+
+'''
+Records the token usage of an OpenAI response (response.usage) and its estimated cost. price_factor scales the list
+prices, e.g. for the discounted Batch API.
+'''
+def record_llm_usage(model, usage, price_factor=1.0):
+    if usage is None:
+        return
+    prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+    completion_tokens = getattr(usage, "completion_tokens", 0) or 0
+    prompt_price, completion_price = model_price(model)
+    cost = (prompt_tokens * prompt_price + completion_tokens * completion_price) * price_factor / 1e6
+    LLM_TOKENS.inc(prompt_tokens, model=model, type="prompt")
+    LLM_TOKENS.inc(completion_tokens, model=model, type="completion")
+    LLM_COST.inc(cost, model=model)
+    _trace_add("prompt_tokens", prompt_tokens)
+    _trace_add("completion_tokens", completion_tokens)
+    _trace_add("cost_usd", cost)
+
+
+def _trace_add(name, amount):
+    trace = current_trace()
+    if trace is not None:
+        trace.add(name, amount)
@@ -0,0 +1,244 @@
+'''
+Background jobs for the Flask app. An upload is saved under the job directory, recorded in a local SQLite job
+store and handed to a bounded thread pool, so the request handler can return 202 straight away. The job row
+tracks the overall status and per-stage progress; because it lives on disk, jobs that were queued or running
+when a worker died are picked up again by JobRunner.resume() on the next start.
+
+Several worker processes (gunicorn workers, a reloaded app) share the store, so every job is leased by the runner
+that queued or resumed it: the row names its owner and a lease_until time the owner's heartbeat keeps pushing
+forward. A runner only resumes jobs whose lease has run out, and claims a job atomically before running it, so a
+job still held by a live sibling worker is never run twice.
+'''
+
+import json
+import os
+import shutil
+import socket
+import sqlite3
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_JOB_DIR = os.getenv("JOB_DIR", os.path.join(".cache", "jobs"))
+DEFAULT_MAX_WORKERS = int(os.getenv("JOB_MAX_WORKERS", 4))
+DEFAULT_RETENTION = float(os.getenv("JOB_RETENTION_SECONDS", 24 * 3600))
+# a job whose owner has not renewed its lease for this long is taken to be abandoned
+DEFAULT_LEASE = float(os.getenv("JOB_LEASE_SECONDS", 60))
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+
+
+class JobStore:
+
+    def __init__(self, directory=DEFAULT_JOB_DIR):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.path = os.path.join(directory, "jobs.sqlite")
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id TEXT PRIMARY KEY, status TEXT NOT NULL, stage TEXT, stages TEXT NOT NULL, error TEXT, "
+                "pdf_path TEXT NOT NULL, output_path TEXT NOT NULL, created REAL NOT NULL, updated REAL NOT NULL, "
+                "owner TEXT, lease_until REAL)"
+            )
+            # stores created before jobs were leased
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(jobs)")}
+            for column, kind in (("owner", "TEXT"), ("lease_until", "REAL")):
+                if column not in columns:
+                    conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {kind}")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def job_paths(self, job_id):
+        '''Where a job keeps its uploaded PDF and its finished workbook.'''
+        job_dir = os.path.join(self.directory, job_id)
+        os.makedirs(job_dir, exist_ok=True)
+        return os.path.join(job_dir, "input.pdf"), os.path.join(job_dir, "financial_metrics.xlsx")
+
+    def create(self, job_id, pdf_path, output_path, owner=None, lease=DEFAULT_LEASE):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO jobs (id, status, stage, stages, error, pdf_path, output_path, created, updated, owner, "
+                "lease_until) VALUES (?, ?, NULL, '{}', NULL, ?, ?, ?, ?, ?, ?)",
+                (job_id, QUEUED, pdf_path, output_path, now, now, owner, now + lease if owner else None),
+            )
+
+    def get(self, job_id):
+        with self._connect() as conn:
+            conn.row_factory = sqlite3.Row
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job["stages"] = json.loads(job["stages"])
+        return job
+
+    def update(self, job_id, **fields):
+        fields["updated"] = time.time()
+        if "stages" in fields:
+            fields["stages"] = json.dumps(fields["stages"])
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        with self._connect() as conn:
+            conn.execute(f"UPDATE jobs SET {assignments} WHERE id = ?", (*fields.values(), job_id))
+
+    def purge(self, max_age=DEFAULT_RETENTION):
+        '''Deletes finished jobs older than max_age seconds together with their files.'''
+        cutoff = time.time() - max_age
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT id FROM jobs WHERE status IN (?, ?) AND updated < ?", (SUCCEEDED, FAILED, cutoff)
+            ).fetchall()
+            conn.executemany("DELETE FROM jobs WHERE id = ?", rows)
+        for (job_id,) in rows:
+            shutil.rmtree(os.path.join(self.directory, job_id), ignore_errors=True)
+        return len(rows)
+
+    def claim(self, job_id, owner, lease=DEFAULT_LEASE):
+        '''
+        Marks an unfinished job running under owner, unless another owner holds an unexpired lease on it. Returns
+        whether owner got the job.
+        '''
+        now = time.time()
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET status = ?, owner = ?, lease_until = ?, updated = ? "
+                "WHERE id = ? AND status IN (?, ?) AND (owner = ? OR lease_until IS NULL OR lease_until < ?)",
+                (RUNNING, owner, now + lease, now, job_id, QUEUED, RUNNING, owner, now),
+            )
+        return cursor.rowcount == 1
+
+    def claim_expired(self, owner, lease=DEFAULT_LEASE):
+        '''Takes over every unfinished job whose lease has run out, queued again under owner. Returns their ids.'''
+        now = time.time()
+        conn = self._connect()
+        conn.isolation_level = None
+        try:
+            # the write lock is taken before reading, so two workers starting together cannot claim the same job
+            conn.execute("BEGIN IMMEDIATE")
+            rows = conn.execute(
+                "SELECT id FROM jobs WHERE status IN (?, ?) AND (lease_until IS NULL OR lease_until < ?) "
+                "ORDER BY created", (QUEUED, RUNNING, now)
+            ).fetchall()
+            conn.executemany(
+                "UPDATE jobs SET status = ?, stage = NULL, owner = ?, lease_until = ?, updated = ? WHERE id = ?",
+                [(QUEUED, owner, now + lease, now, job_id) for (job_id,) in rows],
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+        return [job_id for (job_id,) in rows]
+
+    def renew(self, owner, lease=DEFAULT_LEASE):
+        '''Extends the lease on every unfinished job of owner.'''
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET lease_until = ? WHERE owner = ? AND status IN (?, ?)",
+                (time.time() + lease, owner, QUEUED, RUNNING),
+            )
+
+    def unfinished(self):
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT id FROM jobs WHERE status IN (?, ?) ORDER BY created", (QUEUED, RUNNING)
+            ).fetchall()
+        return [row[0] for row in rows]
+
+
+class JobRunner:
+    '''
+    Runs pipeline(pdf_path, output_path, progress) for each job on a bounded pool. The pipeline calls
+    progress(stage) when it enters a stage; the previous stage is then marked done. The runner's jobs are leased
+    under its owner id and renewed by a heartbeat thread every lease / 3 seconds.
+    '''
+
+    def __init__(self, pipeline, store=None, max_workers=DEFAULT_MAX_WORKERS, lease=DEFAULT_LEASE):
+        self.pipeline = pipeline
+        self.store = store if store is not None else JobStore()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job")
+        self.lease = lease
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._lock = threading.Lock()
+        self._started = False
+        self._stopped = threading.Event()
+
+    def start(self):
+        '''Starts the lease heartbeat and resumes abandoned jobs; only the first call does anything.'''
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        threading.Thread(target=self._heartbeat, name="job-heartbeat", daemon=True).start()
+        self.resume()
+
+    def _heartbeat(self):
+        while not self._stopped.wait(self.lease / 3):
+            try:
+                self.store.renew(self.owner, self.lease)
+            except sqlite3.Error as e:
+                print(f"Error renewing job leases: {e}")
+
+    def submit(self, save_pdf):
+        '''Creates a job, lets save_pdf(path) write the upload into place and queues it. Returns the job id.'''
+        self.store.purge()
+        job_id = uuid.uuid4().hex
+        pdf_path, output_path = self.store.job_paths(job_id)
+        try:
+            save_pdf(pdf_path)
+        except BaseException:
+            shutil.rmtree(os.path.dirname(pdf_path), ignore_errors=True)
+            raise
+        self.start()
+        self.store.create(job_id, pdf_path, output_path, self.owner, self.lease)
+        self.executor.submit(self._run, job_id)
+        return job_id
+
+    def resume(self):
+        '''Re-queues every unfinished job whose owner stopped renewing its lease (e.g. a worker that died).'''
+        job_ids = self.store.claim_expired(self.owner, self.lease)
+        for job_id in job_ids:
+            self.executor.submit(self._run, job_id)
+        return job_ids
+
+    def _run(self, job_id):
+        if not self.store.claim(job_id, self.owner, self.lease):
+            return  # taken over by another worker meanwhile
+        job = self.store.get(job_id)
+        stages = {}
+
+        def progress(stage):
+            now = time.time()
+            with self._lock:
+                for info in stages.values():
+                    if info["status"] == RUNNING:
+                        info.update(status=SUCCEEDED, finished=now)
+                stages[stage] = {"status": RUNNING, "started": now, "finished": None}
+                self.store.update(job_id, stage=stage, stages=stages)
+
+        self.store.update(job_id, stages=stages)
+        try:
+            self.pipeline(job["pdf_path"], job["output_path"], progress)
+        except Exception as e:
+            traceback.print_exc()
+            for info in stages.values():
+                if info["status"] == RUNNING:
+                    info.update(status=FAILED, finished=time.time())
+            self.store.update(job_id, status=FAILED, error=str(e), stages=stages)
+            return
+        for info in stages.values():
+            if info["status"] == RUNNING:
+                info.update(status=SUCCEEDED, finished=time.time())
+        self.store.update(job_id, status=SUCCEEDED, stage=None, stages=stages)
+
+    def shutdown(self, wait=True):
+        self._stopped.set()
+        self.executor.shutdown(wait=wait)
@@ -0,0 +1,317 @@
+'''
+Deterministic fast path for the typed extraction. Most line items of a statement are printed under a stable label
+("Total current assets", "Goodwill", "Net income"), so they can be copied from the tables without the LLM: row
+labels are looked up in a synonym index of every schema field (exact match on the normalized label, then fuzzy
+matching with difflib), the period columns are read from the table headers and the amounts are parsed from the
+cells. Only the residual fields go to the LLM: the generic slots ("Revenue Item N", "Adjustment N"), computed
+lines such as Adjusted EBITDA, and every field no row matched unambiguously.
+
+A field counts as matched when exactly one set of values was found for it across the section's tables. Tables
+whose periods differ from the first table with a usable header (quarterly columns, for instance) are ignored.
+
+LABEL_MATCHING=0 turns the fast path off; LABEL_MATCHING_CUTOFF sets the fuzzy similarity required (0 to 1).
+'''
+
+import difflib
+import os
+import re
+from collections import namedtuple
+
+from instrumentation import REGISTRY, current_trace
+from prompt import Scale, TypedFinancialStatementExtract
+from table_relevance import BALANCE_SHEET, CASH_FLOW, INCOME_STATEMENT, PLACEHOLDER, normalize_label
+
+ENABLED = os.getenv("LABEL_MATCHING", "1") != "0"
+FUZZY_CUTOFF = float(os.getenv("LABEL_MATCHING_CUTOFF", 0.92))
+HEADER_ROWS = 4
+
+# the statements whose tables a section's rows are matched in; working capital takes the changes reported in
+# the cash flow statement, not the balances of the balance sheet
+MATCH_STATEMENTS = {
+    "income_statement": (INCOME_STATEMENT,),
+    "adjusted_ebitda": (INCOME_STATEMENT, CASH_FLOW),
+    "cash_flow": (CASH_FLOW,),
+    "working_capital": (CASH_FLOW,),
+    "balance_sheet": (BALANCE_SHEET,),
+}
+
+# lines the filings do not print as such; always left to the LLM
+COMPUTED_FIELDS = {
+    ("adjusted_ebitda", "Adjusted_Operating_Income"),
+    ("adjusted_ebitda", "Adjusted_EBITDA"),
+    ("adjusted_ebitda", "Cash_Adjustments"),
+    ("cash_flow", "Change_in_Working_Capital"),
+    ("cash_flow", "Other"),
+    ("working_capital", "Change_in_Working_Capital"),
+    ("working_capital", "Others"),
+}
+
+# labels filings use besides the field name itself
+SYNONYMS = {
+    ("income_statement", "Sales"): (
+        "net sales", "total net sales", "revenue", "revenues", "total revenue", "total revenues", "net revenue",
+        "net revenues", "total net revenue", "total net revenues"),
+    ("income_statement", "Cost_of_Sales"): (
+        "total cost of sales", "cost of revenue", "cost of revenues", "total cost of revenue",
+        "total cost of revenues", "cost of goods sold"),
+    ("income_statement", "Selling_General_and_Administrative"): (
+        "selling general and administrative expenses", "selling general and administrative expense"),
+    ("income_statement", "Operating_Income"): (
+        "income from operations", "operating profit", "operating income loss", "income loss from operations"),
+    ("income_statement", "Interest_Expense"): ("interest expense net",),
+    ("income_statement", "Other_Income_expense_net"): (
+        "other income expense", "other income net", "other expense net", "other income expense net"),
+    ("income_statement", "Provision_for_Income_Tax"): (
+        "provision for income taxes", "income tax expense", "income taxes", "provision for benefit from income taxes",
+        "income tax provision"),
+    ("income_statement", "Earnings_from_Discontinued_Operations"): (
+        "income from discontinued operations", "income loss from discontinued operations",
+        "income from discontinued operations net of tax", "earnings loss from discontinued operations"),
+    ("income_statement", "Net_Income"): ("net earnings", "net income loss", "net earnings loss"),
+    ("adjusted_ebitda", "Net_Income"): ("net earnings", "net income loss", "net earnings loss"),
+    ("adjusted_ebitda", "Interest_Expense"): ("interest expense net",),
+    ("adjusted_ebitda", "Income_Taxes"): (
+        "provision for income taxes", "income tax expense", "provision for benefit from income taxes"),
+    ("adjusted_ebitda", "Depreciation_Amortization"): ("depreciation and amortization",),
+    ("cash_flow", "Net_Income"): ("net earnings", "net income loss", "net earnings loss"),
+    ("cash_flow", "Cash_Flow_From_Operating_Activities"): (
+        "cash generated by operating activities", "net cash provided by operating activities",
+        "net cash provided by used in operating activities", "net cash from operating activities",
+        "cash provided by operating activities"),
+    ("cash_flow", "Capital_Expenditures"): (
+        "payments for acquisition of property plant and equipment", "purchases of property plant and equipment",
+        "purchases of property and equipment", "additions to property plant and equipment", "capital expenditure"),
+    ("cash_flow", "Cash_Flow_From_Investing_Activities"): (
+        "cash generated by used in investing activities", "cash used in investing activities",
+        "net cash used in investing activities", "net cash provided by used in investing activities",
+        "net cash from investing activities"),
+    ("cash_flow", "Debt_Issuance_Costs"): ("payments of debt issuance costs", "payment of debt issuance costs"),
+    ("cash_flow", "Dividends"): (
+        "dividends paid", "payments for dividends", "payments for dividends and dividend equivalents",
+        "cash dividends paid"),
+    ("cash_flow", "Cash_Flow_From_Financing_Activities"): (
+        "cash used in financing activities", "net cash used in financing activities",
+        "net cash provided by used in financing activities", "net cash from financing activities"),
+    ("cash_flow", "Foreign_Exchange_Rate_Effect_on_Cash_and_Cash_Equivalents"): (
+        "effect of exchange rate changes on cash and cash equivalents", "effect of exchange rate changes on cash",
+        "effect of exchange rate changes on cash cash equivalents and restricted cash"),
+    ("cash_flow", "Change_In_Cash_Cash_Equiv"): (
+        "increase decrease in cash and cash equivalents", "net increase decrease in cash and cash equivalents",
+        "net change in cash and cash equivalents", "increase decrease in cash cash equivalents and restricted cash"),
+    ("cash_flow", "Cash_And_Cash_Equivalents_Beginning_Of_Period"): (
+        "cash and cash equivalents at beginning of period", "cash and cash equivalents beginning of year",
+        "cash cash equivalents and restricted cash beginning balances"),
+    ("cash_flow", "Cash_And_Cash_Equivalents_End_Of_Period"): (
+        "cash and cash equivalents at end of period", "cash and cash equivalents end of year",
+        "cash cash equivalents and restricted cash ending balances"),
+    ("working_capital", "Accounts_Receivable"): ("accounts receivable net",),
+    ("working_capital", "Prepaid_Expenses_and_Other_Current_Assets"): ("prepaid expenses and other assets",),
+    ("working_capital", "Accrued_Expenses"): ("accrued liabilities", "accrued expenses and other liabilities"),
+    ("working_capital", "Income_Taxes_Payables"): ("income taxes payable",),
+    ("balance_sheet", "Accounts_Receivables"): ("accounts receivable", "accounts receivable net", "trade receivables"),
+    ("balance_sheet", "Property_Plant_and_Equipment_Net"): ("property and equipment net",),
+    ("balance_sheet", "Other_Intangiblesnet"): ("intangible assets net", "other intangible assets net"),
+    ("balance_sheet", "Other_Assets"): ("other non current assets", "other noncurrent assets"),
+    ("balance_sheet", "Trade_Accounts_Payable"): ("accounts payable",),
+    ("balance_sheet", "Accrued_and_Other_Current_Liabilities"): (
+        "other current liabilities", "accrued liabilities", "accrued expenses and other current liabilities"),
+    ("balance_sheet", "Current_Portion_of_Debt"): (
+        "current portion of long term debt", "short term debt and current portion of long term debt"),
+    ("balance_sheet", "Other_Noncurrent_Liabilities"): ("other non current liabilities", "other liabilities"),
+    ("balance_sheet", "Total_Liabilities"): ("total liabilities",),
+    ("balance_sheet", "Shareholder_Equity"): (
+        "total shareholders equity", "total stockholders equity", "shareholders equity", "stockholders equity",
+        "total equity"),
+    ("balance_sheet", "Total_Liabilities_And_Shareholders_Equities"): (
+        "total liabilities and shareholders equity", "total liabilities and stockholders equity",
+        "total liabilities and equity"),
+}
+
+SCALES = {"thousands": Scale.thousands, "millions": Scale.millions, "billions": Scale.billions}
+SCALE_PATTERN = re.compile(r"\bin (thousands|millions|billions)\b|\b(thousands|millions|billions) of\b")
+CURRENCY_SYMBOLS = {"$": "USD", "€": "EUR", "£": "GBP", "¥": "JPY"}
+CURRENCY_CODE = re.compile(r"\b(USD|EUR|GBP|JPY|CHF|CAD|AUD)\b")
+YEAR = re.compile(r"\b(?:19|20)\d{2}\b")
+AMOUNT = re.compile(r"(\()?(-)?(\d[\d,]*(?:\.\d+)?)(\))?")
+DASHES = {"-", "—", "–"}
+FOOTNOTE = re.compile(r"( \d{1,2})+$")
+SEPARATOR = re.compile(r"[|\s:-]+")
+
+SectionMatch = namedtuple("SectionMatch", ["periods", "currency", "scale", "values", "residual"])
+
+MATCHED_FIELDS = REGISTRY.counter("label_match_fields_total",
+                                  "Typed fields filled by label matching or left to the LLM.", ["section", "result"])
+
+
+def residual_only(section, field):
+    return bool(PLACEHOLDER.search(normalize_label(field))) or (section, field) in COMPUTED_FIELDS
+
+
+def _clean_label(label):
+    label = normalize_label(label)
+    for prefix in ("plus ", "less "):
+        if label.startswith(prefix):
+            label = label[len(prefix):]
+    return FOOTNOTE.sub("", label)
+
+
+'''
+Builds {section: {normalized label: field}} from the field names and SYNONYMS, skipping the residual-only fields.
+'''
+def build_index():
+    index = {}
+    for section, info in TypedFinancialStatementExtract.model_fields.items():
+        if section not in MATCH_STATEMENTS:
+            continue
+        labels = index.setdefault(section, {})
+        for field in info.annotation.model_fields:
+            if residual_only(section, field):
+                continue
+            for label in (field, *SYNONYMS.get((section, field), ())):
+                labels.setdefault(_clean_label(label), field)
+    return index
+
+
+INDEX = build_index()
+
+
+def lookup(section, label):
+    labels = INDEX[section]
+    label = _clean_label(label)
+    if not label:
+        return None
+    if label in labels:
+        return labels[label]
+    close = difflib.get_close_matches(label, labels.keys(), n=1, cutoff=FUZZY_CUTOFF)
+    return labels[close[0]] if close else None
+
+
+'''
+Parses a printed amount: "$ 1,234.5" -> 1234.5, "(1,234)" -> -1234.0, a dash -> 0.0. Returns None for anything
+else, including percentages.
+'''
+def parse_amount(cell):
+    text = cell.strip()
+    for symbol in CURRENCY_SYMBOLS:
+        text = text.replace(symbol, "")
+    text = text.replace(" ", "")
+    if text in DASHES:
+        return 0.0
+    match = AMOUNT.fullmatch(text)
+    if match is None or bool(match.group(1)) != bool(match.group(4)):
+        return None
+    value = float(match.group(3).replace(",", ""))
+    return -value if match.group(1) or match.group(2) else value
+
+
+'''
+Splits a table text into rows of cells. Understands the tab-separated rows of TableGrid.to_text and markdown
+tables (Docling); other lines, such as captions, are skipped.
+'''
+def table_rows(text):
+    rows = []
+    for line in text.splitlines():
+        stripped = line.strip()
+        if stripped.startswith("|"):
+            if not SEPARATOR.fullmatch(stripped):
+                rows.append([cell.strip() for cell in stripped.strip("|").split("|")])
+        elif "\t" in line:
+            rows.append([cell.strip() for cell in line.split("\t")])
+    return rows
+
+
+'''
+Finds the header row with the period columns: the first of the top rows in which some columns name exactly one
+year. Returns (row index, {column: period}), or None when no row qualifies or a year appears twice.
+'''
+def period_columns(rows):
+    for r, row in enumerate(rows[:HEADER_ROWS]):
+        columns = {}
+        for c, cell in enumerate(row[1:], start=1):
+            years = YEAR.findall(cell)
+            if len(years) == 1:
+                columns[c] = years[0]
+        if columns:
+            if len(set(columns.values())) != len(columns):
+                return None
+            return r, columns
+    return None
+
+
+def row_values(row, columns):
+    '''The amount of every period column; a currency symbol in its own cell is skipped. None if one is missing.'''
+    starts = sorted(columns)
+    values = []
+    for i, start in enumerate(starts):
+        end = starts[i + 1] if i + 1 < len(starts) else len(row)
+        amount = None
+        for cell in row[start:end]:
+            if cell and cell not in CURRENCY_SYMBOLS:
+                amount = parse_amount(cell)
+                break
+        if amount is None:
+            return None
+        values.append(amount)
+    return values
+
+
+def detect_scale(text):
+    found = {SCALES[next(group for group in match.groups() if group)]
+             for match in SCALE_PATTERN.finditer(text.casefold())}
+    return found.pop() if len(found) == 1 else None
+
+
+def detect_currency(text):
+    for symbol, code in CURRENCY_SYMBOLS.items():
+        if symbol in text:
+            return code
+    match = CURRENCY_CODE.search(text)
+    return match.group(1) if match else None
+
+
+'''
+Matches the rows of a section's tables (table texts, see table_relevance.group_tables) against the section's
+fields. Returns a SectionMatch with the periods, currency and scale read from the tables (None when not stated),
+the values of every matched field and the fields left for the LLM; None when no table has a period header.
+'''
+def match_section(section, tables):
+    fields = TypedFinancialStatementExtract.model_fields[section].annotation.model_fields
+    periods, currency, scales = None, None, set()
+    candidates = {}
+    for text in tables:
+        rows = table_rows(text)
+        header = period_columns(rows)
+        if header is None:
+            continue
+        header_row, columns = header
+        table_periods = list(columns.values())
+        if periods is None:
+            periods = table_periods
+        elif table_periods != periods:
+            continue
+        scale = detect_scale(text)
+        if scale is not None:
+            scales.add(scale)
+        currency = currency or detect_currency(text)
+        for row in rows[header_row + 1:]:
+            field = lookup(section, row[0]) if row else None
+            if field is None:
+                continue
+            values = row_values(row, columns)
+            if values is not None:
+                candidates.setdefault(field, set()).add(tuple(values))
+    if periods is None:
+        return None
+
+    values = {field: list(next(iter(found))) for field, found in candidates.items() if len(found) == 1}
+    residual = [field for field in fields if field not in values]
+    return SectionMatch(periods, currency, scales.pop() if len(scales) == 1 else None, values, residual)
+
+
+def record_match(section, match):
+    MATCHED_FIELDS.inc(len(match.values), section=section, result="matched")
+    MATCHED_FIELDS.inc(len(match.residual), section=section, result="residual")
+    trace = current_trace()
+    if trace is not None:
+        trace.add("matched_fields", len(match.values))
+        trace.add("residual_fields", len(match.residual))
@@ -0,0 +1,278 @@
+'''
+Content-addressed on-disk cache for layout analysis results. Entries are keyed by the SHA-256 of the PDF bytes
+together with the backend, model id and backend version, so re-running the same annual report (while tuning
+prompts, or on a retry) skips the Azure/Docling round-trip entirely.
+
+Values are stored as zlib-compressed JSON. The cache is bounded in size and evicts least recently used entries;
+writes go through a temp file and os.replace so several Flask or Streamlit workers can share one directory.
+cached_azure_tables_async serves the async pipeline: the cache is read and written on worker threads and the
+analysis is polled without blocking the event loop.
+
+The PDF can be given as bytes or as a file path. A path is never read into memory whole: it is hashed in chunks
+for the key and handed to Azure as an open file the SDK streams.
+'''
+
+import asyncio
+import hashlib
+import json
+import os
+import tempfile
+import zlib
+from contextlib import contextmanager
+from importlib import metadata
+
+try:
+    import fcntl
+except ImportError:  # Windows: eviction still works, just without cross-process locking
+    fcntl = None
+
+import page_selection
+from instrumentation import record_cache, stage
+from resilience import azure_backend, poller_result, poller_result_async
+from tables import TableGrid, grids_from_result
+
+DEFAULT_CACHE_DIR = os.getenv("LAYOUT_CACHE_DIR", os.path.join(".cache", "layout"))
+DEFAULT_MAX_BYTES = int(os.getenv("LAYOUT_CACHE_MAX_BYTES", 512 * 1024 * 1024))
+
+AZURE_LAYOUT_MODEL = "prebuilt-layout"
+ENTRY_SUFFIX = ".json.z"
+CHUNK_SIZE = 1024 * 1024
+
+
+'''
+Returns the installed version of a distribution, or "unknown" so a missing backend never breaks the key.
+'''
+def package_version(distribution):
+    try:
+        return metadata.version(distribution)
+    except metadata.PackageNotFoundError:
+        return "unknown"
+
+
+'''
+SHA-256 of a PDF given as bytes or as a file path; a file is read in chunks.
+'''
+def pdf_digest(pdf):
+    digest = hashlib.sha256()
+    if isinstance(pdf, (bytes, bytearray)):
+        digest.update(pdf)
+    else:
+        with open(pdf, "rb") as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+class LayoutCache:
+
+    def __init__(self, directory=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.directory, exist_ok=True)
+
+    def key(self, digest, backend, model_id, backend_version):
+        '''The entry key for a PDF with content digest (pdf_digest) under a backend, model and version.'''
+        suffix = hashlib.sha256(f"{backend}\0{model_id}\0{backend_version}".encode()).hexdigest()[:16]
+        return f"{digest}-{suffix}"
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + ENTRY_SUFFIX)
+
+    def get(self, key):
+        '''Returns the cached value for key, or None. A hit refreshes the entry's position in the LRU order.'''
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                value = json.loads(zlib.decompress(f.read()))
+            os.utime(path)
+        except (FileNotFoundError, zlib.error, ValueError):
+            self.misses += 1
+            record_cache("layout", False)
+            return None
+        self.hits += 1
+        record_cache("layout", True)
+        return value
+
+    def put(self, key, value):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        payload = zlib.compress(json.dumps(value, separators=(",", ":")).encode(), 6)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(payload)
+            os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        self.evict()
+
+    def get_or_compute(self, digest, backend, model_id, backend_version, compute):
+        key = self.key(digest, backend, model_id, backend_version)
+        value = self.get(key)
+        if value is None:
+            value = compute()
+            self.put(key, value)
+        return value
+
+    @contextmanager
+    def _lock(self):
+        if fcntl is None:
+            yield
+            return
+        with open(os.path.join(self.directory, ".lock"), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _entries(self):
+        entries = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if not name.endswith(ENTRY_SUFFIX):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def size(self):
+        return sum(size for _, size, _ in self._entries())
+
+    def evict(self):
+        '''Removes least recently used entries until the cache fits in max_bytes.'''
+        with self._lock():
+            entries = self._entries()
+            total = sum(size for _, size, _ in entries)
+            if total <= self.max_bytes:
+                return
+            for _, size, path in sorted(entries):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+                if total <= self.max_bytes:
+                    break
+
+    def clear(self):
+        with self._lock():
+            for _, _, path in self._entries():
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+
+_default_cache = None
+
+
+def default_cache():
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = LayoutCache()
+    return _default_cache
+
+
+'''
+Returns the pages worth sending to layout analysis (see page_selection), or [] for the whole document. The
+selection is cached alongside the layout results so a repeat analysis does not rescan the PDF. digest is the
+PDF's pdf_digest, when the caller already has it.
+'''
+def selected_pages(pdf, cache=None, digest=None):
+    if not page_selection.ENABLED:
+        return []
+    cache = cache or default_cache()
+    return cache.get_or_compute(digest or pdf_digest(pdf), "page-selection", "v3", package_version("pypdf"),
+                                lambda: page_selection.select_pages(pdf))
+
+
+'''
+The document to send to Azure: the bytes themselves, or the file at a path opened for the SDK to stream. Opened
+anew for every attempt, so a retry starts from the beginning of the file.
+'''
+@contextmanager
+def _document(pdf):
+    if isinstance(pdf, (bytes, bytearray)):
+        yield pdf
+        return
+    with open(pdf, "rb") as document:
+        yield document
+
+
+def _begin_analyze(document_client, pdf, options):
+    with _document(pdf) as document:
+        return document_client.begin_analyze_document(AZURE_LAYOUT_MODEL, document=document, **options)
+
+
+'''
+Runs Azure prebuilt-layout on the PDF (bytes or a file path) unless the same document was already analyzed, and
+returns the tables as TableGrids. Only the pre-selected pages are analyzed; the request is rate limited and
+retried through resilience.azure_backend, and waits for the analysis no longer than the run's deadline.
+'''
+def cached_azure_tables(document_client, pdf, cache=None):
+    cache = cache or default_cache()
+    digest = pdf_digest(pdf)
+    pages = page_selection.format_page_ranges(selected_pages(pdf, cache, digest))
+
+    def analyze():
+        options = {"pages": pages} if pages else {}
+        with stage("azure_analyze"):
+            result = azure_backend().call(lambda: poller_result(_begin_analyze(document_client, pdf, options)))
+        return [grid.to_dict() for grid in grids_from_result(result)]
+
+    model_id = f"{AZURE_LAYOUT_MODEL}@{pages}" if pages else AZURE_LAYOUT_MODEL
+    tables = cache.get_or_compute(digest, "azure", model_id, package_version("azure-ai-formrecognizer"), analyze)
+    return [TableGrid.from_dict(table) for table in tables]
+
+
+'''
+Same as cached_azure_tables for the async DocumentAnalysisClient (azure.ai.formrecognizer.aio).
+'''
+async def cached_azure_tables_async(document_client, pdf, cache=None):
+    cache = cache or default_cache()
+    digest = await asyncio.to_thread(pdf_digest, pdf)
+    pages = page_selection.format_page_ranges(await asyncio.to_thread(selected_pages, pdf, cache, digest))
+    model_id = f"{AZURE_LAYOUT_MODEL}@{pages}" if pages else AZURE_LAYOUT_MODEL
+    key = cache.key(digest, "azure", model_id, package_version("azure-ai-formrecognizer"))
+    tables = await asyncio.to_thread(cache.get, key)
+    if tables is None:
+        options = {"pages": pages} if pages else {}
+
+        async def analyze():
+            with _document(pdf) as document:
+                poller = await document_client.begin_analyze_document(AZURE_LAYOUT_MODEL, document=document,
+                                                                      **options)
+            return await poller_result_async(poller)
+
+        with stage("azure_analyze"):
+            result = await azure_backend().call_async(analyze)
+        tables = [grid.to_dict() for grid in grids_from_result(result)]
+        await asyncio.to_thread(cache.put, key, tables)
+    return [TableGrid.from_dict(table) for table in tables]
+
+
+'''
+Converts the PDF with Docling unless the same document was already converted, and returns the document exported
+to markdown. convert_markdown(pdf_path, pages) does the conversion, e.g. DoclingPool.convert_markdown; pages are
+the pre-selected page numbers, or None for the whole document.
+'''
+def cached_docling_markdown(convert_markdown, pdf_path, cache=None):
+    cache = cache or default_cache()
+    digest = pdf_digest(pdf_path)
+    pages = selected_pages(pdf_path, cache, digest)
+
+    def convert():
+        with stage("docling_convert"):
+            return convert_markdown(pdf_path, pages or None)
+
+    model_id = f"DocumentConverter@{page_selection.format_page_ranges(pages)}" if pages else "DocumentConverter"
+    return cache.get_or_compute(digest, "docling", model_id, package_version("docling"), convert)
@@ -0,0 +1,327 @@
+'''
+Response cache for the OpenAI extraction step. A response is keyed on a hash of everything that determines it:
+the model, the full message list (prompt file contents plus the table text) and the response schema. Re-submitted
+or duplicate statements are answered from the cache instead of paying for another multi-second LLM round-trip.
+Calls that do go out are rate limited and retried by resilience.openai_request. The *_async variants do the same
+for the async OpenAI client; the store is read and written on a worker thread so the event loop never blocks.
+
+Two stores are available, picked with LLM_CACHE_BACKEND: "sqlite" (default, one file shared by every worker) and
+"file" (one JSON file per entry). Both expire entries after a TTL and evict least recently used entries once
+they hold more than max_entries.
+'''
+
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+from instrumentation import record_cache, record_llm_usage
+from resilience import openai_request, openai_request_async
+
+DEFAULT_BACKEND = os.getenv("LLM_CACHE_BACKEND", "sqlite")
+DEFAULT_PATH = os.getenv("LLM_CACHE_PATH", os.path.join(".cache", "llm"))
+DEFAULT_TTL = float(os.getenv("LLM_CACHE_TTL", 7 * 24 * 3600))
+DEFAULT_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", 10000))
+
+
+class SQLiteStore:
+
+    def __init__(self, path, ttl=DEFAULT_TTL, max_entries=DEFAULT_MAX_ENTRIES):
+        if not path.endswith(".sqlite"):
+            path = os.path.join(path, "responses.sqlite")
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+
+    def _connect(self):
+        # a connection per operation keeps the store safe to share between threads and processes
+        return sqlite3.connect(self.path, timeout=30)
+
+    def get(self, key):
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute("SELECT value, created FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if self.ttl and now - row[1] > self.ttl:
+                conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                return None
+            conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+        return row[0]
+
+    def put(self, key, value):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)", (key, value, now, now))
+            if self.ttl:
+                conn.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl,))
+            conn.execute(
+                "DELETE FROM responses WHERE key IN ("
+                "SELECT key FROM responses ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+    def __len__(self):
+        with self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def clear(self):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM responses")
+
+
+class FileStore:
+
+    def __init__(self, directory, ttl=DEFAULT_TTL, max_entries=DEFAULT_MAX_ENTRIES):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".json")
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, "r") as f:
+                entry = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        if self.ttl and time.time() - entry["created"] > self.ttl:
+            self._remove(path)
+            return None
+        os.utime(path)
+        return entry["value"]
+
+    def put(self, key, value):
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump({"created": time.time(), "value": value}, f)
+        os.replace(temp_path, self._path(key))
+        self._evict()
+
+    def _entries(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".json"):
+                path = os.path.join(self.directory, name)
+                try:
+                    entries.append((os.stat(path).st_mtime, path))
+                except FileNotFoundError:
+                    pass
+        return entries
+
+    def _evict(self):
+        entries = sorted(self._entries(), reverse=True)
+        now = time.time()
+        for position, (accessed, path) in enumerate(entries):
+            if position >= self.max_entries or (self.ttl and now - accessed > self.ttl):
+                self._remove(path)
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def __len__(self):
+        return len(self._entries())
+
+    def clear(self):
+        for _, path in self._entries():
+            self._remove(path)
+
+
+STORES = {
+    "sqlite": SQLiteStore,
+    "file": FileStore,
+}
+
+
+class LLMCache:
+
+    def __init__(self, store=None):
+        self.store = store if store is not None else STORES[DEFAULT_BACKEND](DEFAULT_PATH)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def key(self, model, messages, response_format=None):
+        '''Hashes every input that determines the response, including the JSON schema of a structured output.'''
+        schema = response_format.model_json_schema() if response_format is not None else None
+        material = json.dumps({"model": model, "messages": messages, "schema": schema}, sort_keys=True)
+        return hashlib.sha256(material.encode()).hexdigest()
+
+    def get(self, key):
+        value = self.store.get(key)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        record_cache("llm", value is not None)
+        return value
+
+    def put(self, key, value):
+        self.store.put(key, value)
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses}
+
+
+_default_cache = None
+
+
+def default_cache():
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = LLMCache()
+    return _default_cache
+
+
+def has_parsed(response):
+    '''Whether a structured-output response can be used; a hedged request takes the first one that can.'''
+    return response.choices[0].message.parsed is not None
+
+
+def has_content(response):
+    return bool(response.choices[0].message.content)
+
+
+'''
+Structured-output call (beta.chat.completions.parse) through the cache. Returns the parsed response_format
+instance, exactly like response.choices[0].message.parsed.
+'''
+def cached_parse(openai_client, model, messages, response_format, cache=None):
+    cache = cache or default_cache()
+    key = cache.key(model, messages, response_format)
+    cached = cache.get(key)
+    if cached is not None:
+        return response_format.model_validate_json(cached)
+
+    response = openai_request(
+        openai_client.beta.chat.completions.parse,
+        model=model,
+        messages=messages,
+        response_format=response_format,
+        valid=has_parsed
+    )
+    parsed = response.choices[0].message.parsed
+    if parsed is not None:
+        cache.put(key, parsed.model_dump_json())
+    return parsed
+
+
+'''
+Plain chat completion through the cache. Returns the message content.
+'''
+def cached_create(openai_client, model, messages, cache=None):
+    cache = cache or default_cache()
+    key = cache.key(model, messages)
+    cached = cache.get(key)
+    if cached is not None:
+        return cached
+
+    response = openai_request(
+        openai_client.chat.completions.create,
+        model=model,
+        messages=messages,
+        valid=has_content
+    )
+    content = response.choices[0].message.content
+    if content:
+        cache.put(key, content)
+    return content
+
+
+'''
+Same as cached_parse for the async client (AsyncOpenAI).
+'''
+async def cached_parse_async(openai_client, model, messages, response_format, cache=None):
+    cache = cache or default_cache()
+    key = cache.key(model, messages, response_format)
+    cached = await asyncio.to_thread(cache.get, key)
+    if cached is not None:
+        return response_format.model_validate_json(cached)
+
+    response = await openai_request_async(
+        openai_client.beta.chat.completions.parse,
+        model=model,
+        messages=messages,
+        response_format=response_format,
+        valid=has_parsed
+    )
+    parsed = response.choices[0].message.parsed
+    if parsed is not None:
+        await asyncio.to_thread(cache.put, key, parsed.model_dump_json())
+    return parsed
+
+
+'''
+Same as cached_create for the async client (AsyncOpenAI).
+'''
+async def cached_create_async(openai_client, model, messages, cache=None):
+    cache = cache or default_cache()
+    key = cache.key(model, messages)
+    cached = await asyncio.to_thread(cache.get, key)
+    if cached is not None:
+        return cached
+
+    response = await openai_request_async(
+        openai_client.chat.completions.create,
+        model=model,
+        messages=messages,
+        valid=has_content
+    )
+    content = response.choices[0].message.content
+    if content:
+        await asyncio.to_thread(cache.put, key, content)
+    return content
+
+
+'''
+Streaming chat completion through the cache. Yields the content as it is generated; a cached answer is yielded
+in one piece. The full content is cached once the stream has finished.
+'''
+def cached_stream(openai_client, model, messages, cache=None):
+    cache = cache or default_cache()
+    key = cache.key(model, messages)
+    cached = cache.get(key)
+    if cached is not None:
+        yield cached
+        return
+
+    # retries cover opening the stream; a stream that breaks off midway is not resumed
+    stream = openai_request(
+        openai_client.chat.completions.create,
+        model=model,
+        messages=messages,
+        stream=True,
+        stream_options={"include_usage": True}
+    )
+    parts = []
+    for chunk in stream:
+        if getattr(chunk, "usage", None) is not None:
+            record_llm_usage(model, chunk.usage)
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta.content
+        if delta:
+            parts.append(delta)
+            yield delta
+    content = "".join(parts)
+    if content:
+        cache.put(key, content)
@@ -0,0 +1,98 @@
+'''
+Incremental parsing of the "Metric | Value | Value" lines the text prompts ask the model for. Feeding the
+completion in as it streams yields every row as soon as its line is complete, so the UI can render rows while
+the model is still generating the rest.
+'''
+
+import re
+
+SEPARATOR_ROW = re.compile(r"^[\s|:\-]+$")
+
+
+'''
+Splits one output line into cells. Lines use "|" between cells (tabs in older outputs); lines with neither,
+markdown separator rows and blank lines are not rows and give None.
+'''
+def parse_metric_line(line):
+    line = line.strip().strip("`")
+    if not line or SEPARATOR_ROW.match(line):
+        return None
+    if "|" in line:
+        cells = [cell.strip() for cell in line.strip("|").split("|")]
+    elif "\t" in line:
+        cells = [cell.strip() for cell in line.split("\t")]
+    else:
+        return None
+    return cells if len(cells) >= 2 and cells[0] else None
+
+
+class MetricRowParser:
+    '''Buffers streamed text and returns the rows of every line completed by each chunk.'''
+
+    def __init__(self):
+        self._buffer = ""
+
+    def feed(self, text):
+        self._buffer += text
+        *lines, self._buffer = self._buffer.split("\n")
+        return [row for row in map(parse_metric_line, lines) if row]
+
+    def close(self):
+        '''Parses whatever is left after the stream ends (a last line without a newline).'''
+        row = parse_metric_line(self._buffer)
+        self._buffer = ""
+        return [row] if row else []
+
+
+'''
+Parses a complete completion into rows.
+'''
+def parse_metric_rows(text):
+    parser = MetricRowParser()
+    return parser.feed(text) + parser.close()
+
+
+def prompt_metrics(prompt_text):
+    '''The metrics a text prompt asks for: the labels of its "- " bullets, in order.'''
+    return [line.strip()[1:].strip() for line in prompt_text.splitlines() if line.strip().startswith("-")]
+
+
+'''
+The metrics of prompt_text the answer text reports no value for.
+'''
+def unreported_metrics(text, prompt_text):
+    from table_relevance import normalize_label
+
+    reported = {normalize_label(row[0]) for row in parse_metric_rows(text) if not is_missing(row)}
+    return [metric for metric in prompt_metrics(prompt_text) if normalize_label(metric) not in reported]
+
+
+class PartialText(str):
+    '''
+    A "metric | value" answer the run's deadline (deadlines.py) cut short. missing names the metrics of the prompt
+    it reports no value for.
+    '''
+
+    def __new__(cls, text, missing):
+        partial = super().__new__(cls, text)
+        partial.missing = list(missing)
+        return partial
+
+
+def is_missing(row):
+    '''True for a row that reports no value: every value cell is empty or "N/A".'''
+    return all(cell.strip().upper() in ("", "N/A", "NA", "-") for cell in row[1:])
+
+
+'''
+Merges the rows of several answers (e.g. one per prompt chunk) by metric, in order of first appearance. A metric
+keeps its first row that reports a value; rows that are all "N/A" only fill metrics nothing else reported.
+'''
+def merge_metric_rows(row_lists):
+    merged = {}
+    for rows in row_lists:
+        for row in rows:
+            key = " ".join(row[0].casefold().split())
+            if key not in merged or (is_missing(merged[key]) and not is_missing(row)):
+                merged[key] = row
+    return list(merged.values())
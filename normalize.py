@@ -0,0 +1,97 @@
+'''
+Columnar view of typed extraction results. A TypedFinancialStatementExtract holds one list of numbers per metric;
+to_array turns it into a periods x metrics float array in one pass (missing values become NaN, figures are
+rescaled to a common scale), and normalize_batch stacks several documents into documents x periods x metrics.
+Metrics are addressed by their section-qualified name, e.g. "cash_flow.Net_Income".
+'''
+
+from collections import namedtuple
+
+import numpy as np
+
+from prompt import Scale, StatementContext, TypedFinancialStatementExtract
+
+SCALE_FACTORS = {
+    Scale.units: 1.0,
+    Scale.thousands: 1e3,
+    Scale.millions: 1e6,
+    Scale.billions: 1e9,
+}
+
+SECTION_NAMES = tuple(name for name in TypedFinancialStatementExtract.model_fields
+                      if name not in StatementContext.model_fields)
+# (section, field) pairs in schema order; the column order of every array built here
+METRICS = tuple((section, field)
+                for section in SECTION_NAMES
+                for field in TypedFinancialStatementExtract.model_fields[section].annotation.model_fields)
+METRIC_NAMES = tuple(f"{section}.{field}" for section, field in METRICS)
+METRIC_INDEX = {name: i for i, name in enumerate(METRIC_NAMES)}
+
+StatementArray = namedtuple("StatementArray", ["values", "periods", "metrics"])
+
+
+'''
+Returns the periods of several results in first-seen order, without duplicates.
+'''
+def union_periods(results):
+    periods = {}
+    for result in results:
+        for period in result.periods:
+            periods.setdefault(period, None)
+    return list(periods)
+
+
+'''
+Reorders one metric's values from the result's periods to the given periods, with None where a period is missing.
+'''
+def align_values(values, result_periods, periods):
+    position = {period: i for i, period in enumerate(result_periods)}
+    aligned = []
+    for period in periods:
+        i = position.get(period)
+        aligned.append(values[i] if i is not None and i < len(values) else None)
+    return aligned
+
+
+'''
+Converts one extract into a float array of shape (len(periods), len(METRICS)), in the given scale. periods
+defaults to the extract's own; periods it does not report are NaN.
+'''
+def to_array(extract, periods=None, scale=Scale.millions):
+    periods = list(extract.periods) if periods is None else list(periods)
+    columns = []
+    for section, field in METRICS:
+        values = getattr(getattr(extract, section), field)
+        columns.append(align_values(values, extract.periods, periods))
+    # None converts to NaN in the same pass that builds the array
+    array = np.array(columns, dtype=float).reshape(len(METRICS), len(periods)).T
+    factor = SCALE_FACTORS[Scale(extract.scale)] / SCALE_FACTORS[Scale(scale)]
+    if factor != 1.0:
+        array *= factor
+    return array
+
+
+'''
+Normalizes a batch of extracts into one StatementArray with values of shape (documents, periods, metrics). The
+period axis is the union of every document's periods.
+'''
+def normalize_batch(extracts, scale=Scale.millions):
+    extracts = [extract for extract in extracts if extract is not None]
+    periods = union_periods(extracts)
+    values = np.empty((len(extracts), len(periods), len(METRICS)))
+    for i, extract in enumerate(extracts):
+        values[i] = to_array(extract, periods, scale)
+    return StatementArray(values, periods, METRIC_NAMES)
+
+
+'''
+The extract as worksheet rows: a header with the periods, then one row per metric with numbers (None where
+missing) in the extract's own scale.
+'''
+def worksheet_rows(extract):
+    array = to_array(extract, scale=extract.scale)
+    header = [f"Metric ({extract.currency}, {Scale(extract.scale).value})", *extract.periods]
+    rows = [header]
+    for name, column in zip(METRIC_NAMES, array.T):
+        rows.append([name, *(None if np.isnan(value) else float(value) for value in column)])
+    return rows
@@ -0,0 +1,479 @@
+'''
+OpenAI Batch API mode for backfills that do not need interactive latency. Instead of one synchronous
+structured-output call per section and chunk, the typed section requests of every document (the requests the
+"sections" parser sends, see sections.section_request) are written to JSONL batch files, uploaded and submitted as
+Batch API jobs, which are billed at a discount and do not count against the online rate limits.
+
+A run lives in a run directory:
+- documents.jsonl: every document's PDF path and statement tables, so that answers are reassembled without
+  analyzing the layout again;
+- requests-NNN.jsonl: the request lines, split at the Batch API limits (MAX_BATCH_REQUESTS, MAX_BATCH_BYTES);
+- state.json: the model, system message and prompt of the run and its batches with their status;
+- output-NNN.jsonl, errors-NNN.jsonl: the downloaded answers and failed requests of each batch.
+
+A request's custom_id is its LLM cache key (llm_cache.py): requests the cache can answer are not submitted,
+identical requests are submitted once and collected answers are stored in the cache for later online runs.
+Collecting plans every document's requests again from its tables, looks the answers up, merges them per section
+as the online parser does (chunks, label-matched values) and writes one workbook per complete document. Documents
+with failed or missing answers are reported; "resubmit" sends only their missing requests in a new batch. There is
+no re-extraction round for sections failing the accounting checks; as in batch.py, the failures are written to
+validation.json.
+
+Usage:
+    python openai_batch.py submit data/filings --run-dir data/batch_run --backend azure
+    python openai_batch.py status --run-dir data/batch_run
+    python openai_batch.py collect --run-dir data/batch_run --output-dir data/out --wait
+    python openai_batch.py resubmit --run-dir data/batch_run
+'''
+
+import argparse
+import json
+import os
+import re
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from types import SimpleNamespace
+
+from backends import EXTRACTORS, SECTIONS_MODEL, SECTIONS_SYSTEM_MESSAGE, WRITERS, component, openai_client
+from batch import Journal, collect_inputs, output_stem
+from instrumentation import model_price, record_llm_usage, stage
+from resilience import BackendError, openai_backend
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+COMPLETION_WINDOW = "24h"
+MAX_BATCH_REQUESTS = int(os.getenv("OPENAI_BATCH_MAX_REQUESTS", 50000))
+# the Batch API takes input files of up to 200 MB
+MAX_BATCH_BYTES = int(os.getenv("OPENAI_BATCH_MAX_BYTES", 190 * 1024 * 1024))
+POLL_SECONDS = float(os.getenv("OPENAI_BATCH_POLL_SECONDS", 60))
+# Batch API tokens are billed at half the list price
+BATCH_PRICE_FACTOR = 0.5
+
+FINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+
+'''
+Rewrites a JSON schema into the form strict structured outputs require: every object closed (additionalProperties
+false) with all of its properties required, no null defaults and no $ref with sibling keys.
+'''
+def strict_schema(schema, definitions=None):
+    definitions = schema.get("$defs", {}) if definitions is None else definitions
+    if "$ref" in schema and len(schema) > 1:
+        siblings = {key: value for key, value in schema.items() if key != "$ref"}
+        return strict_schema(dict(definitions[schema["$ref"].split("/")[-1]], **siblings), definitions)
+    strict = {}
+    for key, value in schema.items():
+        if key == "default" and value is None:
+            continue
+        if key in ("properties", "$defs"):
+            value = {name: strict_schema(item, definitions) for name, item in value.items()}
+        elif key in ("anyOf", "allOf"):
+            value = [strict_schema(item, definitions) for item in value]
+        elif key == "items" and isinstance(value, dict):
+            value = strict_schema(value, definitions)
+        strict[key] = value
+    if strict.get("type") == "object":
+        strict["additionalProperties"] = False
+        strict["required"] = list(strict.get("properties", {}))
+    return strict
+
+
+@lru_cache(maxsize=None)
+def response_format_param(response_format):
+    '''The response_format request parameter that beta.chat.completions.parse sends for a pydantic model.'''
+    return {"type": "json_schema", "json_schema": {
+        "name": re.sub(r"[^a-zA-Z0-9_-]", "_", response_format.__name__),
+        "schema": strict_schema(response_format.model_json_schema()),
+        "strict": True,
+    }}
+
+
+class BatchRun:
+    '''The files of one batch run in run_dir (see the module docstring).'''
+
+    def __init__(self, run_dir):
+        self.run_dir = run_dir
+        os.makedirs(run_dir, exist_ok=True)
+
+    def path(self, name):
+        return os.path.join(self.run_dir, name)
+
+    def exists(self):
+        return os.path.exists(self.path("state.json"))
+
+    def load(self):
+        with open(self.path("state.json"), "r") as f:
+            return json.load(f)
+
+    def save(self, state):
+        temp_path = self.path("state.json.tmp")
+        with open(temp_path, "w") as f:
+            json.dump(state, f, indent=2)
+        os.replace(temp_path, self.path("state.json"))
+
+    def documents(self):
+        with open(self.path("documents.jsonl"), "r") as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def write_documents(self, documents):
+        with open(self.path("documents.jsonl"), "w") as f:
+            for document in documents:
+                f.write(json.dumps(document) + "\n")
+
+    def answer_path(self, batch, kind):
+        '''Where the "output" or "errors" file of a batch is downloaded to.'''
+        return self.path(batch["input"].replace("requests", kind, 1))
+
+
+'''
+Analyzes the layout of every PDF with the backend's extractor, layout_workers at a time. Returns one document entry
+per PDF: its statement tables, or the error that kept it from having any.
+'''
+def extract_documents(pdf_paths, backend, layout_workers=4):
+    extractor = component(EXTRACTORS, backend)
+
+    def extract(pdf_path):
+        try:
+            with stage("extract"):
+                tables = extractor.extract(pdf_path)
+        except BackendError as e:
+            return {"pdf": pdf_path, "error": str(e)}
+        if not tables:
+            return {"pdf": pdf_path, "error": "no tables extracted"}
+        tables_by_statement, fallback_tables = extractor.statement_tables(tables)
+        return {"pdf": pdf_path, "tables_by_statement": tables_by_statement, "fallback_tables": list(fallback_tables)}
+
+    with ThreadPoolExecutor(max_workers=max(1, layout_workers), thread_name_prefix="layout") as pool:
+        return list(pool.map(extract, pdf_paths))
+
+
+'''
+Plans the typed section requests of one document as the "sections" parser would send them. Returns a
+(SectionRequest, [(custom_id, request body) per chunk]) pair per section.
+'''
+def document_requests(document, state, cache):
+    from sections import SECTIONS, request_messages, section_request
+
+    model, system_message = state["model"], state["system_message"]
+    tables_by_statement = document["tables_by_statement"]
+    all_tables = [table for tables in tables_by_statement.values() for table in tables] or document["fallback_tables"]
+    planned = []
+    for section in SECTIONS:
+        request = section_request(section, state["prompt"], tables_by_statement, all_tables, model, system_message,
+                                  typed=True)
+        calls = []
+        for chunk in request.chunks:
+            messages = request_messages(system_message, request, chunk)
+            body = {"model": model, "messages": messages,
+                    "response_format": response_format_param(request.response_format)}
+            calls.append((cache.key(model, messages, request.response_format), body))
+        planned.append((request, calls))
+    return planned
+
+
+def _parsed(custom_id, response_format, answers, cache):
+    '''One request's parsed answer, from the batch answers or the LLM cache; None when it has none.'''
+    content = answers.get(custom_id) or cache.get(custom_id)
+    if not content:
+        return None
+    try:
+        parsed = response_format.model_validate_json(content)
+    except ValueError:
+        return None
+    if custom_id in answers:
+        cache.put(custom_id, parsed.model_dump_json())
+    return parsed
+
+
+'''
+The request bodies ({custom_id: body}) of every document that have no valid answer, neither among answers nor in
+the LLM cache.
+'''
+def pending_requests(run, state, cache, answers=None):
+    answers = answers or {}
+    bodies = {}
+    for document in run.documents():
+        if document.get("error"):
+            continue
+        for request, calls in document_requests(document, state, cache):
+            for custom_id, body in calls:
+                if custom_id not in bodies and _parsed(custom_id, request.response_format, answers, cache) is None:
+                    bodies[custom_id] = body
+    return bodies
+
+
+'''
+Writes request bodies as Batch API input lines into requests-NNN.jsonl files, numbered from start, starting a new
+file before one would exceed MAX_BATCH_REQUESTS lines or MAX_BATCH_BYTES. Returns the file names.
+'''
+def write_request_files(run, bodies, start=0):
+    files, lines, size = [], [], 0
+    for custom_id, body in bodies.items():
+        line = (json.dumps({"custom_id": custom_id, "method": "POST", "url": BATCH_ENDPOINT, "body": body})
+                + "\n").encode()
+        if lines and (len(lines) >= MAX_BATCH_REQUESTS or size + len(line) > MAX_BATCH_BYTES):
+            files.append(lines)
+            lines, size = [], 0
+        lines.append(line)
+        size += len(line)
+    if lines:
+        files.append(lines)
+
+    names = []
+    for number, file_lines in enumerate(files, start=start):
+        name = f"requests-{number:03d}.jsonl"
+        with open(run.path(name), "wb") as f:
+            f.writelines(file_lines)
+        names.append(name)
+    return names
+
+
+'''
+Uploads and creates every batch of the run that has not been submitted yet. The state is saved after each step,
+so an interrupted submission resumes where it stopped.
+'''
+def submit_batches(run, state, client):
+    backend = openai_backend()
+    for batch in state["batches"]:
+        if batch.get("batch_id"):
+            continue
+        if not batch.get("input_file_id"):
+            with open(run.path(batch["input"]), "rb") as f:
+                content = f.read()
+            uploaded = backend.call(client.files.create, file=(batch["input"], content), purpose="batch")
+            batch["input_file_id"] = uploaded.id
+            run.save(state)
+        created = backend.call(client.batches.create, input_file_id=batch["input_file_id"], endpoint=BATCH_ENDPOINT,
+                               completion_window=COMPLETION_WINDOW,
+                               metadata={"run": os.path.basename(os.path.abspath(run.run_dir)),
+                                         "input": batch["input"]})
+        batch.update(batch_id=created.id, status=created.status)
+        run.save(state)
+        print(f"Submitted {batch['input']} as {created.id}")
+
+
+'''
+Retrieves the status of the submitted batches and downloads the answers of those that have finished. Returns True
+once every batch has finished and been downloaded.
+'''
+def refresh_batches(run, state, client):
+    backend = openai_backend()
+    for batch in state["batches"]:
+        if not batch.get("batch_id") or batch.get("downloaded"):
+            continue
+        current = backend.call(client.batches.retrieve, batch["batch_id"])
+        counts = current.request_counts
+        batch.update(status=current.status, request_counts=counts and {
+            "total": counts.total, "completed": counts.completed, "failed": counts.failed})
+        if current.status in FINAL_STATUSES:
+            for kind, file_id in (("output", current.output_file_id), ("errors", current.error_file_id)):
+                if file_id:
+                    content = backend.call(client.files.content, file_id)
+                    with open(run.answer_path(batch, kind), "w") as f:
+                        f.write(content.text)
+            batch["downloaded"] = True
+        run.save(state)
+    return all(batch.get("downloaded") for batch in state["batches"])
+
+
+'''
+Reads the downloaded answers. Returns ({custom_id: message content}, {custom_id: error message}, usage): the
+requests answered, those that failed and never were answered, and the answers' token counts and cost at the
+Batch API price.
+'''
+def load_answers(run, state):
+    answers, errors = {}, {}
+    usage = {"prompt_tokens": 0, "completion_tokens": 0, "cost_usd": 0.0}
+    for batch in state["batches"]:
+        for kind in ("output", "errors"):
+            path = run.answer_path(batch, kind)
+            if not os.path.exists(path):
+                continue
+            with open(path, "r") as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    entry = json.loads(line)
+                    response = entry.get("response") or {}
+                    body = response.get("body") or {}
+                    if response.get("status_code") == 200 and body.get("choices"):
+                        answers[entry["custom_id"]] = body["choices"][0]["message"].get("content")
+                        prompt_price, completion_price = model_price(body.get("model") or state["model"])
+                        tokens = body.get("usage") or {}
+                        usage["prompt_tokens"] += tokens.get("prompt_tokens", 0)
+                        usage["completion_tokens"] += tokens.get("completion_tokens", 0)
+                        usage["cost_usd"] += BATCH_PRICE_FACTOR * (
+                            tokens.get("prompt_tokens", 0) * prompt_price
+                            + tokens.get("completion_tokens", 0) * completion_price) / 1e6
+                    else:
+                        error = entry.get("error") or body.get("error") or {}
+                        errors[entry["custom_id"]] = error.get("message") or f"status {response.get('status_code')}"
+    return answers, {custom_id: error for custom_id, error in errors.items() if custom_id not in answers}, usage
+
+
+'''
+Reassembles one document's TypedFinancialStatementExtract from the answers: chunks and label-matched values are
+merged per section as in the online parser. Returns (extract, custom_ids of missing answers); the extract is None
+while any answer is missing.
+'''
+def assemble(document, state, answers, cache):
+    from sections import merge_partial, merge_typed_sections
+
+    results, missing = [], []
+    for request, calls in document_requests(document, state, cache):
+        partial = [_parsed(custom_id, request.response_format, answers, cache) for custom_id, _ in calls]
+        missing.extend(custom_id for (custom_id, _), parsed in zip(calls, partial) if parsed is None)
+        results.append(request.finish(merge_partial(partial)))
+    if missing:
+        return None, missing
+    return merge_typed_sections(results), []
+
+
+def output_path(output_dir, pdf_path):
+    return os.path.join(output_dir, f"{output_stem(pdf_path)}.xlsx")
+
+
+'''
+Writes a workbook for every complete document of the run that the output directory's journal does not list as
+done yet, then validates the new extracts together (validation.json, as in batch.py). Returns
+({pdf: extract} written, {pdf: missing custom_ids}).
+'''
+def collect(run, state, output_dir, cache):
+    os.makedirs(output_dir, exist_ok=True)
+    journal = Journal(os.path.join(output_dir, "journal.jsonl"))
+    completed = journal.completed()
+    write = component(WRITERS, "metrics")
+
+    answers, errors, usage = load_answers(run, state)
+    record_llm_usage(state["model"], SimpleNamespace(**usage), BATCH_PRICE_FACTOR)
+    print(f"{len(answers)} answers ({usage['prompt_tokens'] + usage['completion_tokens']} tokens, "
+          f"${usage['cost_usd']:.2f}), {len(errors)} failed requests")
+
+    extracts, incomplete = {}, {}
+    for document in run.documents():
+        pdf_path = document["pdf"]
+        if pdf_path in completed:
+            continue
+        if document.get("error"):
+            journal.record(file=pdf_path, status="failed", stage="extract", error=document["error"])
+            continue
+        with stage("parse"):
+            extract, missing = assemble(document, state, answers, cache)
+        if extract is None:
+            incomplete[pdf_path] = missing
+            continue
+        output = output_path(output_dir, pdf_path)
+        with stage("save"):
+            written = write(extract, output)
+        if not written:
+            journal.record(file=pdf_path, status="failed", stage="save", error="workbook not written")
+            continue
+        journal.record(file=pdf_path, status="done", output=output)
+        extracts[pdf_path] = extract
+
+    if extracts:
+        from validation import validate_batch  # numpy is only needed once the run has extracts
+
+        failures = {path: checks for path, checks in validate_batch(extracts).items() if checks}
+        with open(os.path.join(output_dir, "validation.json"), "w") as f:
+            json.dump(failures, f, indent=2)
+        print(f"Validation: {len(extracts) - len(failures)} of {len(extracts)} files pass every check")
+    return extracts, incomplete
+
+
+def print_status(state):
+    for batch in state["batches"]:
+        counts = batch.get("request_counts") or {}
+        progress = f"{counts.get('completed', 0)}/{counts.get('total', 0)} done, {counts.get('failed', 0)} failed" \
+            if counts else ""
+        print(f"{batch['input']}: {batch.get('batch_id', 'not submitted')} {batch.get('status', '')} {progress}")
+
+
+def main(argv=None):
+    from llm_cache import default_cache
+    from prompt import load_prompt
+
+    parser = argparse.ArgumentParser(description="Extract financial metrics from PDFs through the OpenAI Batch API.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    submit = commands.add_parser("submit", help="analyze the layouts and submit the requests of every PDF")
+    submit.add_argument("source", help="directory of PDFs, or a manifest file with one PDF path per line")
+    submit.add_argument("--backend", choices=sorted(EXTRACTORS), default="azure")
+    submit.add_argument("--model", default=SECTIONS_MODEL)
+    submit.add_argument("--prompt", default="data/prompt.txt")
+    submit.add_argument("--layout-workers", type=int, default=4)
+    commands.add_parser("status", help="show the status of the run's batches")
+    collect_command = commands.add_parser("collect", help="download the answers and write the workbooks")
+    collect_command.add_argument("--output-dir", default="data/batch_output")
+    collect_command.add_argument("--wait", action="store_true", help="poll until every batch has finished")
+    commands.add_parser("resubmit", help="submit the requests still missing an answer in a new batch")
+    for command in commands.choices.values():
+        command.add_argument("--run-dir", default="data/batch_run")
+    args = parser.parse_args(argv)
+
+    run = BatchRun(args.run_dir)
+    client = openai_client()
+    cache = default_cache()
+
+    if args.command == "submit":
+        if run.exists():
+            print(f"Resuming the submission of {args.run_dir}")
+            state = run.load()
+        else:
+            pdf_paths = collect_inputs(args.source)
+            documents = extract_documents(pdf_paths, args.backend, args.layout_workers)
+            run.write_documents(documents)
+            state = {"model": args.model, "system_message": SECTIONS_SYSTEM_MESSAGE,
+                     "prompt": load_prompt(args.prompt), "backend": args.backend, "created": time.time()}
+            bodies = pending_requests(run, state, cache)
+            state["batches"] = [{"input": name} for name in write_request_files(run, bodies)]
+            run.save(state)
+            failed = sum(1 for document in documents if document.get("error"))
+            print(f"{len(pdf_paths)} files ({failed} without tables): {len(bodies)} requests "
+                  f"in {len(state['batches'])} batch files")
+        submit_batches(run, state, client)
+        return 0
+
+    if not run.exists():
+        print(f"No batch run in {args.run_dir}")
+        return 1
+    state = run.load()
+    finished = refresh_batches(run, state, client)
+
+    if args.command == "status":
+        print_status(state)
+        return 0 if finished else 2
+
+    if args.command == "resubmit":
+        if not finished:
+            print_status(state)
+            print("Batches are still running; resubmit once they have finished")
+            return 2
+        answers, _, _ = load_answers(run, state)
+        bodies = pending_requests(run, state, cache, answers)
+        names = write_request_files(run, bodies, start=len(state["batches"]))
+        state["batches"].extend({"input": name} for name in names)
+        run.save(state)
+        print(f"{len(bodies)} missing requests in {len(names)} batch files")
+        submit_batches(run, state, client)
+        return 0
+
+    while args.wait and not finished:
+        print_status(state)
+        time.sleep(POLL_SECONDS)
+        finished = refresh_batches(run, state, client)
+    if not finished:
+        print_status(state)
+        print("Batches are still running; collect again later or pass --wait")
+        return 2
+    extracts, incomplete = collect(run, state, args.output_dir, cache)
+    print(f"Wrote {len(extracts)} workbooks to {args.output_dir}")
+    if incomplete:
+        print(f"{len(incomplete)} files miss answers to {sum(map(len, incomplete.values()))} requests; "
+              f"run 'python openai_batch.py resubmit --run-dir {args.run_dir}' to request them again")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,182 @@
+'''
+Page pre-selection for layout analysis. In a 120-page annual report the primary statements sit on a handful of
+pages, so before sending a PDF to Azure or Docling its text layer is scanned locally and every page is scored for
+statement headings ("Consolidated Statements of Operations", "Balance Sheets", ...) and numeric density. Only
+the selected pages are analyzed. When the PDF has no text layer, pypdf is not installed or one of the three
+statements has no selected page headed by its title, the whole document is analyzed as before.
+
+Set PAGE_PRESELECTION=0 to always analyze every page.
+'''
+
+import io
+import os
+import re
+
+from table_relevance import STATEMENT_TITLES, normalize_label
+
+ENABLED = os.getenv("PAGE_PRESELECTION", "1") != "0"
+DEFAULT_THRESHOLD = float(os.getenv("PAGE_SELECTION_THRESHOLD", 0.6))
+
+# pages that continue a statement are picked up when they are at least this numeric, at most this many of them
+CONTINUATION_DENSITY = 0.2
+MAX_CONTINUATION_PAGES = 4
+# a statement title has to appear within this many lines from the top of the page to count as its heading
+HEADING_LINES = 12
+# a table of contents entry: a dot leader, or a tab, before a short trailing page number
+TOC_ENTRY = re.compile(r"(?:\.\s*){3,}\d{1,4}\s*$|\t\s*\d{1,3}\s*$")
+
+NUMBER = re.compile(r"^\(?-?\$?[\d,]+(\.\d+)?\)?%?$")
+
+'''
+Statement headings, matched on normalized lines. A heading starts the line: "statement(s) of <title>" may follow
+qualifiers such as "consolidated"; a short title (balance sheets, cash flows, financial position, ...) only counts
+after "consolidated", so MD&A headings like "Cash flows" and notes like "Off-balance sheet arrangements" do not.
+'''
+QUALIFIERS = re.compile(r"^((?:(?:condensed|combined|consolidated) )*)(.*)$")
+STATEMENT_OF = re.compile(r"^statements? of (?:(?:condensed|combined|consolidated) )*")
+
+
+def _title_pattern(titles):
+    return re.compile(r"^(?:%s)\b" % "|".join(map(re.escape, sorted(titles, key=len, reverse=True))))
+
+
+# (after "statement(s) of", after "consolidated") per statement
+HEADING_PATTERNS = {
+    statement: (_title_pattern({title.removeprefix("statements of ") for title in titles}),
+                _title_pattern({title for title in titles if not title.startswith("statements of ")}))
+    for statement, titles in STATEMENT_TITLES.items()
+}
+
+
+'''
+Returns the text of every page of a PDF (a path or the raw bytes), or None when the text layer cannot be read.
+'''
+def page_texts(pdf):
+    try:
+        from pypdf import PdfReader
+    except ImportError:
+        return None
+    if isinstance(pdf, bytes):
+        pdf = io.BytesIO(pdf)
+    try:
+        return [page.extract_text() or "" for page in PdfReader(pdf).pages]
+    except Exception as e:
+        print(f"Error scanning PDF pages: {e}")
+        return None
+
+
+'''
+Counts the pages of a PDF (a path or the raw bytes). Uses pypdf when it is installed and otherwise counts page
+objects in the raw bytes, which is close enough for throughput reporting.
+'''
+def count_pages(pdf):
+    try:
+        from pypdf import PdfReader
+        return len(PdfReader(io.BytesIO(pdf) if isinstance(pdf, bytes) else pdf).pages)
+    except ImportError:
+        pass
+    except Exception:
+        return 0
+    if not isinstance(pdf, bytes):
+        with open(pdf, "rb") as f:
+            pdf = f.read()
+    return len(re.findall(rb"/Type\s*/Page(?![a-zA-Z])", pdf))
+
+
+def numeric_density(text):
+    words = text.split()
+    if not words:
+        return 0.0
+    return sum(1 for word in words if NUMBER.match(word) and any(c.isdigit() for c in word)) / len(words)
+
+
+'''
+Returns the statement a normalized line is the heading of, or None.
+'''
+def heading_statement(line):
+    if "off balance" in line:
+        return None
+    qualifiers, rest = QUALIFIERS.match(line).groups()
+    statement_of = STATEMENT_OF.match(rest)
+    if statement_of is None and "consolidated" not in qualifiers:
+        return None
+    for statement, (long_titles, short_titles) in HEADING_PATTERNS.items():
+        if statement_of is not None and long_titles.match(rest[statement_of.end():]):
+            return statement
+        if statement_of is None and short_titles.match(rest):
+            return statement
+    return None
+
+
+'''
+Returns the statements whose title stands as a heading line near the top of the page. Table of contents entries
+(a title followed by a leader and a page number) do not count as headings; a title ending in a year does.
+'''
+def page_headings(text):
+    headings = set()
+    for line in text.splitlines()[:HEADING_LINES]:
+        if TOC_ENTRY.search(line):
+            continue
+        line = normalize_label(line)
+        if len(line) > 80:
+            continue
+        statement = heading_statement(line)
+        if statement is not None:
+            headings.add(statement)
+    return headings
+
+
+'''
+Scores one page between 0 and 1: half for a statement title standing as a heading line near the top of the page,
+half for numeric density.
+'''
+def score_page(text):
+    return (0.5 if page_headings(text) else 0.0) + 0.5 * min(1.0, numeric_density(text) * 2.5)
+
+
+'''
+Returns the 1-based numbers of the pages worth analyzing, or [] to analyze the whole document. A selected page
+pulls in the pages after it while they are numeric enough to be the statement's continuation (up to
+MAX_CONTINUATION_PAGES). Every statement
+has to be found on a selected page: when one of them scores zero (its heading is worded differently, or the
+statement is an image) the whole document is analyzed rather than leave it out.
+'''
+def select_pages(pdf, threshold=DEFAULT_THRESHOLD):
+    texts = page_texts(pdf)
+    if not texts:
+        return []
+    selected = set()
+    found = set()
+    for number, text in enumerate(texts, start=1):
+        if score_page(text) >= threshold:
+            selected.add(number)
+            found |= page_headings(text)
+            following = number + 1
+            while (following <= min(len(texts), number + MAX_CONTINUATION_PAGES)
+                   and numeric_density(texts[following - 1]) >= CONTINUATION_DENSITY):
+                selected.add(following)
+                following += 1
+    if len(selected) == len(texts) or found != set(STATEMENT_TITLES):
+        return []
+    return sorted(selected)
+
+
+'''
+Splits sorted page numbers into inclusive (first, last) runs of consecutive pages, e.g. [3, 4, 5, 9] ->
+[(3, 5), (9, 9)].
+'''
+def page_runs(pages):
+    runs = []
+    for page in pages:
+        if runs and page == runs[-1][1] + 1:
+            runs[-1][1] = page
+        else:
+            runs.append([page, page])
+    return [tuple(run) for run in runs]
+
+
+'''
+Formats page numbers the way Azure's pages option expects them, e.g. [3, 4, 5, 9] -> "3-5,9".
+'''
+def format_page_ranges(pages):
+    return ",".join(str(start) if start == end else f"{start}-{end}" for start, end in page_runs(pages))
@@ -2,8 +2,26 @@
 Set up a class to handle structured output form OpenAI models
 '''
 
+import os
+from enum import Enum
+from typing import List, Optional
+
 from pydantic import BaseModel
 
+_prompt_cache = {}
+
+'''
+Reads a prompt file, keeping its contents in memory until the file changes on disk.
+'''
+def load_prompt(path):
+    mtime = os.stat(path).st_mtime_ns
+    cached = _prompt_cache.get(path)
+    if cached is None or cached[0] != mtime:
+        with open(path, 'r') as f:
+            cached = (mtime, f.read())
+        _prompt_cache[path] = cached
+    return cached[1]
+
 class FinancialStatementExtract(BaseModel):
     Income_statement_millions: str
     Revenue_Item_1: str
@@ -117,3 +135,301 @@ class FinancialStatementExtract(BaseModel):
 
     Shareholder_Equity: str
     Total_Liabilities_And_Shareholders_Equities: str
+
+'''
+The same fields split by statement section, so each section can be extracted by its own structured-output
+call. Fields that FinancialStatementExtract declares twice live in the section where they first appear, which is
+the declaration the flat model keeps.
+'''
+
+class IncomeStatementSection(BaseModel):
+    Income_statement_millions: str
+    Revenue_Item_1: str
+    Revenue_Item_2: str
+    Revenue_Item_3: str
+    Sales: str
+
+    Cost_of_Sales: str
+    Selling_General_and_Administrative: str
+    Cost_Item_1: str
+    Cost_Item_2: str
+    Cost_Item_3: str
+    Operating_Income: str
+
+    Interest_Expense: str
+    Other_Income_expense_net: str
+    Provision_for_Income_Tax: str
+    Earnings_from_Discontinued_Operations: str
+    Net_Income: str
+
+
+class AdjustedEBITDASection(BaseModel):
+    Adjusted_Operating_Income: str
+    Income_Taxes: str
+    Depreciation_Amortization: str
+    Adjustment_1: str
+    Adjustment_2: str
+    Adjustment_3: str
+    Adjustment_4: str
+    Adjusted_EBITDA: str
+    Cash_Adjustments: str
+
+
+class CashFlowSection(BaseModel):
+    Cash_Flow_Statement: str
+    Operating_Activities: str
+    Depreciation_and_Amortization: str
+    Operating_Activity_1: str
+    Operating_Activity_2: str
+    Operating_Activity_3: str
+    Operating_Activity_4: str
+    Operating_Activity_5: str
+    Operating_Activity_6: str
+    Change_in_Working_Capital: str
+    Cash_Flow_From_Operating_Activities: str
+
+    Capital_Expenditures: str
+    Activity_1: str
+    Activity_2: str
+    Activity_3: str
+    Cash_Flow_From_Investing_Activities: str
+
+    Borrowings_net: str
+    Shortterm_Borrowings_from_Parent_Net: str
+    Related_Party_Loans_Net: str
+    Debt_Issuance_Costs: str
+    Net_Transfer_to_Parent: str
+    Dividends: str
+    Other: str
+    Cash_Flow_From_Financing_Activities: str
+
+    Foreign_Exchange_Rate_Effect_on_Cash_and_Cash_Equivalents: str
+    Discontinued_Operations_Cash_Flows: str
+    Discontinued_Operations_Cash_Balance: str
+    Change_In_Cash_Cash_Equiv: str
+    Cash_And_Cash_Equivalents_Beginning_Of_Period: str
+    Cash_And_Cash_Equivalents_End_Of_Period: str
+
+
+class WorkingCapitalSection(BaseModel):
+    Working_Capital: str
+    Accounts_Receivable: str
+    Inventories: str
+    Prepaid_Expenses_and_Other_Current_Assets: str
+    Accounts_Payable: str
+    Accrued_Expenses: str
+    Due_From_Due_to_Related_Party: str
+    Income_Taxes_Payables: str
+    Others: str
+
+
+class BalanceSheetSection(BaseModel):
+    Current_Assets: str
+    Cash_and_Cash_Equivalents: str
+    Accounts_Receivables: str
+    Other_Current_Assets: str
+    Current_Assets_of_Discontinued_Operations: str
+    Total_Current_Assets: str
+
+    Property_Plant_and_Equipment_Net: str
+    Goodwill: str
+    Other_Intangiblesnet: str
+    Other_Assets: str
+    Noncurrent_Assets_of_Discontinued_Operations: str
+    Total_Assets: str
+
+    Current_Liabilities: str
+    Trade_Accounts_Payable: str
+    Accrued_and_Other_Current_Liabilities: str
+    Due_to_Related_Party: str
+    Income_Taxes_Payable: str
+    Current_Liabilities_of_Discontinued_Operations: str
+    Current_Portion_of_Debt: str
+    Total_Current_Liabilities: str
+
+    Long_Term_Debt: str
+    Deferred_Income_Taxes: str
+    Other_Noncurrent_Liabilities: str
+    Noncurrent_Liabilities_of_Discontinued_Operation: str
+    Total_Liabilities: str
+
+    Shareholder_Equity: str
+    Total_Liabilities_And_Shareholders_Equities: str
+
+
+'''
+Typed schema. Every metric is a list of numbers, one per reporting period in the order of `periods`, with
+null where the filing has no value. Currency and scale are explicit, and metrics are grouped under their section,
+so names such as income_statement.Net_Income and cash_flow.Net_Income no longer collide.
+'''
+
+Values = List[Optional[float]]
+
+
+class Scale(str, Enum):
+    units = "units"
+    thousands = "thousands"
+    millions = "millions"
+    billions = "billions"
+
+
+class StatementContext(BaseModel):
+    currency: str
+    scale: Scale
+    periods: List[str]
+
+
+class IncomeStatementValues(BaseModel):
+    Revenue_Item_1: Values
+    Revenue_Item_2: Values
+    Revenue_Item_3: Values
+    Sales: Values
+
+    Cost_of_Sales: Values
+    Selling_General_and_Administrative: Values
+    Cost_Item_1: Values
+    Cost_Item_2: Values
+    Cost_Item_3: Values
+    Operating_Income: Values
+
+    Interest_Expense: Values
+    Other_Income_expense_net: Values
+    Provision_for_Income_Tax: Values
+    Earnings_from_Discontinued_Operations: Values
+    Net_Income: Values
+
+
+class AdjustedEBITDAValues(BaseModel):
+    Net_Income: Values
+    Interest_Expense: Values
+    Income_Taxes: Values
+    Depreciation_Amortization: Values
+    Adjusted_Operating_Income: Values
+
+    Adjustment_1: Values
+    Adjustment_2: Values
+    Adjustment_3: Values
+    Adjustment_4: Values
+    Adjusted_EBITDA: Values
+    Cash_Adjustments: Values
+
+
+class CashFlowValues(BaseModel):
+    Net_Income: Values
+    Depreciation_and_Amortization: Values
+    Operating_Activity_1: Values
+    Operating_Activity_2: Values
+    Operating_Activity_3: Values
+    Operating_Activity_4: Values
+    Operating_Activity_5: Values
+    Operating_Activity_6: Values
+    Change_in_Working_Capital: Values
+    Cash_Flow_From_Operating_Activities: Values
+
+    Capital_Expenditures: Values
+    Activity_1: Values
+    Activity_2: Values
+    Activity_3: Values
+    Cash_Flow_From_Investing_Activities: Values
+
+    Borrowings_net: Values
+    Shortterm_Borrowings_from_Parent_Net: Values
+    Related_Party_Loans_Net: Values
+    Debt_Issuance_Costs: Values
+    Net_Transfer_to_Parent: Values
+    Dividends: Values
+    Other: Values
+    Cash_Flow_From_Financing_Activities: Values
+
+    Foreign_Exchange_Rate_Effect_on_Cash_and_Cash_Equivalents: Values
+    Discontinued_Operations_Cash_Flows: Values
+    Discontinued_Operations_Cash_Balance: Values
+    Change_In_Cash_Cash_Equiv: Values
+    Cash_And_Cash_Equivalents_Beginning_Of_Period: Values
+    Cash_And_Cash_Equivalents_End_Of_Period: Values
+
+
+class WorkingCapitalValues(BaseModel):
+    Accounts_Receivable: Values
+    Inventories: Values
+    Prepaid_Expenses_and_Other_Current_Assets: Values
+    Accounts_Payable: Values
+    Accrued_Expenses: Values
+    Due_From_Due_to_Related_Party: Values
+    Income_Taxes_Payables: Values
+    Others: Values
+    Change_in_Working_Capital: Values
+
+
+class BalanceSheetValues(BaseModel):
+    Cash_and_Cash_Equivalents: Values
+    Accounts_Receivables: Values
+    Inventories: Values
+    Other_Current_Assets: Values
+    Current_Assets_of_Discontinued_Operations: Values
+    Total_Current_Assets: Values
+
+    Property_Plant_and_Equipment_Net: Values
+    Goodwill: Values
+    Other_Intangiblesnet: Values
+    Other_Assets: Values
+    Noncurrent_Assets_of_Discontinued_Operations: Values
+    Total_Assets: Values
+
+    Trade_Accounts_Payable: Values
+    Accrued_and_Other_Current_Liabilities: Values
+    Due_to_Related_Party: Values
+    Income_Taxes_Payable: Values
+    Current_Liabilities_of_Discontinued_Operations: Values
+    Current_Portion_of_Debt: Values
+    Total_Current_Liabilities: Values
+
+    Long_Term_Debt: Values
+    Deferred_Income_Taxes: Values
+    Other_Noncurrent_Liabilities: Values
+    Noncurrent_Liabilities_of_Discontinued_Operation: Values
+    Total_Liabilities: Values
+
+    Shareholder_Equity: Values
+    Total_Liabilities_And_Shareholders_Equities: Values
+
+
+'''
+Structured-output models for the per-section calls: the section's values plus the periods, currency and scale
+they are reported in.
+'''
+
+class IncomeStatementResult(StatementContext):
+    income_statement: IncomeStatementValues
+
+
+class AdjustedEBITDAResult(StatementContext):
+    adjusted_ebitda: AdjustedEBITDAValues
+
+
+class CashFlowResult(StatementContext):
+    cash_flow: CashFlowValues
+
+
+class WorkingCapitalResult(StatementContext):
+    working_capital: WorkingCapitalValues
+
+
+class BalanceSheetResult(StatementContext):
+    balance_sheet: BalanceSheetValues
+
+
+class TypedFinancialStatementExtract(StatementContext):
+    income_statement: IncomeStatementValues
+    adjusted_ebitda: AdjustedEBITDAValues
+    cash_flow: CashFlowValues
+    working_capital: WorkingCapitalValues
+    balance_sheet: BalanceSheetValues
+
+
+'''
+A typed extract the run's deadline (deadlines.py) cut short: the sections named in missing did not answer in time
+and are all null.
+'''
+class PartialTypedFinancialStatementExtract(TypedFinancialStatementExtract):
+    missing: List[str]
@@ -0,0 +1,181 @@
+'''
+Compact table encoding and token budgeting for prompts. Table texts (TableGrid.to_text rows or Docling markdown)
+are re-encoded before they go into a prompt: amounts are normalized ("$ 1,234" -> "1234", "(56)" -> "-56"),
+currency cells and columns that are empty in every row are dropped, header rows repeated further down a table
+(tables continued over several pages) are removed and markdown padding and alignment rows are replaced by tabs.
+The stripped currency symbols are kept as one "Currency: USD" line per table.
+
+Prompts are then held to a token budget, counted locally for the target model (tokens.py): the smaller of
+PROMPT_TOKEN_BUDGET and the model's context window less the answer, minus the instructions. Tables that do not
+fit are split into chunks, each of which fits on its own; oversized tables are split between rows and every
+piece repeats the table's caption and header rows. The parsers send one call per chunk and merge the answers.
+'''
+
+import os
+
+from instrumentation import REGISTRY
+from label_matching import CURRENCY_SYMBOLS, DASHES, YEAR, parse_amount, table_rows
+from resilience import OUTPUT_TOKENS_ESTIMATE
+from tokens import DEFAULT_MODEL, count_tokens
+
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", 24000))
+# a chunk always gets at least this many tokens of tables, however long the instructions are
+MIN_CHUNK_TOKENS = 512
+
+# context windows by model name prefix; the longest matching prefix wins
+CONTEXT_WINDOWS = {
+    "gpt-3.5-turbo": 16385,
+    "gpt-4": 8192,
+    "gpt-4-32k": 32768,
+    "gpt-4-turbo": 128000,
+    "gpt-4-1106": 128000,
+    "gpt-4-0125": 128000,
+    "gpt-4o": 128000,
+    "gpt-4.1": 1047576,
+}
+DEFAULT_CONTEXT_WINDOW = 128000
+
+CHUNKED_PROMPTS = REGISTRY.counter("prompt_chunks_total",
+                                   "Chunks sent for prompts split to fit the token budget.", ["model"])
+
+
+def context_window(model):
+    prefixes = [prefix for prefix in CONTEXT_WINDOWS if model.startswith(prefix)]
+    return CONTEXT_WINDOWS[max(prefixes, key=len)] if prefixes else DEFAULT_CONTEXT_WINDOW
+
+
+'''
+Tokens left for tables in a prompt to model whose other text (instructions, system message) is fixed_text.
+'''
+def token_budget(model, fixed_text=""):
+    budget = min(PROMPT_TOKEN_BUDGET, context_window(model) - OUTPUT_TOKENS_ESTIMATE)
+    return max(MIN_CHUNK_TOKENS, budget - count_tokens(fixed_text, model))
+
+
+def _is_row(line):
+    return line.lstrip().startswith("|") or "\t" in line
+
+
+'''
+Normalizes one cell. Returns (cell, currency symbol or None): amounts lose currency symbols, spaces and thousands
+separators and parentheses become a minus sign; dashes become "-" and a cell holding only a symbol becomes empty.
+'''
+def normalize_cell(cell):
+    text = " ".join(cell.split())
+    symbol = next((symbol for symbol in CURRENCY_SYMBOLS if symbol in text), None)
+    if text in CURRENCY_SYMBOLS:
+        return "", symbol
+    if text in DASHES:
+        return "-", None
+    value = parse_amount(text) if any(c.isdigit() for c in text) else None
+    if value is None:
+        return text, None
+    return (str(int(value)) if value.is_integer() else str(value)), symbol
+
+
+def _is_body(row):
+    '''A row with a label and an amount that is not a year: the header rows end before the first one.'''
+    return bool(row[0]) and any(cell and cell != "-" and not YEAR.fullmatch(cell) and parse_amount(cell) is not None
+                                for cell in row[1:])
+
+
+def _is_body_line(line):
+    rows = table_rows(line)
+    return bool(rows) and _is_body(rows[0])
+
+
+def _header_length(rows):
+    return next((i for i, row in enumerate(rows) if _is_body(row)), len(rows))
+
+
+def _compact_rows(rows):
+    symbols = set()
+    normalized = []
+    for row in rows:
+        cells = []
+        for cell in row:
+            cell, symbol = normalize_cell(cell)
+            cells.append(cell)
+            if symbol:
+                symbols.add(symbol)
+        if any(cells):
+            normalized.append(cells)
+    if not normalized:
+        return ""
+
+    width = max(len(row) for row in normalized)
+    normalized = [row + [""] * (width - len(row)) for row in normalized]
+    header = normalized[:_header_length(normalized)]
+    kept = list(header)
+    for row in normalized[len(header):]:
+        if row not in header and (not kept or row != kept[-1]):
+            kept.append(row)
+
+    columns = [i for i in range(width) if any(row[i] for row in kept)]
+    lines = ["\t".join(row[i] for i in columns).rstrip("\t") for row in kept]
+    if symbols:
+        lines.insert(0, "Currency: " + ", ".join(sorted(CURRENCY_SYMBOLS[symbol] for symbol in symbols)))
+    return "\n".join(lines)
+
+
+'''
+Re-encodes a table text compactly (see the module docstring). Caption lines are kept without their markdown
+heading marks; a text holding several tables (e.g. pruned Docling markdown) is encoded table by table.
+'''
+def compact_table(text):
+    parts, block = [], []
+    for line in text.splitlines() + [""]:
+        if _is_row(line):
+            block.append(line)
+            continue
+        if block:
+            parts.append(_compact_rows(table_rows("\n".join(block))))
+            block = []
+        if line.strip():
+            parts.append(line.strip().lstrip("#").strip())
+    return "\n".join(part for part in parts if part)
+
+
+'''
+Splits a table text that does not fit budget between rows. Every piece starts with the table's caption lines and
+header rows; a single row longer than the budget becomes a piece of its own.
+'''
+def split_table(table, budget, model=DEFAULT_MODEL):
+    if count_tokens(table, model) <= budget:
+        return [table]
+    lines = table.splitlines()
+    head = next((i for i, line in enumerate(lines) if _is_body_line(line)), 0)
+    header = "\n".join(lines[:head])
+    header_tokens = count_tokens(header, model) if header else 0
+
+    pieces, piece, used = [], [], header_tokens
+    for line in lines[head:]:
+        tokens = count_tokens(line, model) + 1
+        if piece and used + tokens > budget:
+            pieces.append(piece)
+            piece, used = [], header_tokens
+        piece.append(line)
+        used += tokens
+    if piece:
+        pieces.append(piece)
+    return ["\n".join(([header] if header else []) + piece) for piece in pieces]
+
+
+'''
+Packs table texts, in order, into chunks of at most budget tokens. Returns a list of chunks (lists of table
+texts); a single chunk when everything fits.
+'''
+def chunk_tables(tables, budget, model=DEFAULT_MODEL):
+    chunks, chunk, used = [], [], 0
+    for table in tables:
+        for piece in split_table(table, budget, model):
+            tokens = count_tokens(piece, model) + 1
+            if chunk and used + tokens > budget:
+                chunks.append(chunk)
+                chunk, used = [], 0
+            chunk.append(piece)
+            used += tokens
+    chunks.append(chunk)
+    if len(chunks) > 1:
+        CHUNKED_PROMPTS.inc(len(chunks), model=model)
+    return chunks
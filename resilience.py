@@ -0,0 +1,724 @@
+'''
+Rate limiting, retries and circuit breaking for the Azure and OpenAI calls. Every request goes through a Backend:
+
+- a RateLimiter with token buckets for requests per minute and (for OpenAI) tokens per minute. Bucket state is
+  kept in one SQLite file, so every thread and process of a batch run or web server draws from the same quota
+  and throughput stays just under the ceiling instead of bouncing off it;
+- retries of 429s, 5xx and connection errors with jittered exponential backoff. A Retry-After header pauses the
+  whole shared bucket, not just the thread that got it;
+- a per-backend CircuitBreaker that fails fast while the service is down;
+- for the async pipeline (call_async), a bounded semaphore per backend on the requests in flight;
+- typed failures (RateLimited, BackendUnavailable, CircuitOpen, RequestFailed) raised once retries are exhausted,
+  so callers fail the document instead of writing an empty workbook;
+- the run's deadline (deadlines.py): no attempt, retry or rate-limit wait runs past it (DeadlineExceeded), and an
+  OpenAI request gets the time left as its timeout;
+- hedged OpenAI requests: a request that has not answered after the HEDGE_PERCENTILE latency of its model's
+  recent requests is sent a second time, and the first valid answer wins. The async loser is cancelled; a
+  thread cannot be interrupted, so the sync loser is left to finish (its usage is still recorded) and its answer
+  dropped.
+
+Quotas are set with OPENAI_REQUESTS_PER_MINUTE, OPENAI_TOKENS_PER_MINUTE and AZURE_REQUESTS_PER_MINUTE (0 turns a
+limit off) and should match the deployment's quota. LLM_HEDGE_PERCENTILE sets the hedging threshold (0 turns
+hedging off); a model is hedged once LLM_HEDGE_MIN_SAMPLES of its requests have been timed.
+'''
+
+import asyncio
+import contextvars
+import math
+import os
+import queue
+import random
+import sqlite3
+import threading
+import time
+import weakref
+from collections import deque
+from email.utils import parsedate_to_datetime
+
+import deadlines
+from instrumentation import REGISTRY, current_trace, record_llm_usage, stage
+from tokens import count_tokens
+
+DEFAULT_PATH = os.getenv("RATE_LIMIT_PATH", os.path.join(".cache", "rate_limits.sqlite"))
+OPENAI_REQUESTS_PER_MINUTE = float(os.getenv("OPENAI_REQUESTS_PER_MINUTE", 500))
+OPENAI_TOKENS_PER_MINUTE = float(os.getenv("OPENAI_TOKENS_PER_MINUTE", 300000))
+AZURE_REQUESTS_PER_MINUTE = float(os.getenv("AZURE_REQUESTS_PER_MINUTE", 900))
+MAX_ATTEMPTS = int(os.getenv("BACKEND_MAX_ATTEMPTS", 6))
+# bounds on concurrent requests from the async pipeline, per backend and event loop
+OPENAI_MAX_IN_FLIGHT = int(os.getenv("OPENAI_MAX_IN_FLIGHT", 64))
+AZURE_MAX_IN_FLIGHT = int(os.getenv("AZURE_MAX_IN_FLIGHT", 32))
+# reserved per request for the completion until the response reports the real usage
+OUTPUT_TOKENS_ESTIMATE = int(os.getenv("OPENAI_OUTPUT_TOKENS_ESTIMATE", 1500))
+HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", 0.9))
+HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", 20))
+HEDGE_WINDOW = int(os.getenv("LLM_HEDGE_WINDOW", 500))
+
+RETRYABLE_STATUSES = {408, 409, 429}
+# connection errors of the OpenAI and Azure SDKs carry no status code; matched by name so neither SDK is imported
+RETRYABLE_ERRORS = {"APIConnectionError", "APITimeoutError", "ServiceRequestError", "ServiceResponseError",
+                    "ConnectionError", "TimeoutError"}
+
+
+class BackendError(Exception):
+    '''A call that failed for good. kind is the class' short name, attempts how many calls were made.'''
+
+    kind = "failed"
+
+    def __init__(self, backend, message, attempts=0, status=None):
+        super().__init__(f"[{backend}] {self.kind} after {attempts} attempt(s): {message}")
+        self.backend = backend
+        self.attempts = attempts
+        self.status = status
+
+
+class RateLimited(BackendError):
+    kind = "rate_limited"
+
+
+class BackendUnavailable(BackendError):
+    kind = "unavailable"
+
+
+class CircuitOpen(BackendError):
+    kind = "circuit_open"
+
+
+class RequestFailed(BackendError):
+    '''The backend rejected the request itself (bad request, authentication, content filter); not retried.'''
+    kind = "request_failed"
+
+
+class DeadlineExceeded(BackendError):
+    '''The run's deadline passed before the call answered, or would have during a retry or rate-limit wait.'''
+    kind = "deadline_exceeded"
+
+
+HEDGED_REQUESTS = REGISTRY.counter("llm_hedged_requests_total",
+                                   "OpenAI requests sent a second time, by the copy whose answer was used.",
+                                   ["model", "winner"])
+
+
+'''
+Raises DeadlineExceeded when waiting wait more seconds would run past the current deadline (at once when it has
+passed). name and attempts describe the call for the error.
+'''
+def check_deadline(name, wait=0.0, attempts=0):
+    left = deadlines.remaining()
+    if left is not None and wait >= left:
+        raise DeadlineExceeded(name, f"{left:.2f}s left before the deadline, {wait:.2f}s to wait", attempts)
+
+
+class TokenBucket:
+    '''
+    A bucket refilled at per_minute tokens per minute up to capacity (one minute's worth by default). The state
+    lives in a SQLite row, so buckets with the same name and path are shared between threads and processes.
+    '''
+
+    def __init__(self, name, per_minute, capacity=None, path=DEFAULT_PATH):
+        self.name = name
+        self.rate = per_minute / 60.0
+        self.capacity = capacity or per_minute
+        self.path = path
+        if not self.enabled:
+            return
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS buckets ("
+                "name TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL, blocked_until REAL NOT NULL)"
+            )
+            conn.execute("INSERT OR IGNORE INTO buckets VALUES (?, ?, ?, 0)", (name, self.capacity, time.time()))
+
+    @property
+    def enabled(self):
+        return self.rate > 0
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    def _update(self, change):
+        '''Refills the bucket, applies change(tokens, blocked_until, now) -> (tokens, blocked_until, result).'''
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                tokens, updated, blocked_until = conn.execute(
+                    "SELECT tokens, updated, blocked_until FROM buckets WHERE name = ?", (self.name,)).fetchone()
+                now = time.time()
+                tokens = min(self.capacity, tokens + max(0.0, now - updated) * self.rate)
+                tokens, blocked_until, result = change(tokens, blocked_until, now)
+                conn.execute("UPDATE buckets SET tokens = ?, updated = ?, blocked_until = ? WHERE name = ?",
+                             (tokens, now, blocked_until, self.name))
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return result
+
+    def _try_take(self, amount):
+        # requests larger than the bucket go through once it is full, leaving it in debt
+        needed = min(amount, self.capacity)
+
+        def change(tokens, blocked_until, now):
+            if now < blocked_until:
+                return tokens, blocked_until, blocked_until - now
+            if tokens >= needed:
+                return tokens - amount, blocked_until, 0.0
+            return tokens, blocked_until, (needed - tokens) / self.rate
+        return self._update(change)
+
+    def acquire(self, amount=1):
+        '''Blocks until amount tokens are available and takes them. Returns the seconds spent waiting.'''
+        if not self.enabled or amount <= 0:
+            return 0.0
+        waited = 0.0
+        while True:
+            wait = self._try_take(amount)
+            if wait <= 0:
+                return waited
+            check_deadline(self.name, wait)
+            wait = min(wait, 5.0)  # re-check: other processes may have been paused or refunded meanwhile
+            time.sleep(wait)
+            waited += wait
+
+    async def acquire_async(self, amount=1):
+        '''Same as acquire, but waits without blocking the event loop; the SQLite update runs on a thread.'''
+        if not self.enabled or amount <= 0:
+            return 0.0
+        waited = 0.0
+        while True:
+            wait = await asyncio.to_thread(self._try_take, amount)
+            if wait <= 0:
+                return waited
+            check_deadline(self.name, wait)
+            wait = min(wait, 5.0)
+            await asyncio.sleep(wait)
+            waited += wait
+
+    def adjust(self, amount):
+        '''Takes (or with a negative amount, returns) tokens without waiting, e.g. to settle an estimate.'''
+        if self.enabled and amount:
+            self._update(lambda tokens, blocked_until, now: (tokens - amount, blocked_until, None))
+
+    def block(self, seconds):
+        '''Pauses every user of the bucket for seconds, e.g. when the service answered with Retry-After.'''
+        if self.enabled and seconds > 0:
+            self._update(lambda tokens, blocked_until, now: (tokens, max(blocked_until, now + seconds), None))
+
+
+class RateLimiter:
+
+    def __init__(self, name, requests_per_minute, tokens_per_minute=0, path=DEFAULT_PATH):
+        self.requests = TokenBucket(f"{name}:requests", requests_per_minute, path=path)
+        self.tokens = TokenBucket(f"{name}:tokens", tokens_per_minute, path=path)
+
+    def acquire(self, tokens=0):
+        waited = self.requests.acquire(1)
+        try:
+            return waited + self.tokens.acquire(tokens)
+        except DeadlineExceeded:
+            self.requests.adjust(-1)  # the request is not made
+            raise
+
+    async def acquire_async(self, tokens=0):
+        waited = await self.requests.acquire_async(1)
+        try:
+            return waited + await self.tokens.acquire_async(tokens)
+        except DeadlineExceeded:
+            await asyncio.to_thread(self.requests.adjust, -1)
+            raise
+
+    def settle(self, estimated, actual):
+        '''Corrects the tokens bucket once a response reports how many tokens the request really used.'''
+        if actual is not None:
+            self.tokens.adjust(actual - estimated)
+
+    def block(self, seconds):
+        self.requests.block(seconds)
+        self.tokens.block(seconds)
+
+
+class CircuitBreaker:
+    '''
+    Opens after failure_threshold consecutive failures and rejects calls for reset_timeout seconds. After that a
+    single trial call is let through; its success closes the circuit, its failure opens it again.
+    '''
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                return
+            raise CircuitOpen(self.name, f"circuit open after {self.failures} consecutive failures")
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_abandoned(self):
+        '''A call given up without an answer; a half-open circuit opens again until the next trial.'''
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+
+def status_code(error):
+    status = getattr(error, "status_code", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    return status if isinstance(status, int) else None
+
+
+'''
+Seconds to wait according to the error's Retry-After (or retry-after-ms) header, or None without one.
+'''
+def retry_after(error):
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if not headers:
+        return None
+    value = headers.get("retry-after-ms")
+    if value is not None:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def is_retryable(error):
+    status = status_code(error)
+    if status is not None:
+        return status in RETRYABLE_STATUSES or status >= 500
+    return any(cls.__name__ in RETRYABLE_ERRORS for cls in type(error).__mro__)
+
+
+class Backend:
+
+    def __init__(self, name, limiter, breaker=None, max_attempts=MAX_ATTEMPTS, base_delay=1.0, max_delay=60.0,
+                 max_in_flight=64):
+        self.name = name
+        self.limiter = limiter
+        self.breaker = breaker or CircuitBreaker(name)
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_in_flight = max_in_flight
+        self._semaphores = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+        self.counters = {"calls": 0, "retries": 0, "throttled": 0, "failures": 0, "deadline_exceeded": 0,
+                         "wait_seconds": 0.0}
+
+    def _count(self, **deltas):
+        with self._lock:
+            for name, delta in deltas.items():
+                self.counters[name] += delta
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, circuit=self.breaker.state)
+
+    def _retry_delay(self, error, attempt):
+        '''
+        Handles a failed attempt: raises a BackendError subclass once the call cannot succeed, otherwise returns the
+        seconds to wait before the next attempt.
+        '''
+        status = status_code(error)
+        if not is_retryable(error):
+            # a rejected request is not retried
+            self._count(failures=1)
+            raise RequestFailed(self.name, str(error), attempt, status) from error
+        if status == 429:
+            self._count(throttled=1)
+        if attempt == self.max_attempts:
+            self._count(failures=1)
+            kind = RateLimited if status == 429 else BackendUnavailable
+            raise kind(self.name, str(error), attempt, status) from error
+        self._count(retries=1)
+        wait = retry_after(error)
+        if wait is not None and status == 429 and self.limiter.requests.enabled:
+            self.limiter.block(wait)  # the next acquire() waits it out, in every worker
+            return 0.0
+        if wait is not None:
+            return min(wait, self.max_delay)
+        # full jitter keeps workers that failed together from retrying together
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+    def _settle(self, error=None, answered=False):
+        '''
+        Reports how an attempt ended to the circuit breaker, closing a half-open circuit or opening it again: an
+        answer from the backend, including a rejection or a 429, is a success and a 5xx or connection error a
+        failure. An attempt cancelled or cut short by the run's deadline before the backend answered says nothing
+        about its health; it only sends a half-open circuit back to open, so a later call gets the trial.
+        '''
+        if answered:
+            self.breaker.record_success()
+        elif error is None or isinstance(error, BackendError):
+            # cancelled (e.g. a hedged request's loser) or given up on this side, such as a rate-limit wait past
+            # the deadline
+            self.breaker.record_abandoned()
+        elif (status_code(error) or 0) in range(1, 500) or not is_retryable(error):
+            self.breaker.record_success()
+        elif deadlines.expired():
+            self.breaker.record_abandoned()
+        else:
+            self.breaker.record_failure()
+
+    def _check_deadline(self, attempts, wait=0.0, error=None):
+        '''check_deadline for this backend; error is the failure of the attempt that ran into the deadline.'''
+        try:
+            check_deadline(self.name, wait, attempts)
+        except DeadlineExceeded:
+            self._count(deadline_exceeded=1)
+            if error is not None:
+                raise DeadlineExceeded(self.name, str(error), attempts) from error
+            raise
+
+    def _acquire(self, tokens):
+        try:
+            return self.limiter.acquire(tokens)
+        except DeadlineExceeded:
+            self._count(deadline_exceeded=1)
+            raise
+
+    async def _acquire_async(self, tokens):
+        try:
+            return await self.limiter.acquire_async(tokens)
+        except DeadlineExceeded:
+            self._count(deadline_exceeded=1)
+            raise
+
+    def call(self, fn, *args, tokens=0, **kwargs):
+        '''
+        Calls fn(*args, **kwargs) within the rate limits, retrying transient failures. tokens is the estimated
+        token cost of the request. Raises a BackendError subclass once the call cannot succeed, and
+        DeadlineExceeded instead of starting an attempt or a wait the current deadline would cut short.
+        '''
+        for attempt in range(1, self.max_attempts + 1):
+            self._check_deadline(attempt - 1)
+            self.breaker.before_call()
+            # every attempt let through settles the breaker, or a half-open circuit would never leave that state
+            error, answered = None, False
+            try:
+                self._count(calls=1, wait_seconds=self._acquire(tokens))
+                result = fn(*args, **kwargs)
+                answered = True
+            except BackendError as e:
+                error = e
+                raise
+            except Exception as e:
+                error = e
+            finally:
+                self._settle(error, answered)
+            if answered:
+                return result
+            self._check_deadline(attempt, error=error)
+            delay = self._retry_delay(error, attempt)
+            self._check_deadline(attempt, delay)
+            time.sleep(delay)
+
+    def _semaphore(self):
+        '''The bound on in-flight async calls, one per event loop (asyncio primitives are bound to a loop).'''
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if loop not in self._semaphores:
+                self._semaphores[loop] = asyncio.BoundedSemaphore(self.max_in_flight)
+            return self._semaphores[loop]
+
+    async def call_async(self, fn, *args, tokens=0, **kwargs):
+        '''
+        Same as call for a coroutine function: awaits fn(*args, **kwargs) with at most max_in_flight calls of this
+        backend in flight. Waiting for the rate limits and between retries does not block the event loop.
+        '''
+        for attempt in range(1, self.max_attempts + 1):
+            self._check_deadline(attempt - 1)
+            self.breaker.before_call()
+            error, answered = None, False
+            try:
+                self._count(calls=1, wait_seconds=await self._acquire_async(tokens))
+                async with self._semaphore():
+                    result = await fn(*args, **kwargs)
+                answered = True
+            except BackendError as e:
+                error = e
+                raise
+            except Exception as e:
+                error = e
+            finally:
+                self._settle(error, answered)
+            if answered:
+                return result
+            self._check_deadline(attempt, error=error)
+            delay = self._retry_delay(error, attempt)
+            self._check_deadline(attempt, delay)
+            await asyncio.sleep(delay)
+
+
+'''
+Estimated token cost of a chat request: the prompt plus OUTPUT_TOKENS_ESTIMATE for the answer.
+'''
+def request_tokens(messages, model):
+    return sum(count_tokens(message["content"], model) for message in messages) + OUTPUT_TOKENS_ESTIMATE
+
+
+class LatencyTracker:
+    '''The latencies of the last window answered requests per model, from which the hedging threshold is taken.'''
+
+    def __init__(self, window=HEDGE_WINDOW):
+        self.window = window
+        self._latencies = {}
+        self._lock = threading.Lock()
+
+    def observe(self, model, seconds):
+        with self._lock:
+            self._latencies.setdefault(model, deque(maxlen=self.window)).append(seconds)
+
+    def percentile(self, model, q):
+        '''The q-quantile of the model's recent latencies, or None with fewer than HEDGE_MIN_SAMPLES of them.'''
+        with self._lock:
+            latencies = sorted(self._latencies.get(model, ()))
+        if not latencies or len(latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        return latencies[max(0, min(len(latencies), math.ceil(q * len(latencies))) - 1)]  # nearest rank
+
+
+LATENCIES = LatencyTracker()
+
+
+def hedge_delay(model):
+    '''Seconds after which a request to model is hedged, or None while it is not.'''
+    if HEDGE_PERCENTILE <= 0:
+        return None
+    return LATENCIES.percentile(model, HEDGE_PERCENTILE)
+
+
+def _record_hedge(model, winner):
+    HEDGED_REQUESTS.inc(model=model, winner=winner)
+    trace = current_trace()
+    if trace is not None:
+        trace.add("hedged_requests", 1)
+
+
+def _answered(response):
+    return True
+
+
+'''
+Runs request() and, if it has not answered after hedge_delay(model) seconds, a second request() alongside it on
+threads of their own. Returns the first answer valid(answer) accepts; when none is, the last answer (or raises the
+last error). The loser is not waited for.
+'''
+def _hedged(request, model, valid):
+    delay = hedge_delay(model)
+    if delay is None:
+        return request()
+    answers = queue.SimpleQueue()
+
+    def run(copy):
+        try:
+            answers.put((copy, request(), None))
+        except Exception as e:
+            answers.put((copy, None, e))
+
+    def start(copy):
+        # in a copy of the caller's context, to keep the document's trace and deadline
+        threading.Thread(target=contextvars.copy_context().run, args=(run, copy), name=f"llm-{copy}",
+                         daemon=True).start()
+
+    start("primary")
+    copies = 1
+    for answered in range(1, 3):
+        while True:
+            timeout = deadlines.remaining()
+            if copies == 1:
+                timeout = delay if timeout is None else min(delay, timeout)
+            try:
+                copy, response, error = answers.get(timeout=timeout)
+                break
+            except queue.Empty:
+                if copies == 1 and not deadlines.expired():
+                    start("hedge")
+                    copies = 2
+                    continue
+                raise DeadlineExceeded("openai", "no answer before the deadline", copies)
+        if error is None and valid(response):
+            if copies == 2:
+                _record_hedge(model, copy)
+            return response
+        if answered == copies:
+            if copies == 2:
+                _record_hedge(model, "none")
+            if error is not None:
+                raise error
+            return response
+
+
+'''
+Same as _hedged for a coroutine function request; the loser is cancelled.
+'''
+async def _hedged_async(request, model, valid):
+    delay = hedge_delay(model)
+    if delay is None:
+        return await request()
+    # tasks run in a copy of the current context, like the threads of _hedged
+    copies = {asyncio.ensure_future(request()): "primary"}
+    pending, last = set(copies), None
+    try:
+        while pending:
+            timeout = deadlines.remaining()
+            if len(copies) == 1:
+                timeout = delay if timeout is None else min(delay, timeout)
+            done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                if len(copies) == 1 and not deadlines.expired():
+                    hedge = asyncio.ensure_future(request())
+                    copies[hedge] = "hedge"
+                    pending.add(hedge)
+                    continue
+                raise DeadlineExceeded("openai", "no answer before the deadline", len(copies))
+            for task in done:
+                if task.exception() is None and valid(task.result()):
+                    if len(copies) == 2:
+                        _record_hedge(model, copies[task])
+                    return task.result()
+                last = task
+        if len(copies) == 2:
+            _record_hedge(model, "none")
+        return last.result()
+    finally:
+        for task in copies:
+            task.cancel()
+
+
+def _with_timeout(kwargs):
+    '''The request's keyword arguments with the time left before the current deadline as its timeout.'''
+    timeout = deadlines.remaining()
+    return kwargs if timeout is None else dict(kwargs, timeout=timeout)
+
+
+'''
+Makes an OpenAI chat request through the shared backend, settles the token estimate against the usage the
+response reports and records that usage. create is e.g. openai_client.chat.completions.create. A request that is
+slow to answer is hedged (see _hedged); valid(response) tells whether an answer can win, by default any answer
+does. A streamed response is neither hedged nor recorded: it carries its usage in the last chunk and the caller
+records it.
+'''
+def openai_request(create, model, messages, valid=_answered, **kwargs):
+    backend = openai_backend()
+    estimated = request_tokens(messages, model)
+    stream = kwargs.get("stream", False)
+
+    def request():
+        start = time.perf_counter()
+        with stage("llm_request"):
+            response = backend.call(lambda: create(model=model, messages=messages, **_with_timeout(kwargs)),
+                                    tokens=estimated)
+        if stream:
+            return response
+        LATENCIES.observe(model, time.perf_counter() - start)
+        usage = getattr(response, "usage", None)
+        backend.limiter.settle(estimated, getattr(usage, "total_tokens", None))
+        record_llm_usage(model, usage)
+        return response
+
+    return request() if stream else _hedged(request, model, valid)
+
+
+'''
+Same as openai_request for the async client, e.g. create is async_openai_client.chat.completions.create.
+'''
+async def openai_request_async(create, model, messages, valid=_answered, **kwargs):
+    backend = openai_backend()
+    estimated = request_tokens(messages, model)
+    stream = kwargs.get("stream", False)
+
+    async def request():
+        start = time.perf_counter()
+        with stage("llm_request"):
+            response = await backend.call_async(
+                lambda: create(model=model, messages=messages, **_with_timeout(kwargs)), tokens=estimated)
+        if stream:
+            return response
+        LATENCIES.observe(model, time.perf_counter() - start)
+        usage = getattr(response, "usage", None)
+        await asyncio.to_thread(backend.limiter.settle, estimated, getattr(usage, "total_tokens", None))
+        record_llm_usage(model, usage)
+        return response
+
+    return await (request() if stream else _hedged_async(request, model, valid))
+
+
+'''
+The result of an Azure long-running operation (poller.result()), waiting no longer than the current deadline.
+'''
+def poller_result(poller):
+    timeout = deadlines.remaining()
+    if timeout is None:
+        return poller.result()
+    result = poller.result(timeout=timeout)
+    if not poller.done():
+        raise DeadlineExceeded("azure", "analysis still running at the deadline")
+    return result
+
+
+async def poller_result_async(poller):
+    try:
+        return await asyncio.wait_for(poller.result(), deadlines.remaining())
+    except asyncio.TimeoutError as e:
+        raise DeadlineExceeded("azure", "analysis still running at the deadline") from e
+
+
+_backends = {}
+_backends_lock = threading.Lock()
+
+
+def _backend(name, requests_per_minute, tokens_per_minute=0, max_in_flight=64):
+    with _backends_lock:
+        if name not in _backends:
+            _backends[name] = Backend(name, RateLimiter(name, requests_per_minute, tokens_per_minute),
+                                      max_in_flight=max_in_flight)
+        return _backends[name]
+
+
+def openai_backend():
+    return _backend("openai", OPENAI_REQUESTS_PER_MINUTE, OPENAI_TOKENS_PER_MINUTE, OPENAI_MAX_IN_FLIGHT)
+
+
+def azure_backend():
+    return _backend("azure", AZURE_REQUESTS_PER_MINUTE, max_in_flight=AZURE_MAX_IN_FLIGHT)
+
+
+def backend_stats():
+    with _backends_lock:
+        backends = list(_backends.values())
+    return {backend.name: backend.stats() for backend in backends}
@@ -0,0 +1,450 @@
+'''
+Parallel per-section extraction. Instead of one structured-output call that has to generate all of
+FinancialStatementExtract, each statement section (income statement, adjusted EBITDA, cash flow, working capital,
+balance sheet) is extracted by its own call. Each call sees only its part of the prompt's bullet list and only
+the tables classified as the statements it needs. The calls run concurrently and their results are merged back
+into a FinancialStatementExtract with the usual field names, so latency follows the slowest section.
+
+With typed=True the sections use the numeric models from prompt.py instead and the results are merged into a
+TypedFinancialStatementExtract, aligned on the periods each section reported. Typed sections first go through the
+label-matching fast path (label_matching.py): fields whose rows are found in the tables are copied from them and
+only the remaining fields are asked from the LLM, with a schema and a bullet list cut down to those fields.
+
+A section whose tables do not fit the prompt token budget (prompt_budget.py) is extracted chunk by chunk, with the
+chunks' calls running concurrently, and the partial results are merged by merge_partial. The *_async variants run
+the same requests (section_request) as coroutines on the async OpenAI client.
+
+Within a run's deadline (deadlines.py) the sections are waited for no longer than the deadline; a section that
+has not answered by then is left out of the result (None) and recorded as missed on the deadline.
+'''
+
+import asyncio
+from collections import namedtuple
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+from pydantic import create_model
+
+import deadlines
+import label_matching
+from instrumentation import stage
+from llm_cache import cached_parse, cached_parse_async
+from normalize import SCALE_FACTORS, align_values, union_periods
+from prompt_budget import chunk_tables, token_budget
+from prompt import (
+    AdjustedEBITDAResult,
+    AdjustedEBITDASection,
+    BalanceSheetResult,
+    BalanceSheetSection,
+    CashFlowResult,
+    CashFlowSection,
+    FinancialStatementExtract,
+    IncomeStatementResult,
+    IncomeStatementSection,
+    PartialTypedFinancialStatementExtract,
+    Scale,
+    StatementContext,
+    TypedFinancialStatementExtract,
+    Values,
+    WorkingCapitalResult,
+    WorkingCapitalSection,
+    load_prompt,
+)
+from table_relevance import BALANCE_SHEET, CASH_FLOW, INCOME_STATEMENT, normalize_label
+
+Section = namedtuple("Section", ["name", "model", "typed_model", "statements"])
+
+SECTIONS = (
+    Section("income_statement", IncomeStatementSection, IncomeStatementResult, (INCOME_STATEMENT,)),
+    Section("adjusted_ebitda", AdjustedEBITDASection, AdjustedEBITDAResult, (INCOME_STATEMENT, CASH_FLOW)),
+    Section("cash_flow", CashFlowSection, CashFlowResult, (CASH_FLOW,)),
+    Section("working_capital", WorkingCapitalSection, WorkingCapitalResult, (CASH_FLOW, BALANCE_SHEET)),
+    Section("balance_sheet", BalanceSheetSection, BalanceSheetResult, (BALANCE_SHEET,)),
+)
+
+# headings of the bullet list in data/prompt.txt and the section each one belongs to
+PROMPT_HEADINGS = {
+    "income statement": "income_statement",
+    "adjusted operating income": "adjusted_ebitda",
+    "adjusted ebitda": "adjusted_ebitda",
+    "cash flow statement": "cash_flow",
+    "operating activities": "cash_flow",
+    "investing activities": "cash_flow",
+    "financing activities": "cash_flow",
+    "working capital": "working_capital",
+    "balance sheet": "balance_sheet",
+    "current assets": "balance_sheet",
+    "current liabilities": "balance_sheet",
+}
+TABLES_INTRO = "now im going to give you the following tables"
+
+# appended to every section prompt when the typed models are used, overriding its "Metric | Value" format
+TYPED_INSTRUCTIONS = (
+    "Fill every metric with plain numbers, one per period in the order of `periods` and null where the value is "
+    "not reported. Do not include currency symbols, thousands separators or units; amounts shown in parentheses "
+    "are negative. State the currency and the scale (units, thousands, millions or billions) the figures are "
+    "reported in."
+)
+
+
+'''
+Splits a prompt file into its preamble, the bullet blocks of each section and the closing lines that introduce
+the tables. Returns (preamble, {section: text}, closing).
+'''
+def split_prompt(prompt_text):
+    preamble, closing = [], []
+    blocks = {}
+    current = None
+    for line in prompt_text.splitlines():
+        stripped = line.strip()
+        if normalize_label(stripped).startswith(TABLES_INTRO):
+            current = "closing"
+        elif stripped.endswith(":") and not stripped.startswith("-"):
+            current = PROMPT_HEADINGS.get(normalize_label(stripped.split("(")[0]), current)
+
+        if current is None:
+            preamble.append(line)
+        elif current == "closing":
+            closing.append(line)
+        else:
+            blocks.setdefault(current, []).append(line)
+    return "\n".join(preamble), {name: "\n".join(lines) for name, lines in blocks.items()}, "\n".join(closing)
+
+
+'''
+The prompt for one section: the shared instructions, that section's bullets and the closing lines. Prompts
+without a recognizable bullet list (e.g. prompt2.txt) are used whole.
+'''
+def section_prompt(prompt_text, section_name):
+    preamble, blocks, closing = split_prompt(prompt_text)
+    if not blocks:
+        return prompt_text
+    return "\n".join(part for part in (preamble, blocks.get(section_name, ""), closing) if part)
+
+
+def _bullet_key(label):
+    label = normalize_label(label.strip().lstrip("-").strip())
+    for prefix in ("plus ", "less "):
+        if label.startswith(prefix):
+            label = label[len(prefix):]
+    return label.replace(" and ", " ").replace(" ", "")
+
+
+'''
+The prompt for the fields label matching left over: the section's headings and only the bullets of those fields,
+followed by the periods to report and the rows that are already taken.
+'''
+def residual_prompt(prompt_text, section_name, match):
+    preamble, blocks, closing = split_prompt(prompt_text)
+    wanted = {_bullet_key(field) for field in match.residual}
+    note = [f"Report exactly these periods, in this order: {', '.join(match.periods)}."]
+    if match.residual:
+        note.append("Extract only: " + ", ".join(field.replace("_", " ") for field in match.residual) + ".")
+    if match.values:
+        note.append("These rows are already extracted; do not use them for any of the items above: "
+                    + ", ".join(field.replace("_", " ") for field in match.values) + ".")
+    lines = [line for line in blocks.get(section_name, "").splitlines()
+             if line.strip() and (not line.strip().startswith("-") or _bullet_key(line) in wanted)]
+    if not blocks:
+        return prompt_text + "\n\n" + " ".join(note)
+    return "\n".join(part for part in (preamble, "\n".join(lines), " ".join(note), closing) if part)
+
+
+'''
+Structured-output model for a section's residual fields. With no residual fields it only asks for the currency,
+scale and periods.
+'''
+@lru_cache(maxsize=None)
+def residual_model(section, fields):
+    if not fields:
+        return StatementContext
+    values_model = TypedFinancialStatementExtract.model_fields[section.name].annotation
+    residual_values = create_model(f"{values_model.__name__}Residual", **{field: (Values, ...) for field in fields})
+    return create_model(f"{section.typed_model.__name__}Residual", __base__=StatementContext,
+                        **{section.name: (residual_values, ...)})
+
+
+'''
+Combines the label-matched values of a section with the LLM's answer for the residual fields (result, None when
+there was no call or it failed) into the section's typed result, in the periods and scale of the tables.
+'''
+def merge_match(section, match, result):
+    if result is None and (match.scale is None or match.currency is None):
+        return None
+    scale = match.scale or Scale(result.scale)
+    periods = match.periods
+    values_model = TypedFinancialStatementExtract.model_fields[section.name].annotation
+    values = {field: match.values.get(field, [None] * len(periods)) for field in values_model.model_fields}
+
+    residual = getattr(result, section.name, None) if result is not None else None
+    if residual is not None:
+        factor = SCALE_FACTORS[Scale(result.scale)] / SCALE_FACTORS[scale]
+        # periods named differently than in the table headers (e.g. "FY2024") are taken in the order asked for
+        result_periods = result.periods
+        if not set(result_periods) & set(periods) and len(result_periods) == len(periods):
+            result_periods = periods
+        for field, field_values in residual:
+            aligned = align_values(field_values, result_periods, periods)
+            values[field] = [None if v is None else v * factor for v in aligned]
+    return section.typed_model(currency=match.currency or result.currency, scale=scale, periods=periods,
+                               **{section.name: values_model(**values)})
+
+
+'''
+What one section asks of the LLM: its prompt, the table chunks to send with it (one call per chunk, no call at all
+when chunks is empty) and the response model. finish(result) turns the merged answer (None without one) into the
+section's result.
+'''
+SectionRequest = namedtuple("SectionRequest", ["prompt", "chunks", "response_format", "finish"])
+
+
+'''
+Builds the SectionRequest of one section: through the label-matching fast path for typed sections, otherwise the
+section's full prompt. tables_by_statement maps statements to table texts (see table_relevance.group_tables); a
+section whose statements have no tables gets all_tables instead. feedback maps section names to notes appended to
+that section's prompt, e.g. the checks a previous answer failed.
+'''
+def section_request(section, prompt_text, tables_by_statement, all_tables, model, system_message, typed=False,
+                    feedback=None):
+    feedback = feedback or {}
+
+    def chunked(prompt, tables):
+        return chunk_tables(tables, token_budget(model, system_message + prompt), model)
+
+    if typed and label_matching.ENABLED and section.name not in feedback:
+        with stage("label_match"):
+            match = label_matching.match_section(section.name, [
+                table for statement in label_matching.MATCH_STATEMENTS[section.name]
+                for table in tables_by_statement.get(statement, [])])
+        if match is not None and match.values:
+            label_matching.record_match(section.name, match)
+            finish = lambda result: merge_match(section, match, result)
+            if not match.residual and match.scale is not None and match.currency is not None:
+                return SectionRequest(None, [], None, finish)
+            with stage("prompt_build"):
+                tables = [table for statement in section.statements
+                          for table in tables_by_statement.get(statement, [])]
+                prompt = residual_prompt(prompt_text, section.name, match)
+                prompt += "\n\n" + TYPED_INSTRUCTIONS
+                chunks = chunked(prompt, tables or all_tables)
+            return SectionRequest(prompt, chunks, residual_model(section, tuple(match.residual)), finish)
+
+    with stage("prompt_build"):
+        tables = [table for statement in section.statements for table in tables_by_statement.get(statement, [])]
+        prompt = section_prompt(prompt_text, section.name)
+        if typed:
+            prompt += "\n\n" + TYPED_INSTRUCTIONS
+        if section.name in feedback:
+            prompt += "\n\n" + feedback[section.name]
+        chunks = chunked(prompt, tables or all_tables)
+    return SectionRequest(prompt, chunks, section.typed_model if typed else section.model, lambda result: result)
+
+
+def request_messages(system_message, request, chunk):
+    return [
+        {"role": "system", "content": system_message},
+        {"role": "user", "content": request.prompt + "\n\n" + "\n\n".join(chunk)}
+    ]
+
+
+def _section_results(sections, results):
+    '''Replaces the results the deadline cut short with None and records their sections as missed.'''
+    for section, result in zip(sections, results):
+        if result is deadlines.MISSED:
+            deadlines.miss(section.name)
+    return [None if result is deadlines.MISSED else result for result in results]
+
+
+'''
+Runs one extraction call per section concurrently and returns the raw results in the order of sections (None
+where a call failed to parse or did not answer before the run's deadline). Tables over the token budget are sent
+in chunks, whose calls run concurrently as well, and the partial results are merged. See section_request for
+tables_by_statement and feedback.
+'''
+def extract_section_results(openai_client, tables_by_statement, prompt_path, model, system_message,
+                            fallback_tables=(), max_workers=len(SECTIONS), typed=False, sections=SECTIONS,
+                            feedback=None):
+    prompt_text = load_prompt(prompt_path)
+    all_tables = [table for tables in tables_by_statement.values() for table in tables] or list(fallback_tables)
+
+    def extract(section):
+        request = section_request(section, prompt_text, tables_by_statement, all_tables, model, system_message,
+                                  typed, feedback)
+
+        def call(chunk):
+            return cached_parse(openai_client, model=model, messages=request_messages(system_message, request, chunk),
+                                response_format=request.response_format)
+
+        if len(request.chunks) <= 1:
+            return request.finish(merge_partial([call(chunk) for chunk in request.chunks]))
+        with ThreadPoolExecutor(max_workers=len(request.chunks), thread_name_prefix="chunk") as pool:
+            futures = [pool.submit(contextvars.copy_context().run, call, chunk) for chunk in request.chunks]
+            return request.finish(merge_partial([future.result() for future in futures]))
+
+    with deadlines.thread_pool(max(1, min(max_workers, len(sections))), "section") as pool:
+        # each call runs in a copy of the caller's context so it is recorded in the document's trace and keeps
+        # the run's deadline
+        futures = [pool.submit(contextvars.copy_context().run, extract, section) for section in sections]
+        return _section_results(sections, deadlines.results_by_deadline(futures))
+
+
+'''
+Same as extract_section_results for the async OpenAI client: every section's and every chunk's call is a
+coroutine on the running event loop.
+'''
+async def extract_section_results_async(openai_client, tables_by_statement, prompt_path, model, system_message,
+                                        fallback_tables=(), typed=False, sections=SECTIONS, feedback=None):
+    prompt_text = load_prompt(prompt_path)
+    all_tables = [table for tables in tables_by_statement.values() for table in tables] or list(fallback_tables)
+
+    async def extract(section):
+        request = section_request(section, prompt_text, tables_by_statement, all_tables, model, system_message,
+                                  typed, feedback)
+        results = await asyncio.gather(*(
+            cached_parse_async(openai_client, model=model, messages=request_messages(system_message, request, chunk),
+                               response_format=request.response_format)
+            for chunk in request.chunks))
+        return request.finish(merge_partial(results))
+
+    return _section_results(sections, await deadlines.gather_by_deadline(extract(section) for section in sections))
+
+
+'''
+Extracts every section concurrently and merges the results. With typed=True the result is a
+TypedFinancialStatementExtract, otherwise a FinancialStatementExtract.
+'''
+def extract_sections(openai_client, tables_by_statement, prompt_path, model, system_message,
+                     fallback_tables=(), max_workers=len(SECTIONS), typed=False):
+    results = extract_section_results(openai_client, tables_by_statement, prompt_path, model, system_message,
+                                      fallback_tables, max_workers, typed)
+    return merge_typed_sections(results) if typed else merge_sections(results)
+
+
+async def extract_sections_async(openai_client, tables_by_statement, prompt_path, model, system_message,
+                                 fallback_tables=(), typed=False):
+    results = await extract_section_results_async(openai_client, tables_by_statement, prompt_path, model,
+                                                  system_message, fallback_tables, typed)
+    return merge_typed_sections(results) if typed else merge_sections(results)
+
+
+def _replace_sections(extract, sections, results):
+    replaced = dict(zip((section.name for section in sections), results))
+    kept = [result for name, result in split_typed(extract).items()
+            if name not in replaced or replaced[name] is None]
+    return merge_typed_sections(kept + [result for result in replaced.values() if result is not None])
+
+
+'''
+Re-extracts only the named sections of a typed extract and returns the extract with those sections replaced.
+feedback is passed on to extract_section_results; it also keeps the retry from being answered by the LLM cache
+with the previous result.
+'''
+def reextract_sections(openai_client, extract, section_names, tables_by_statement, prompt_path, model,
+                       system_message, fallback_tables=(), feedback=None):
+    sections = [section for section in SECTIONS if section.name in section_names]
+    results = extract_section_results(openai_client, tables_by_statement, prompt_path, model, system_message,
+                                      fallback_tables, typed=True, sections=sections, feedback=feedback)
+    return _replace_sections(extract, sections, results)
+
+
+async def reextract_sections_async(openai_client, extract, section_names, tables_by_statement, prompt_path, model,
+                                   system_message, fallback_tables=(), feedback=None):
+    sections = [section for section in SECTIONS if section.name in section_names]
+    results = await extract_section_results_async(openai_client, tables_by_statement, prompt_path, model,
+                                                  system_message, fallback_tables, typed=True, sections=sections,
+                                                  feedback=feedback)
+    return _replace_sections(extract, sections, results)
+
+
+'''
+Splits a typed extract back into one section result per section, the inverse of merge_typed_sections.
+'''
+def split_typed(extract):
+    context = {"currency": extract.currency, "scale": extract.scale, "periods": extract.periods}
+    return {section.name: section.typed_model(**context, **{section.name: getattr(extract, section.name)})
+            for section in SECTIONS}
+
+
+'''
+Merges the results of one section's chunks (None where a call failed) into one result of the same model. Typed
+results are aligned on the union of their periods and rescaled to the first result's scale; every value is taken
+from the first chunk that reported it. Untyped fields take the first value other than "N/A".
+'''
+def merge_partial(results):
+    reported = [result for result in results if result is not None]
+    if len(reported) <= 1:
+        return reported[0] if reported else None
+    model = type(reported[0])
+    if not issubclass(model, StatementContext):
+        merged = dict.fromkeys(model.model_fields, "N/A")
+        for result in reported:
+            for field, value in result.model_dump().items():
+                if merged[field] in ("N/A", "", None):
+                    merged[field] = value
+        return model(**merged)
+
+    periods = union_periods(reported)
+    scale = Scale(reported[0].scale)
+    merged = {"currency": reported[0].currency, "scale": scale, "periods": periods}
+    for name in model.model_fields.keys() - StatementContext.model_fields.keys():
+        values_model = model.model_fields[name].annotation
+        values = {field: [None] * len(periods) for field in values_model.model_fields}
+        for result in reported:
+            factor = SCALE_FACTORS[Scale(result.scale)] / SCALE_FACTORS[scale]
+            for field, field_values in getattr(result, name):
+                aligned = align_values(field_values, result.periods, periods)
+                values[field] = [v if v is not None else (None if a is None else a * factor)
+                                 for v, a in zip(values[field], aligned)]
+        merged[name] = values_model(**values)
+    return model(**merged)
+
+
+'''
+The typed extract as a PartialTypedFinancialStatementExtract when the run's deadline cut sections short that are
+still all null in it (a later round may have answered them after all), otherwise the extract itself.
+'''
+def deadline_partial(extract):
+    missed = deadlines.missed()
+    missing = [section.name for section in SECTIONS if section.name in missed
+               and all(value is None for _, values in getattr(extract, section.name) for value in values)]
+    if not missing:
+        return extract
+    return PartialTypedFinancialStatementExtract(**extract.model_dump(exclude={"missing"}), missing=missing)
+
+
+'''
+Merges section results into a FinancialStatementExtract. Fields no section produced are filled with "N/A".
+'''
+def merge_sections(results):
+    merged = dict.fromkeys(FinancialStatementExtract.model_fields, "N/A")
+    for result in results:
+        if result is not None:
+            merged.update(result.model_dump())
+    return FinancialStatementExtract(**merged)
+
+
+'''
+Merges typed section results into a TypedFinancialStatementExtract. Sections are aligned on the union of the
+periods they reported and rescaled to the scale of the first section; sections that failed are all null.
+'''
+def merge_typed_sections(results):
+    reported = [result for result in results if result is not None]
+    periods = union_periods(reported)
+    currency = reported[0].currency if reported else "N/A"
+    scale = Scale(reported[0].scale) if reported else Scale.units
+
+    merged = {"currency": currency, "scale": scale, "periods": periods}
+    for section in SECTIONS:
+        values_model = TypedFinancialStatementExtract.model_fields[section.name].annotation
+        merged[section.name] = values_model(**{field: [None] * len(periods) for field in values_model.model_fields})
+    for result in reported:
+        factor = SCALE_FACTORS[Scale(result.scale)] / SCALE_FACTORS[scale]
+        for section in SECTIONS:
+            values = getattr(result, section.name, None)
+            if values is None:
+                continue
+            for field, field_values in values:
+                aligned = align_values(field_values, result.periods, periods)
+                setattr(merged[section.name], field, [None if v is None else v * factor for v in aligned])
+    return TypedFinancialStatementExtract(**merged)
@@ -0,0 +1,131 @@
+'''
+In-flight request coalescing for the Flask app. When a filing comes out, the same PDF tends to be uploaded several
+times within minutes; every upload used to run its own Azure analysis and OpenAI calls. SingleFlight runs one
+pipeline per document instead: requests for a document already being processed wait for that run and share its
+result, and the result is kept for RESULT_TTL_SECONDS so requests arriving just after it finished are answered
+from it too. Documents are keyed on the SHA-256 of their content, which uploads.store_upload computes while
+streaming the upload to disk.
+
+A failure is passed to the requests waiting on the run but not kept, so the next request tries again. Coalescing
+is per process; across the workers of a server the layout and LLM caches answer a document again once its first
+run has finished. A request waiting on another's run waits no longer than its own deadline (deadlines.py).
+
+Usage:
+    pdf_path, key = store_upload(stream)
+    result = flights.do(key, lambda: run_pipeline(pdf_path))
+'''
+
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from deadlines import remaining
+from instrumentation import REGISTRY
+from resilience import DeadlineExceeded
+
+RESULT_TTL_SECONDS = float(os.getenv("SINGLE_FLIGHT_TTL_SECONDS", 300))
+MAX_RESULTS = int(os.getenv("SINGLE_FLIGHT_MAX_RESULTS", 256))
+
+COALESCED_REQUESTS = REGISTRY.counter("coalesced_requests_total",
+                                      "Requests by how they were answered: by running the pipeline (leader), by "
+                                      "waiting for a run in flight (joined) or from a kept result (stored).",
+                                      ["outcome"])
+
+
+class _Flight:
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    '''
+    Runs fn once per key among concurrent callers of do(key, fn) and keeps its result for ttl seconds, at most
+    max_results of them (least recently used evicted first).
+    '''
+
+    def __init__(self, ttl=RESULT_TTL_SECONDS, max_results=MAX_RESULTS):
+        self.ttl = ttl
+        self.max_results = max_results
+        self._flights = {}
+        self._results = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _stored(self, key, now):
+        entry = self._results.get(key)
+        if entry is None:
+            return None
+        expires, result = entry
+        if expires <= now:
+            del self._results[key]
+            return None
+        self._results.move_to_end(key)
+        return entry
+
+    def _store(self, key, result, now):
+        if self.ttl <= 0 or self.max_results <= 0:
+            return
+        self._results[key] = (now + self.ttl, result)
+        self._results.move_to_end(key)
+        while len(self._results) > self.max_results:
+            self._results.popitem(last=False)
+
+    '''
+    Returns fn()'s result for key: the kept result if there is one, the result of the run in flight if there is
+    one (its exception is raised if it failed), otherwise that of a new run of fn. keep(result) decides whether the
+    result is kept for later requests, e.g. not a partial one. Waiting for the run in flight raises DeadlineExceeded
+    when the caller's deadline passes first; the run goes on for its own caller.
+    '''
+    def do(self, key, fn, keep=None):
+        with self._lock:
+            stored = self._stored(key, time.monotonic())
+            if stored is not None:
+                COALESCED_REQUESTS.inc(outcome="stored")
+                return stored[1]
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+            else:
+                flight.waiters += 1
+
+        if not leader:
+            COALESCED_REQUESTS.inc(outcome="joined")
+            finished = flight.done.wait(remaining())
+            with self._lock:
+                flight.waiters -= 1
+            if not finished:
+                raise DeadlineExceeded("single_flight", "the shared run was still going at the deadline")
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        COALESCED_REQUESTS.inc(outcome="leader")
+        try:
+            flight.result = fn()
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+                if flight.error is None and (keep is None or keep(flight.result)):
+                    self._store(key, flight.result, time.monotonic())
+            flight.done.set()
+        return flight.result
+
+    def stats(self):
+        with self._lock:
+            now = time.monotonic()
+            return {
+                "in_flight": len(self._flights),
+                "waiting": sum(flight.waiters for flight in self._flights.values()),
+                "stored_results": sum(expires > now for expires, _ in self._results.values()),
+                "leader": COALESCED_REQUESTS.value(outcome="leader"),
+                "joined": COALESCED_REQUESTS.value(outcome="joined"),
+                "stored": COALESCED_REQUESTS.value(outcome="stored"),
+            }
@@ -6,24 +6,27 @@ use Azure Document Intelligence instead of Docling, or use a different OpenAI mo
 This app has a user-friendly interface and is easy to deploy.
 '''
 
-import openai
-from openai import OpenAI
 import streamlit as st
-import os
-import openpyxl
-from prompt import FinancialStatementExtract
-import json
-from docling.document_converter import DocumentConverter
-from dotenv import load_dotenv
-from tempfile import NamedTemporaryFile
-from azure.core.credentials import AzureKeyCredential
-import io
-
-load_dotenv()
-
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-
-openai_client = OpenAI(api_key=OPENAI_API_KEY)
+from backends import EXTRACTORS
+from background import BackgroundRunner, process_upload, session_runs, upload_key
+from docling_pool import DoclingPool
+from uploads import write_scratch_file
+
+# Docling and the OpenAI client are loaded on the first upload and reused by every rerun of this process
+extractor = EXTRACTORS["docling"]
+PROMPT_PATH = 'data/prompt2.txt'
+
+# one pool of warm Docling converters per server process, shared by every session and rerun
+@st.cache_resource
+def get_docling_pool():
+    pool = DoclingPool()
+    pool.warm_up()
+    return pool
+
+# one pipeline worker pool per server process, shared by every session and rerun
+@st.cache_resource
+def get_runner():
+    return BackgroundRunner()
 
 st.set_page_config(
     page_title="Financial Statement Analyzer",
@@ -39,87 +42,41 @@ Upload a PDF file of a financial statement, and this demo will extract key finan
 uploaded_file = st.file_uploader("Upload Financial Statement PDF", type=["pdf"])
 
 if uploaded_file is not None:
-    with st.spinner('Processing...'):
-        try:
-            with NamedTemporaryFile(delete=False, suffix=".pdf") as temp_pdf:
-                temp_pdf.write(uploaded_file.read())
-                pdf_path = temp_pdf.name
-
-            
-            def extract_tables_from_pdf(pdf_path):
-                try:
-                    converter = DocumentConverter() # Uses Docling for now. 
-                    result = converter.convert(pdf_path)
-                    tables = result.document.export_to_markdown()
-                    print(tables)
-                    return tables
-                except Exception as e:
-                    print(f"Error extracting tables: {e}")
-                    return []
-
-            
-            def parse_tables_with_openai(tables):
-                with open('data/prompt2.txt', 'r') as f:
-                    prompt = f.read()
-                
-                for table in tables:
-                    prompt += "\n".join(["\t".join(row) for row in table]) + "\n\n"
-
-                try:
-                    response = openai_client.chat.completions.create(
-                        model="gpt-4-turbo", 
-                        messages=[
-                            {"role": "system", "content": "You are a helpful assistant for financial analysis."},
-                            {"role": "user", "content": prompt}
-                        ]
-                    )
-                    return response.choices[0].message.content
-                except Exception as e:
-                    print(f"Error parsing tables with OpenAI: {e}")
-                    return ""
-
-            def save_to_excel(parsed_data):
-                try:
-                    workbook = openpyxl.Workbook()
-                    sheet = workbook.active
-                    sheet.title = "Financial Metrics"
-
-                    lines = parsed_data.strip().split("\n")
-                    for line in lines:
-                        cells = [cell.strip() for cell in line.split("\t")]
-                        sheet.append(cells)
-
-                    # save to a BytesIO object
-                    excel_file = io.BytesIO()
-                    workbook.save(excel_file)
-                    excel_file.seek(0)
-                    return excel_file
-                except Exception as e:
-                    st.error(f"Error saving data to Excel: {e}")
-                    return None
-
-            # call helper functions to parse everything
-            tables = extract_tables_from_pdf(pdf_path)
-            if not tables:
-                st.error("No tables found in the PDF.")
-            else:
-                parsed_data = parse_tables_with_openai(tables)
-                if parsed_data:
-                    excel_file = save_to_excel(parsed_data)
-                    if excel_file:
-                        st.success("Processing complete!")
-                        st.markdown("### Download Extracted Metrics")
-                        st.download_button(
-                            label="Download Excel File",
-                            data=excel_file,
-                            file_name='financial_metrics.xlsx',
-                            mime='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-                        )
-                    else:
-                        st.error("Failed to create Excel file.")
-                else:
-                    st.error("Failed to parse data with OpenAI.")
-        except Exception as e:
-            st.error(f"An error occurred: {e}")
+    # each document is processed once per session; reruns pick up its run by the hash of the upload
+    key = upload_key(uploaded_file.getbuffer())
+    runs = session_runs(st.session_state)
+    if key not in runs:
+        # getbuffer() hands over the upload without copying it; the worker removes the scratch file when done
+        pdf_path = write_scratch_file(uploaded_file.getbuffer(), suffix=".pdf")
+        runs[key] = get_runner().submit(key, process_upload, pdf_path, extractor, PROMPT_PATH,
+                                        pool=get_docling_pool())
+    run = runs[key]
+
+    st.markdown("### Extracted Metrics")
+    progress = st.progress(run.fraction(), text=run.label())
+    placeholder = st.empty()
+    # rows are rendered into the placeholder as soon as their line has streamed in
+    while not run.wait(0.25):
+        progress.progress(run.fraction(), text=run.label())
+        if run.rows:
+            placeholder.table(run.rows)
+    progress.empty()
+    if run.rows:
+        placeholder.table(run.rows)
+
+    if run.error is not None:
+        st.error(f"An error occurred: {run.error}")
+        if st.button("Try again"):
+            del runs[key]
+            st.rerun()
+    else:
+        st.success("Processing complete!")
+        st.markdown("### Download Extracted Metrics")
+        st.download_button(
+            label="Download Excel File",
+            data=run.result,
+            file_name='financial_metrics.xlsx',
+            mime='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+        )
 else:
     st.info("Please upload a PDF file to get started.")
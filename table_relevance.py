@@ -0,0 +1,258 @@
+'''
+Statement-aware table pruning. A 10-K yields dozens to hundreds of tables, but FinancialStatementExtract only
+needs the income statement, the cash flow statement and the balance sheet. Each table is scored against the
+row-label vocabulary of those statements, taken from the bullet list in the prompt file and from the schema's
+field names, and only tables scoring above a threshold are forwarded to the LLM.
+'''
+
+import os
+import re
+
+from instrumentation import record_tables
+from tokens import count_tokens
+
+DEFAULT_THRESHOLD = float(os.getenv("TABLE_RELEVANCE_THRESHOLD", 0.25))
+DEFAULT_PROMPT_PATH = "data/prompt.txt"
+
+INCOME_STATEMENT = "income_statement"
+CASH_FLOW = "cash_flow"
+BALANCE_SHEET = "balance_sheet"
+STATEMENTS = (INCOME_STATEMENT, CASH_FLOW, BALANCE_SHEET)
+
+# prompt section headings that start a new statement
+PROMPT_SECTIONS = {
+    "income statement": INCOME_STATEMENT,
+    "cash flow statement": CASH_FLOW,
+    "balance sheet": BALANCE_SHEET,
+}
+
+# schema fields are declared statement by statement; these are the last field of each statement
+SCHEMA_SECTION_ENDS = {
+    "Cash_Adjustments": CASH_FLOW,
+    "Cash_And_Cash_Equivalents_End_Of_Period": BALANCE_SHEET,
+}
+
+# titles filings use for the primary statements, matched against a table's caption and header text
+STATEMENT_TITLES = {
+    INCOME_STATEMENT: ("statements of operations", "statements of income", "income statements",
+                       "statements of earnings", "comprehensive income"),
+    CASH_FLOW: ("statements of cash flows", "cash flows"),
+    BALANCE_SHEET: ("balance sheets", "balance sheet", "statements of financial position", "financial position"),
+}
+
+# extra labels that are common in filings but not spelled the same way in the prompt
+EXTRA_LABELS = {
+    INCOME_STATEMENT: ("net sales", "total net sales", "revenue", "revenues", "total revenues", "gross margin",
+                       "gross profit", "research and development", "operating expenses", "total operating expenses",
+                       "income before provision for income taxes", "earnings per share"),
+    CASH_FLOW: ("cash generated by operating activities", "cash used in investing activities",
+                "cash used in financing activities", "share-based compensation expense", "deferred income taxes",
+                "payments for acquisition of property plant and equipment", "repurchases of common stock",
+                "payments for dividends and dividend equivalents", "changes in operating assets and liabilities"),
+    BALANCE_SHEET: ("marketable securities", "vendor non-trade receivables", "total non-current assets",
+                    "commercial paper", "term debt", "total shareholders equity", "retained earnings",
+                    "deferred revenue", "accounts receivable net", "property plant and equipment net"),
+}
+
+# placeholder bullets such as "Revenue Item 1" or "Activity 2" carry no vocabulary
+PLACEHOLDER = re.compile(r"\b(item|activity|adjustment)\s*\d+$")
+NUMBER = re.compile(r"^[\s$€£(]*-?[\d,]+(\.\d+)?\s*%?\)?$")
+STOPWORDS = {"and", "of", "the", "for", "from", "to", "in", "on", "plus", "less", "net", "total"}
+
+_vocabulary = {}
+
+
+def normalize_label(label):
+    label = label.replace("&", " and ").replace("'", "").replace("’", "").replace("_", " ").casefold()
+    return " ".join(re.sub(r"[^a-z0-9]+", " ", label).split())
+
+
+def label_tokens(label):
+    return frozenset(word for word in normalize_label(label).split() if word not in STOPWORDS)
+
+
+'''
+Reads the bullet list of the prompt file and assigns each bullet to the statement whose heading precedes it.
+'''
+def prompt_labels(prompt_path):
+    labels = {statement: set() for statement in STATEMENTS}
+    statement = None
+    with open(prompt_path, "r") as f:
+        for line in f:
+            line = line.strip()
+            heading = normalize_label(line.split("(")[0]) if line.endswith(":") else None
+            if heading in PROMPT_SECTIONS:
+                statement = PROMPT_SECTIONS[heading]
+            elif statement and line.startswith("- "):
+                label = normalize_label(line[2:].replace("Plus:", ""))
+                if label and not PLACEHOLDER.search(label):
+                    labels[statement].add(label)
+    return labels
+
+
+'''
+Assigns the schema's field names to statements in declaration order.
+'''
+def schema_labels():
+    from prompt import FinancialStatementExtract  # pydantic loads with the first classification, not on import
+
+    labels = {statement: set() for statement in STATEMENTS}
+    statement = INCOME_STATEMENT
+    for field in FinancialStatementExtract.model_fields:
+        label = normalize_label(field)
+        if not PLACEHOLDER.search(label):
+            labels[statement].add(label)
+        statement = SCHEMA_SECTION_ENDS.get(field, statement)
+    return labels
+
+
+'''
+Builds (once per prompt file) the label vocabulary of every statement as sets of token sets.
+'''
+def statement_vocabulary(prompt_path=DEFAULT_PROMPT_PATH):
+    if prompt_path not in _vocabulary:
+        from_prompt = prompt_labels(prompt_path) if os.path.exists(prompt_path) else {}
+        from_schema = schema_labels()
+        vocabulary = {}
+        for statement in STATEMENTS:
+            labels = from_prompt.get(statement, set()) | from_schema[statement] | set(EXTRA_LABELS[statement])
+            vocabulary[statement] = {label_tokens(label) for label in labels} - {frozenset()}
+        _vocabulary[prompt_path] = vocabulary
+    return _vocabulary[prompt_path]
+
+
+def _matches(tokens, vocabulary):
+    if tokens in vocabulary:
+        return True
+    for phrase in vocabulary:
+        overlap = len(tokens & phrase)
+        if overlap and overlap / len(tokens | phrase) >= 0.6:
+            return True
+    return False
+
+
+'''
+Scores a table given its row labels and cells. Returns (statement, score): the statement whose vocabulary covers
+the largest share of the row labels, weighted by how numeric the table is, with a bonus when the caption or
+header names the statement.
+'''
+def classify_table(labels, cells, caption="", prompt_path=DEFAULT_PROMPT_PATH):
+    vocabulary = statement_vocabulary(prompt_path)
+    label_sets = [tokens for tokens in map(label_tokens, labels) if tokens]
+    if not label_sets:
+        return None, 0.0
+
+    values = [cell for cell in cells if cell.strip()]
+    numeric_density = sum(1 for cell in values if NUMBER.match(cell)) / len(values) if values else 0.0
+    title_text = normalize_label(caption)
+
+    best_statement, best_score = None, 0.0
+    for statement in STATEMENTS:
+        coverage = sum(1 for tokens in label_sets if _matches(tokens, vocabulary[statement])) / len(label_sets)
+        score = coverage * (0.5 + 0.5 * min(1.0, numeric_density * 2))
+        if any(title in title_text for title in STATEMENT_TITLES[statement]):
+            score += 0.25
+        if score > best_score:
+            best_statement, best_score = statement, score
+    return best_statement, round(min(best_score, 1.0), 3)
+
+
+def classify_grid(grid, prompt_path=DEFAULT_PROMPT_PATH):
+    cells = [cell for row in grid.body_rows() for cell in row[1:]]
+    return classify_table(grid.row_labels(), cells, " ".join(grid.column_headers()), prompt_path)
+
+
+def _report(label, kept, total, before_text, after_text, model):
+    before, after = count_tokens(before_text, model), count_tokens(after_text, model)
+    print(f"{label}: kept {kept}/{total} tables, ~{before:,} -> ~{after:,} input tokens")
+    return before, after
+
+
+'''
+Filters a list of TableGrids down to the statement tables. Falls back to every table when none clears the
+threshold so the prompt is never emptied by a bad guess.
+'''
+def select_tables(grids, threshold=DEFAULT_THRESHOLD, model="gpt-4o-2024-08-06", prompt_path=DEFAULT_PROMPT_PATH):
+    record_tables(len(grids))
+    kept = [grid for grid in grids if classify_grid(grid, prompt_path)[1] >= threshold]
+    if not kept:
+        kept = list(grids)
+    _report("Table pruning", len(kept), len(grids),
+            "\n\n".join(grid.to_text() for grid in grids), "\n\n".join(grid.to_text() for grid in kept), model)
+    return kept
+
+
+def _markdown_blocks(markdown):
+    '''Splits exported markdown into (caption, table_lines) pairs; the caption is the last text line before.'''
+    blocks = []
+    caption, table = "", []
+    for line in markdown.splitlines():
+        if line.lstrip().startswith("|"):
+            table.append(line.strip())
+            continue
+        if table:
+            blocks.append((caption, table))
+            table = []
+        if line.strip():
+            caption = line.strip().lstrip("#").strip()
+    if table:
+        blocks.append((caption, table))
+    return blocks
+
+
+def _classify_markdown_block(caption, lines, prompt_path):
+    rows = [[cell.strip() for cell in line.strip("|").split("|")] for line in lines
+            if not re.fullmatch(r"[|\s:-]+", line)]
+    labels = [row[0] for row in rows[1:]]
+    cells = [cell for row in rows[1:] for cell in row[1:]]
+    header = " ".join(rows[0]) if rows else ""
+    return classify_table(labels, cells, f"{caption} {header}", prompt_path)
+
+
+def _block_text(caption, lines):
+    return f"## {caption}\n" + "\n".join(lines) if caption else "\n".join(lines)
+
+
+'''
+Keeps only the statement tables of a markdown document (Docling's export_to_markdown), each preceded by its
+caption line.
+'''
+def prune_markdown(markdown, threshold=DEFAULT_THRESHOLD, model="gpt-4o-2024-08-06",
+                   prompt_path=DEFAULT_PROMPT_PATH):
+    blocks = _markdown_blocks(markdown)
+    record_tables(len(blocks))
+    kept = []
+    for caption, lines in blocks:
+        _, score = _classify_markdown_block(caption, lines, prompt_path)
+        if score >= threshold:
+            kept.append(_block_text(caption, lines))
+    if not kept:
+        return markdown
+    pruned = "\n\n".join(kept)
+    _report("Table pruning", len(kept), len(blocks), markdown, pruned, model)
+    return pruned
+
+
+'''
+Groups TableGrids by the statement they were classified as, as {statement: [table text, ...]}. Tables under the
+threshold are left out.
+'''
+def group_tables(grids, threshold=DEFAULT_THRESHOLD, prompt_path=DEFAULT_PROMPT_PATH):
+    groups = {statement: [] for statement in STATEMENTS}
+    for grid in grids:
+        statement, score = classify_grid(grid, prompt_path)
+        if statement and score >= threshold:
+            groups[statement].append(grid.to_text())
+    return groups
+
+
+'''
+Same as group_tables for a markdown document; each table keeps its caption line.
+'''
+def group_markdown(markdown, threshold=DEFAULT_THRESHOLD, prompt_path=DEFAULT_PROMPT_PATH):
+    groups = {statement: [] for statement in STATEMENTS}
+    for caption, lines in _markdown_blocks(markdown):
+        statement, score = _classify_markdown_block(caption, lines, prompt_path)
+        if statement and score >= threshold:
+            groups[statement].append(_block_text(caption, lines))
+    return groups
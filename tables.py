@@ -0,0 +1,222 @@
+'''
+Shared table model for the layout analysis backends. Azure Document Intelligence returns every table as a flat
+list of cells with row/column positions and spans. Instead of rescanning that list once per row, the cells are
+bucketed in a single pass into a fixed-size grid backed by flat arrays, so every lookup after that is O(1).
+'''
+
+from array import array
+
+KIND_CONTENT = 0
+KIND_COLUMN_HEADER = 1
+KIND_ROW_HEADER = 2
+KIND_STUB_HEAD = 3
+KIND_DESCRIPTION = 4
+
+_KIND_CODES = {
+    "content": KIND_CONTENT,
+    "columnHeader": KIND_COLUMN_HEADER,
+    "rowHeader": KIND_ROW_HEADER,
+    "stubHead": KIND_STUB_HEAD,
+    "description": KIND_DESCRIPTION,
+}
+_KIND_NAMES = {code: name for name, code in _KIND_CODES.items()}
+
+
+class TableGrid:
+    '''
+    A row_count x column_count grid stored row-major. Each slot records the index of the cell that covers it,
+    so a cell spanning several rows or columns is stored once and every slot it covers points back at it.
+    '''
+
+    def __init__(self, row_count, column_count):
+        self.row_count = row_count
+        self.column_count = column_count
+        self.contents = []
+        self.anchors = array("l")
+        self.row_spans = array("H")
+        self.column_spans = array("H")
+        self.kinds = array("B")
+        self._slots = array("l", [-1]) * (row_count * column_count)
+
+    def __len__(self):
+        return len(self.contents)
+
+    def __repr__(self):
+        return f"TableGrid(rows={self.row_count}, columns={self.column_count}, cells={len(self)})"
+
+    def add_cell(self, row_index, column_index, content, row_span=1, column_span=1, kind="content"):
+        '''Place one cell and mark every slot it spans. Spans running off the grid are clipped.'''
+        row_span = row_span or 1
+        column_span = column_span or 1
+        cell_id = len(self.contents)
+        self.contents.append(content or "")
+        self.anchors.append(row_index * self.column_count + column_index)
+        self.row_spans.append(row_span)
+        self.column_spans.append(column_span)
+        self.kinds.append(_KIND_CODES.get(kind or "content", KIND_CONTENT))
+
+        row_end = min(row_index + row_span, self.row_count)
+        column_end = min(column_index + column_span, self.column_count)
+        for r in range(row_index, row_end):
+            base = r * self.column_count
+            for c in range(column_index, column_end):
+                self._slots[base + c] = cell_id
+        return cell_id
+
+    def cell_at(self, row_index, column_index):
+        '''Returns the id of the cell covering (row_index, column_index), or -1 for an empty slot.'''
+        return self._slots[row_index * self.column_count + column_index]
+
+    def text(self, row_index, column_index):
+        cell_id = self.cell_at(row_index, column_index)
+        return self.contents[cell_id] if cell_id >= 0 else ""
+
+    def kind(self, cell_id):
+        return _KIND_NAMES[self.kinds[cell_id]]
+
+    def position(self, cell_id):
+        '''Returns (row_index, column_index, row_span, column_span) of a cell.'''
+        row_index, column_index = divmod(self.anchors[cell_id], self.column_count)
+        return row_index, column_index, self.row_spans[cell_id], self.column_spans[cell_id]
+
+    def is_anchor(self, row_index, column_index):
+        cell_id = self.cell_at(row_index, column_index)
+        return cell_id >= 0 and self.anchors[cell_id] == row_index * self.column_count + column_index
+
+    def row(self, row_index, fill_spans=True):
+        '''
+        Returns the full-width list of cell texts for a row. Merged cells are repeated across every column they
+        span so values stay under the right header; with fill_spans=False only the anchor slot holds the text.
+        '''
+        base = row_index * self.column_count
+        values = []
+        for c in range(self.column_count):
+            cell_id = self._slots[base + c]
+            if cell_id < 0 or (not fill_spans and self.anchors[cell_id] != base + c):
+                values.append("")
+            else:
+                values.append(self.contents[cell_id])
+        return values
+
+    def rows(self, fill_spans=True):
+        return [self.row(r, fill_spans) for r in range(self.row_count)]
+
+    def column(self, column_index, fill_spans=True):
+        if fill_spans:
+            return [self.text(r, column_index) for r in range(self.row_count)]
+        return [self.text(r, column_index) if self.is_anchor(r, column_index) else "" for r in range(self.row_count)]
+
+    def header_rows(self):
+        '''Indices of the rows that contain column header cells, in order.'''
+        found = []
+        for r in range(self.row_count):
+            base = r * self.column_count
+            for c in range(self.column_count):
+                cell_id = self._slots[base + c]
+                if cell_id >= 0 and self.kinds[cell_id] == KIND_COLUMN_HEADER:
+                    found.append(r)
+                    break
+        return found
+
+    def column_headers(self, separator=" "):
+        '''
+        Returns one header label per column, joining the text of every header row above it. Headers spanning
+        several columns (e.g. "Years ended") are shared by all of them.
+        '''
+        header_rows = self.header_rows()
+        labels = []
+        for c in range(self.column_count):
+            parts = []
+            last_id = -1
+            for r in header_rows:
+                cell_id = self.cell_at(r, c)
+                if cell_id >= 0 and cell_id != last_id and self.contents[cell_id]:
+                    parts.append(self.contents[cell_id])
+                last_id = cell_id
+            labels.append(separator.join(parts))
+        return labels
+
+    def body_rows(self):
+        '''Rows that are not column headers, as full-width lists of texts.'''
+        header_rows = set(self.header_rows())
+        return [self.row(r) for r in range(self.row_count) if r not in header_rows]
+
+    def row_labels(self):
+        '''The first-column text of every row; this is where financial tables keep their line-item names.'''
+        return [self.text(r, 0) for r in range(self.row_count)] if self.column_count else []
+
+    def find_row(self, label):
+        '''Returns the index of the first row whose label matches, ignoring case and surrounding whitespace.'''
+        wanted = label.strip().casefold()
+        for r, row_label in enumerate(self.row_labels()):
+            if row_label.strip().casefold() == wanted:
+                return r
+        return -1
+
+    def to_text(self):
+        '''Tab-separated rows, the format the prompts have always been built from.'''
+        return "\n".join("\t".join(row) for row in self.rows())
+
+    def to_markdown(self):
+        if not self.row_count:
+            return ""
+        if self.header_rows():
+            header, body = self.column_headers(), self.body_rows()
+        else:
+            header, body = self.row(0), self.rows()[1:]
+        lines = ["| " + " | ".join(header) + " |", "|" + "---|" * self.column_count]
+        for row in body:
+            lines.append("| " + " | ".join(row) + " |")
+        return "\n".join(lines)
+
+    def to_dict(self):
+        '''Compact, JSON-friendly form: one [row, column, row_span, column_span, kind, content] list per cell.'''
+        cells = []
+        for cell_id, content in enumerate(self.contents):
+            row_index, column_index, row_span, column_span = self.position(cell_id)
+            cells.append([row_index, column_index, row_span, column_span, self.kinds[cell_id], content])
+        return {"rows": self.row_count, "columns": self.column_count, "cells": cells}
+
+    @classmethod
+    def from_dict(cls, data):
+        grid = cls(data["rows"], data["columns"])
+        for row_index, column_index, row_span, column_span, kind, content in data["cells"]:
+            grid.add_cell(row_index, column_index, content, row_span, column_span, _KIND_NAMES.get(kind))
+        return grid
+
+
+'''
+Builds a TableGrid from anything shaped like an Azure DocumentTable: row_count, column_count and a cells list
+whose items have row_index, column_index, row_span, column_span, kind and content. One pass over the cells.
+'''
+def build_table_grid(table):
+    grid = TableGrid(table.row_count, table.column_count)
+    for cell in table.cells:
+        grid.add_cell(
+            cell.row_index,
+            cell.column_index,
+            cell.content,
+            getattr(cell, "row_span", 1),
+            getattr(cell, "column_span", 1),
+            getattr(cell, "kind", "content"),
+        )
+    return grid
+
+
+'''
+Builds a TableGrid from a plain list of rows, e.g. tables coming from Docling or from older cached output.
+'''
+def grid_from_rows(rows):
+    column_count = max((len(row) for row in rows), default=0)
+    grid = TableGrid(len(rows), column_count)
+    for r, row in enumerate(rows):
+        for c, content in enumerate(row):
+            grid.add_cell(r, c, content)
+    return grid
+
+
+'''
+Converts every table of an Azure analyze result into a TableGrid.
+'''
+def grids_from_result(result):
+    return [build_table_grid(table) for table in result.tables]
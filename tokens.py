@@ -0,0 +1,30 @@
+'''
+Local token counting for prompts. Uses tiktoken's encoding for the target model when tiktoken is installed and
+falls back to the usual ~4 characters per token estimate otherwise.
+'''
+
+from functools import lru_cache
+
+DEFAULT_MODEL = "gpt-4o-2024-08-06"
+
+
+@lru_cache(maxsize=None)
+def _encoding(model):
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")
+
+
+'''
+Returns the number of tokens text takes up for the given model.
+'''
+def count_tokens(text, model=DEFAULT_MODEL):
+    encoding = _encoding(model)
+    if encoding is None:
+        return (len(text) + 3) // 4
+    return len(encoding.encode(text, disallowed_special=()))
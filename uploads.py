@@ -0,0 +1,175 @@
+'''
+Memory- and disk-bounded handling of uploaded PDFs. Uploads are streamed in fixed-size chunks into files in one
+managed scratch directory (store_upload for the Flask endpoint, save_upload for the job queue) and rejected once
+they pass MAX_UPLOAD_BYTES, so a request holds at most one chunk of the upload in memory; the pipeline then works
+on the file's path. Scratch files are always removed when processing ends. Counters for uploads and scratch disk
+usage are exposed by upload_metrics() and on the Prometheus registry (instrumentation.REGISTRY).
+'''
+
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+from instrumentation import REGISTRY
+
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", 50 * 1024 * 1024))
+SCRATCH_DIR = os.getenv("UPLOAD_SCRATCH_DIR", os.path.join(tempfile.gettempdir(), "financial-statement-scratch"))
+CHUNK_SIZE = 64 * 1024
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+class UploadMetrics:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.uploads_total = 0
+        self.uploads_rejected = 0
+        self.bytes_received = 0
+        self.scratch_files = 0
+        self.scratch_bytes = 0
+        self.scratch_bytes_peak = 0
+
+    def add(self, **deltas):
+        with self._lock:
+            for name, delta in deltas.items():
+                setattr(self, name, getattr(self, name) + delta)
+            self.scratch_bytes_peak = max(self.scratch_bytes_peak, self.scratch_bytes)
+
+    def snapshot(self):
+        with self._lock:
+            return {name: value for name, value in vars(self).items() if not name.startswith("_")}
+
+
+metrics = UploadMetrics()
+
+REGISTRY.observed("uploads_total", "Uploads accepted.", lambda: metrics.uploads_total, "counter")
+REGISTRY.observed("uploads_rejected_total", "Uploads rejected for exceeding MAX_UPLOAD_BYTES.",
+                  lambda: metrics.uploads_rejected, "counter")
+REGISTRY.observed("upload_bytes_received_total", "Bytes of accepted uploads.", lambda: metrics.bytes_received,
+                  "counter")
+REGISTRY.observed("upload_scratch_files", "Scratch files currently held by requests.", lambda: metrics.scratch_files)
+REGISTRY.observed("upload_scratch_bytes", "Bytes of the scratch files currently held by requests.",
+                  lambda: metrics.scratch_bytes)
+REGISTRY.observed("upload_scratch_bytes_peak", "Most bytes held in scratch files at once.",
+                  lambda: metrics.scratch_bytes_peak)
+REGISTRY.observed("upload_scratch_disk_bytes", "Disk space the scratch directory uses, including stale files.",
+                  lambda: scratch_disk_bytes())
+
+
+'''
+Streams an upload straight into a file at path in chunks, enforcing the same size limit. The partial file is
+removed when the limit is hit. digest (e.g. hashlib.sha256()) is updated with every chunk when given.
+'''
+def save_upload(stream, path, max_bytes=MAX_UPLOAD_BYTES, digest=None):
+    size = 0
+    try:
+        with open(path, "wb") as f:
+            while True:
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > max_bytes:
+                    metrics.add(uploads_rejected=1)
+                    raise UploadTooLarge(f"Upload exceeds the {max_bytes // (1024 * 1024)} MB limit")
+                if digest is not None:
+                    digest.update(chunk)
+                f.write(chunk)
+    except BaseException:
+        if os.path.exists(path):
+            os.remove(path)
+        raise
+    metrics.add(uploads_total=1, bytes_received=size)
+    return size
+
+
+def _scratch_root():
+    os.makedirs(SCRATCH_DIR, exist_ok=True)
+    return SCRATCH_DIR
+
+
+'''
+Writes data (bytes or a buffer, e.g. Streamlit's UploadedFile.getbuffer()) to a new file in the scratch
+directory and returns its path. Pair with remove_scratch_file, or use scratch_file.
+'''
+def write_scratch_file(data, suffix=""):
+    fd, path = tempfile.mkstemp(suffix=suffix, dir=_scratch_root())
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    metrics.add(scratch_files=1, scratch_bytes=memoryview(data).nbytes)
+    return path
+
+
+def remove_scratch_file(path):
+    try:
+        size = os.path.getsize(path)
+        os.remove(path)
+    except FileNotFoundError:
+        return
+    metrics.add(scratch_files=-1, scratch_bytes=-size)
+
+
+'''
+Streams an upload into a new file in the scratch directory and returns its path and the SHA-256 of its content,
+hashed on the way in to key single_flight. Pair with remove_scratch_file.
+'''
+def store_upload(stream, max_bytes=MAX_UPLOAD_BYTES, suffix=".pdf"):
+    fd, path = tempfile.mkstemp(suffix=suffix, dir=_scratch_root())
+    os.close(fd)
+    digest = hashlib.sha256()
+    size = save_upload(stream, path, max_bytes, digest)
+    metrics.add(scratch_files=1, scratch_bytes=size)
+    return path, digest.hexdigest()
+
+
+@contextmanager
+def scratch_file(data, suffix=""):
+    path = write_scratch_file(data, suffix)
+    try:
+        yield path
+    finally:
+        remove_scratch_file(path)
+
+
+'''
+Removes scratch files older than max_age seconds, left behind by a process that was killed mid-request.
+'''
+def cleanup_stale_scratch(max_age=3600):
+    cutoff = time.time() - max_age
+    for name in os.listdir(_scratch_root()):
+        path = os.path.join(SCRATCH_DIR, name)
+        try:
+            if os.stat(path).st_mtime < cutoff:
+                if os.path.isdir(path):
+                    shutil.rmtree(path, ignore_errors=True)
+                else:
+                    os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def scratch_disk_bytes():
+    '''The disk space the scratch directory actually uses.'''
+    disk_bytes = 0
+    for name in os.listdir(_scratch_root()):
+        try:
+            disk_bytes += os.path.getsize(os.path.join(SCRATCH_DIR, name))
+        except OSError:
+            pass
+    return disk_bytes
+
+
+'''
+Current counters plus the disk space the scratch directory actually uses.
+'''
+def upload_metrics():
+    snapshot = metrics.snapshot()
+    snapshot["scratch_disk_bytes"] = scratch_disk_bytes()
+    return snapshot
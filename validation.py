@@ -0,0 +1,197 @@
+'''
+Accounting-identity checks on typed extraction results. The identities (total assets = total liabilities +
+equity, the cash-flow sections add up to the change in cash, beginning cash + change = ending cash, net income
+agrees across statements) are encoded once as a coefficient matrix over the normalized metrics, so a whole batch
+of documents x periods is checked with a couple of matrix products.
+
+validated_extract runs the typed per-section extraction and re-sends only the sections whose checks failed,
+with the failed checks spelled out in the prompt.
+'''
+
+from collections import namedtuple
+
+import numpy as np
+
+import deadlines
+from normalize import METRIC_INDEX, METRIC_NAMES, normalize_batch, to_array
+from sections import extract_sections, extract_sections_async, reextract_sections, reextract_sections_async
+
+# statements round every line, so totals are allowed to be off by this much (in the array's scale) or by
+# REL_TOLERANCE of the total, whichever is larger
+ABS_TOLERANCE = 1.0
+REL_TOLERANCE = 0.005
+
+'''
+total must equal the sum of parts. A check only applies when total and every required part were extracted;
+optional parts count as 0 when missing. sections are the ones re-extracted when the check fails.
+'''
+Identity = namedtuple("Identity", ["name", "total", "parts", "optional", "sections"])
+
+IDENTITIES = (
+    Identity("balance_sheet_balances", "balance_sheet.Total_Assets",
+             ("balance_sheet.Total_Liabilities", "balance_sheet.Shareholder_Equity"), (),
+             ("balance_sheet",)),
+    Identity("liabilities_and_equity_total", "balance_sheet.Total_Liabilities_And_Shareholders_Equities",
+             ("balance_sheet.Total_Assets",), (),
+             ("balance_sheet",)),
+    Identity("cash_flow_sections", "cash_flow.Change_In_Cash_Cash_Equiv",
+             ("cash_flow.Cash_Flow_From_Operating_Activities", "cash_flow.Cash_Flow_From_Investing_Activities",
+              "cash_flow.Cash_Flow_From_Financing_Activities"),
+             ("cash_flow.Foreign_Exchange_Rate_Effect_on_Cash_and_Cash_Equivalents",
+              "cash_flow.Discontinued_Operations_Cash_Flows"),
+             ("cash_flow",)),
+    Identity("cash_roll_forward", "cash_flow.Cash_And_Cash_Equivalents_End_Of_Period",
+             ("cash_flow.Cash_And_Cash_Equivalents_Beginning_Of_Period", "cash_flow.Change_In_Cash_Cash_Equiv"), (),
+             ("cash_flow",)),
+    Identity("net_income_cash_flow", "cash_flow.Net_Income",
+             ("income_statement.Net_Income",), (),
+             ("income_statement", "cash_flow")),
+    Identity("net_income_adjusted_ebitda", "adjusted_ebitda.Net_Income",
+             ("income_statement.Net_Income",), (),
+             ("adjusted_ebitda",)),
+)
+
+
+def _identity_matrices(identities):
+    coefficients = np.zeros((len(identities), len(METRIC_NAMES)))
+    required = np.zeros((len(identities), len(METRIC_NAMES)))
+    for i, identity in enumerate(identities):
+        coefficients[i, METRIC_INDEX[identity.total]] = 1.0
+        required[i, METRIC_INDEX[identity.total]] = 1.0
+        for name in identity.parts:
+            coefficients[i, METRIC_INDEX[name]] -= 1.0
+            required[i, METRIC_INDEX[name]] = 1.0
+        for name in identity.optional:
+            coefficients[i, METRIC_INDEX[name]] -= 1.0
+    totals = np.array([METRIC_INDEX[identity.total] for identity in identities])
+    return coefficients, required, totals
+
+
+COEFFICIENTS, REQUIRED, TOTALS = _identity_matrices(IDENTITIES)
+
+'''
+failed and applicable are boolean arrays of shape (documents, periods, identities); residuals holds total minus
+the sum of its parts.
+'''
+ValidationReport = namedtuple("ValidationReport", ["failed", "applicable", "residuals", "periods"])
+
+
+'''
+Checks every identity for every document and period of a normalize.StatementArray at once.
+'''
+def validate(statements, abs_tolerance=ABS_TOLERANCE, rel_tolerance=REL_TOLERANCE):
+    values = statements.values
+    filled = np.nan_to_num(values)
+    residuals = filled @ COEFFICIENTS.T
+    applicable = (np.isnan(values).astype(float) @ REQUIRED.T) == 0
+    tolerance = np.maximum(abs_tolerance, rel_tolerance * np.abs(filled[..., TOTALS]))
+    failed = applicable & (np.abs(residuals) > tolerance)
+    return ValidationReport(failed, applicable, residuals, statements.periods)
+
+
+def validate_extract(extract, **tolerances):
+    return validate(normalize_batch([extract]), **tolerances)
+
+
+'''
+The identities a document failed, as (identity, period, residual) tuples.
+'''
+def failed_checks(report, document=0):
+    failures = []
+    for period_index, identity_index in zip(*np.nonzero(report.failed[document])):
+        failures.append((IDENTITIES[identity_index], report.periods[period_index],
+                         float(report.residuals[document, period_index, identity_index])))
+    return failures
+
+
+def failing_sections(report, document=0):
+    return {section for identity, _, _ in failed_checks(report, document) for section in identity.sections}
+
+
+'''
+Spells out a document's failed checks per section, in the extract's own numbers, for the re-extraction prompt.
+'''
+def describe_failures(extract, report, document=0):
+    values = dict(zip(METRIC_NAMES, to_array(extract, report.periods, extract.scale).T))
+    period_index = {period: i for i, period in enumerate(report.periods)}
+    notes = {}
+    for identity, period, _ in failed_checks(report, document):
+        i = period_index[period]
+        parts = " + ".join(f"{name} ({values[name][i]:g})" for name in identity.parts)
+        line = f"- {period}: {identity.total} ({values[identity.total][i]:g}) should equal {parts}"
+        for section in identity.sections:
+            notes.setdefault(section, []).append(line)
+    intro = "A previous extraction failed these accounting checks. Re-read the tables and correct the values:"
+    return {section: "\n".join([intro, *lines]) for section, lines in notes.items()}
+
+
+'''
+Extracts a TypedFinancialStatementExtract and validates it. Sections involved in failed checks are re-extracted
+(up to max_rounds times), and a re-extraction is kept only when it fails fewer checks than the answer before.
+'''
+def validated_extract(openai_client, tables_by_statement, prompt_path, model, system_message,
+                      fallback_tables=(), max_rounds=1):
+    extract = extract_sections(openai_client, tables_by_statement, prompt_path, model, system_message,
+                               fallback_tables, typed=True)
+    return revise_failures(openai_client, extract, tables_by_statement, prompt_path, model, system_message,
+                           fallback_tables, max_rounds)
+
+
+'''
+Same as validated_extract for the async OpenAI client.
+'''
+async def validated_extract_async(openai_client, tables_by_statement, prompt_path, model, system_message,
+                                  fallback_tables=(), max_rounds=1):
+    extract = await extract_sections_async(openai_client, tables_by_statement, prompt_path, model, system_message,
+                                           fallback_tables, typed=True)
+    return await revise_failures_async(openai_client, extract, tables_by_statement, prompt_path, model,
+                                       system_message, fallback_tables, max_rounds)
+
+
+'''
+The re-extraction rounds of validated_extract for an extract obtained otherwise (e.g. by the model cascade). No
+round starts once the run's deadline has passed.
+'''
+def revise_failures(openai_client, extract, tables_by_statement, prompt_path, model, system_message,
+                    fallback_tables=(), max_rounds=1):
+    report = validate_extract(extract)
+    for _ in range(max_rounds):
+        sections = failing_sections(report)
+        if not sections or deadlines.expired():
+            break
+        print(f"Re-extracting sections that failed validation: {', '.join(sorted(sections))}")
+        candidate = reextract_sections(openai_client, extract, sections, tables_by_statement, prompt_path, model,
+                                       system_message, fallback_tables, describe_failures(extract, report))
+        candidate_report = validate_extract(candidate)
+        if candidate_report.failed.sum() >= report.failed.sum():
+            break
+        extract, report = candidate, candidate_report
+    return extract
+
+
+async def revise_failures_async(openai_client, extract, tables_by_statement, prompt_path, model, system_message,
+                                fallback_tables=(), max_rounds=1):
+    report = validate_extract(extract)
+    for _ in range(max_rounds):
+        sections = failing_sections(report)
+        if not sections or deadlines.expired():
+            break
+        print(f"Re-extracting sections that failed validation: {', '.join(sorted(sections))}")
+        candidate = await reextract_sections_async(openai_client, extract, sections, tables_by_statement,
+                                                   prompt_path, model, system_message, fallback_tables,
+                                                   describe_failures(extract, report))
+        candidate_report = validate_extract(candidate)
+        if candidate_report.failed.sum() >= report.failed.sum():
+            break
+        extract, report = candidate, candidate_report
+    return extract
+
+
+'''
+Validates a batch of extracts ({name: extract}) in one pass and returns {name: [failed identity names]}.
+'''
+def validate_batch(extracts):
+    names = [name for name, extract in extracts.items() if extract is not None]
+    report = validate(normalize_batch([extracts[name] for name in names]))
+    return {name: sorted({identity.name for identity, _, _ in failed_checks(report, i)})
+            for i, name in enumerate(names)}